@@ -1,11 +1,126 @@
 
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, Response, abort, g, render_template, request, redirect, stream_with_context, url_for
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import DeclarativeBase
+from werkzeug.http import is_resource_modified
+import logging
 import os
 import secrets
+import time
+from src.mais import metrics
+from src.mais.logging_config import configure_logging, log_access_sampled
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+class Base(DeclarativeBase):
+    pass
+
+db = SQLAlchemy(model_class=Base)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET") or secrets.token_hex(16)
 
+# URL対応表のデータベース（未設定時はローカルのSQLite）
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL") or "sqlite:///mais.db"
+
+# コネクションプール（切れた接続は使う前に検出し、長時間使った接続は作り直す）
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_pre_ping": True, "pool_recycle": 300}
+if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+    )
+db.init_app(app)
+
+with app.app_context():
+    import src.mais.models  # noqa: F401
+    db.create_all()
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+    g.timer = metrics.RequestTimer()
+
+@app.after_request
+def access_log(response):
+    # プロキシ経路のみ、サンプリングしたアクセスログを出す
+    if request.endpoint in ('redirect_to_url', 'redirect_to_relative_url'):
+        log_access_sampled(request.method, request.path, response.status_code, time.perf_counter() - g.request_started)
+    return response
+
+@app.after_request
+def record_metrics(response):
+    # ストリーミング応答はヘッダー送信時点までの段階だけがServer-Timingに載る
+    server_timing = g.timer.server_timing()
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    
+    route = request.endpoint or 'other'
+    started = g.request_started
+    metrics.inc('mais_requests_total', route=route, status=str(response.status_code))
+    if response.is_streamed:
+        response.response = metrics.write_iter(response.response, g.timer)
+    else:
+        metrics.inc('mais_bytes_total', response.content_length or 0, direction='out')
+    
+    def finish():
+        metrics.observe('mais_request_seconds', time.perf_counter() - started, route=route)
+        metrics.maybe_flush()
+    
+    response.call_on_close(finish)
+    return response
+
+# エラーページはメッセージごとに一度だけ描画して使い回す（不正なIDへの大量のアクセスでテンプレートを描画しないため）
+_error_pages = {}
+
+def error_page(message, status=200):
+    """
+    エラーページの応答を返す関数
+    
+    Args:
+        message (str): 表示するメッセージ（固定の文言のみ。メッセージごとにキャッシュされる）
+        status (int): ステータスコード
+        
+    Returns:
+        flask.Response: エラーページ
+    """
+    body = _error_pages.get(message)
+    if body is None:
+        body = _error_pages[message] = render_template('error.html', message=message).encode('utf-8')
+    return Response(body, status=status, mimetype='text/html')
+
+# 検索エンジンにはトップページ以外（プロキシしたページ）を収集させない
+ROBOTS_TXT = "User-agent: *\nAllow: /$\nDisallow: /\n"
+
+# よく要求されるパスは、トークンとして扱わずに専用の応答を返す
+WELL_KNOWN_CACHE_CONTROL = 'public, max-age=86400'
+
+@app.route('/robots.txt')
+def robots_txt():
+    return Response(ROBOTS_TXT, mimetype='text/plain', headers={'Cache-Control': WELL_KNOWN_CACHE_CONTROL})
+
+@app.route('/favicon.ico')
+def favicon():
+    # アイコンは無いため、空の404をキャッシュさせる
+    return Response(status=404, headers={'Cache-Control': WELL_KNOWN_CACHE_CONTROL})
+
+@app.after_request
+def release_flight(response):
+    # 結果を共有しないまま応答を終えた場合は、送信完了（または切断）時に待ち合わせを解放する
+    # （ストリーミング応答は本文を送り終えた時点で共有済みのため何もしない）
+    flight = g.pop('flight', None)
+    if flight is not None:
+        response.call_on_close(flight.abandon)
+    return response
+
+@app.teardown_request
+def abandon_flight(exc):
+    # 例外で応答を返せなかった場合（after_requestを通らない場合）も待っていた要求を解放する
+    flight = g.pop('flight', None)
+    if flight is not None:
+        flight.abandon()
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -14,7 +129,7 @@ def index():
 def create_short_url():
     url = request.form.get('url')
     if not url:
-        return render_template('error.html', message='URLを入力してください')
+        return error_page('URLを入力してください')
     
     # URLにスキームがない場合は追加
     if not url.startswith(('http://', 'https://')):
@@ -23,38 +138,299 @@ def create_short_url():
     from src.mais.url_crypto import encode_url
     encoded_id = encode_url(url)
     if not encoded_id:
-        return render_template('error.html', message='URLの暗号化に失敗しました')
+        return error_page('URLの暗号化に失敗しました')
+    
+    from src.mais.short_codes import create_short_code, schedule_external_shortening
+    
+    # ローカルの短縮コードを発行（同じURLには同じコード）
+    short_code = create_short_code(url, encoded_id)
+    short_url = request.host_url + 's/' + short_code
+    
+    # 外部サービスでの短縮は必要な場合のみバックグラウンドで行う
+    schedule_external_shortening(app, url, request.host_url + encoded_id)
+    
+    return render_template('result.html', tiny_url=short_url, original_url=url)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # トークンが無い・一致しない場合は存在を明かさない
+    if not metrics.is_authorized(request.headers.get('Authorization')):
+        abort(404)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/s/<code>')
+def resolve_short_url(code):
+    from src.mais.short_codes import resolve_short_code
+    
+    encoded_id = resolve_short_code(code)
+    if not encoded_id:
+        abort(404)
+    return redirect(url_for('redirect_to_url', encoded_id=encoded_id))
+
+# 上流から透過的に転送するレスポンスヘッダー
+PASSTHROUGH_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'Content-Encoding')
+
+# ストリーミング転送時のチャンクサイズ
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# ブラウザからの条件付きリクエストヘッダー
+CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+def not_modified_response(validators):
+    """
+    Returns a 304 response if the browser's cached copy is still valid.
+    
+    Args:
+        validators (dict): Caching headers of the response we would send
+        
+    Returns:
+        flask.Response: A 304 response, or None if a full response is needed
+    """
+    if not any(header in request.headers for header in CONDITIONAL_HEADERS):
+        return None
+    if is_resource_modified(request.environ, etag=validators.get('ETag'), last_modified=validators.get('Last-Modified')):
+        return None
+    response = Response(status=304)
+    response.headers.update(validators)
+    return response
+
+def stream_upstream_response(upstream, cache_url=None, limit=0):
+    """
+    Streams an upstream response to the client chunk by chunk.
+    
+    The body is forwarded as raw bytes (without decoding Content-Encoding),
+    so memory per request stays constant regardless of the body size.
+    
+    Args:
+        upstream (requests.Response): A response opened with stream=True
+        cache_url (str): If given, a complete 200 body is also stored in the response cache
+        limit (int): Maximum body size in bytes; the stream is aborted beyond it (0 = unlimited)
+        
+    Returns:
+        flask.Response: The streaming response
+    """
+    from src.mais import response_cache
+    from src.mais.proxy_utils import iter_limited
     
-    import pyshorteners
+    timer = g.timer
     
-    proxy_url = request.host_url + encoded_id
+    def generate():
+        try:
+            chunks = metrics.timed_iter(upstream.raw.stream(STREAM_CHUNK_SIZE, decode_content=False), timer, 'download', direction='in')
+            if limit:
+                chunks = iter_limited(chunks, limit, upstream.url)
+            if cache_url and upstream.status_code == 200:
+                chunks = response_cache.tee(chunks, cache_url, request.host_url, upstream.status_code, upstream.headers)
+            yield from chunks
+        finally:
+            upstream.close()
     
-    # TinyURLで短縮
-    s = pyshorteners.Shortener()
-    tiny_url = s.tinyurl.short(proxy_url)
+    response = Response(stream_with_context(generate()), status=upstream.status_code)
+    for header in PASSTHROUGH_HEADERS:
+        if header in upstream.headers:
+            response.headers[header] = upstream.headers[header]
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers.update(response_cache.client_validators(upstream.headers, request.host_url))
+    return response
+
+def cached_response(entry):
+    """
+    Builds a response from a response cache entry, answering 304 when possible.
+    """
+    from src.mais import compression, prefetch, response_cache
+    
+    validators = response_cache.client_validators(entry['headers'], request.host_url, entry.get('rewritten', False))
+    response = not_modified_response(validators)
+    if response is not None:
+        return response
     
-    return render_template('result.html', tiny_url=tiny_url, original_url=url)
+    body, content_encoding = compression.encode_cached_body(entry, request.headers.get('Accept-Encoding'))
+    response = Response(body, status=entry['status'])
+    if 'Content-Type' in entry['headers']:
+        response.headers['Content-Type'] = entry['headers']['Content-Type']
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    links = prefetch.preload_links(entry.get('resources'), request.host_url)
+    if links:
+        response.headers['Link'] = links
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers.update(validators)
+    return response
+
+@app.route('/<encoded_id>/', defaults={'rest': ''})
+@app.route('/<encoded_id>/<path:rest>')
+def redirect_to_relative_url(encoded_id, rest):
+    """
+    オリジン相対の参照（/<オリジンのトークン>/<パスとクエリ>）を処理する
+    """
+    from urllib.parse import quote
+    from src.mais.url_crypto import RELATIVE_SAFE_CHARS
+    
+    # パスはデコード前の形（%エスケープを含む）で使う
+    raw_uri = request.environ.get('RAW_URI') or request.environ.get('REQUEST_URI')
+    prefix = '/' + encoded_id + '/'
+    if raw_uri and raw_uri.startswith(prefix):
+        rest = raw_uri[len(prefix):]
+    else:
+        rest = quote(rest, safe=RELATIVE_SAFE_CHARS)
+        if request.query_string:
+            rest += '?' + request.query_string.decode('latin-1')
+    return redirect_to_url(encoded_id + '/' + rest)
 
 @app.route('/<encoded_id>')
 def redirect_to_url(encoded_id):
+    from src.mais import access_counts, coalescing, compression, prefetch, response_cache, rewrite_cache
     from src.mais.url_crypto import decode_url
-    from src.mais.proxy_utils import fetch_content
-    from src.mais.content_processor import process_content
+    from src.mais.proxy_utils import BodyTooLargeError, check_content_length, fetch_content, get_body_limit, iter_limited, request_upstream
+    from src.mais.content_processor import get_content_kind, process_response
     
-    original_url = decode_url(encoded_id)
+    timer = g.timer
+    with timer.stage('decode'):
+        original_url = decode_url(encoded_id)
     if not original_url:
-        return render_template('error.html', message='無効なURLです')
-        
-    # 元のコンテンツを取得
-    content, status_code, content_type = fetch_content(original_url)
-    if status_code != 200:
-        return render_template('error.html', message='コンテンツの取得に失敗しました')
-        
-    # コンテンツを処理してプロキシ化
-    processed_content = process_content(content, original_url, request.host_url)
+        return error_page('無効なURLです')
+    
+    # アクセス数はメモリ上で数え、DBへはまとめて書き込む
+    access_counts.record(encoded_id)
+    
+    # data: URIやhttp(s)以外はまとめて取得する
+    if not original_url.startswith(('http://', 'https://')):
+        with timer.stage('fetch'):
+            content, status_code, content_type = fetch_content(original_url)
+        if status_code != 200:
+            return error_page('コンテンツの取得に失敗しました')
+        response = app.make_response(process_response(content, content_type, original_url, request.host_url))
+        response.headers['Content-Type'] = content_type
+        return response
+    
+    # 上流には書き換え時に展開でき、かつブラウザが受け付ける圧縮形式だけを要求する
+    # （書き換えない本文は圧縮されたまま転送するため）
+    upstream_headers = {'Accept-Encoding': compression.upstream_accept_encoding(request.headers.get('Accept-Encoding'))}
+    
+    # Rangeリクエストは上流にそのまま転送する（キャッシュは使わない）
+    cacheable = 'Range' not in request.headers
+    if not cacheable:
+        upstream_headers['Range'] = request.headers['Range']
+    
+    # キャッシュが新鮮ならそのまま返し、古ければ条件付きリクエストで再検証する
+    entry = None
+    if cacheable:
+        with timer.stage('cache'):
+            entry, is_fresh = response_cache.lookup(original_url, request.host_url)
+        if entry is not None:
+            if is_fresh:
+                return cached_response(entry)
+            upstream_headers.update(response_cache.revalidation_headers(entry))
+    
+    # ブラウザの条件付きヘッダーは上流へ転送しない（上流の304をそのまま返すと、書き換え対象でも
+    # 上流のETagがブラウザに保存され、書き換え後のETagの世代が変わっても無効にならないため）
+    # 本文を送るかどうかは上流の200を受け取った後、送るバリデーターで判定する
+    
+    # 同じURLを同時に取得中の要求があれば、その取得と書き換えの結果を待って使う
+    # （最初の要求だけが上流に取得しに行き、結果を共有できなかった場合や待ちきれない場合は各自で取得する）
+    flight = None
+    if cacheable:
+        flight, is_leader = coalescing.flights.join((original_url, request.host_url))
+        if flight is not None and not is_leader:
+            with timer.stage('coalesce'):
+                shared = flight.wait()
+            flight = None
+            if shared is not None:
+                coalescing.record('shared')
+                return cached_response(shared)
+            coalescing.record('fallback')
+        elif flight is not None:
+            coalescing.record('leader')
+            g.flight = flight
+    
+    try:
+        # 接続から応答ヘッダー受信まで（TTFB）
+        with timer.stage('upstream'):
+            upstream = request_upstream(original_url, headers=upstream_headers, stream=True)
+    except Exception as e:
+        logger.exception("Error fetching content from %s: %s", original_url, e)
+        return error_page('コンテンツの取得に失敗しました')
+    
+    if entry is not None and upstream.status_code == 304:
+        upstream.close()
+        entry = response_cache.refresh(original_url, request.host_url, entry, upstream.headers)
+        if flight is not None:
+            flight.publish_entry(entry)
+        return cached_response(entry)
+    
+    content_type = upstream.headers.get('Content-Type', 'text/html')
+    
+    content_kind = get_content_kind(content_type)
+    
+    # 書き換えた200応答以外は共有しないため、待っている要求はすぐに解放して各自で取得させる
+    # （書き換えない本文の転送が終わるまで待たせない）
+    if flight is not None and (content_kind is None or upstream.status_code != 200):
+        flight.abandon()
+    
+    # 種類ごとの上限を超える本文は、Content-Lengthで分かる場合は受信前に断る
+    # （宣言が無い・偽りの場合は受信中に上限を超えた時点で打ち切る）
+    body_limit = get_body_limit(content_type)
+    try:
+        check_content_length(upstream.headers, body_limit, original_url)
+    except BodyTooLargeError:
+        upstream.close()
+        return error_page('コンテンツが大きすぎるため表示できません', 502)
+    
+    # 書き換え対象（HTML/CSS）以外はメモリに載せずにストリーミングで転送する
+    if content_kind is None:
+        if upstream.status_code not in (200, 206):
+            upstream.close()
+            return error_page('コンテンツの取得に失敗しました')
+        if upstream.status_code == 200:
+            response = not_modified_response(response_cache.client_validators(upstream.headers, request.host_url))
+            if response is not None:
+                upstream.close()
+                return response
+        return stream_upstream_response(upstream, original_url if cacheable else None, body_limit)
+    
+    if upstream.status_code != 200:
+        upstream.close()
+        return error_page('コンテンツの取得に失敗しました')
+    
+    # 書き換え後の内容がブラウザのキャッシュと同じなら本文を送らない
+    validators = response_cache.client_validators(upstream.headers, request.host_url, rewritten=True)
+    response = not_modified_response(validators)
+    if response is not None:
+        upstream.close()
+        return response
+    
+    # HTML/CSSを書き換えて送る（同じ内容の本文は前回の書き換え結果を再利用し、大きな本文は受信しながら書き換える）
+    # 書き換え結果は非圧縮でキャッシュし、ブラウザが受け付ける形式で圧縮して送る
+    # HTML中のサブリソース（CSS・JS・画像）は書き換え中に集め、見つかったチャンクを送る前にバックグラウンドでの取得を始める
+    base_domain = request.host_url
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    resources = prefetch.new_resource_list()
+    
+    def generate():
+        try:
+            chunks = metrics.timed_iter(upstream.iter_content(STREAM_CHUNK_SIZE), timer, 'download', direction='in')
+            chunks = iter_limited(chunks, body_limit, original_url)
+            chunks = metrics.timed_iter(
+                rewrite_cache.iter_rewrite(chunks, content_type, original_url, base_domain, resources),
+                timer, 'rewrite', exclude='download')
+            chunks = prefetch.iter_schedule(chunks, resources, base_domain)
+            chunks = response_cache.tee(chunks, original_url, base_domain, 200, upstream.headers, rewritten=True,
+                                        resources=resources)
+            if flight is not None:
+                chunks = flight.tee(chunks, upstream.headers, resources)
+            if encoding:
+                chunks = metrics.timed_iter(
+                    compression.iter_compress(chunks, encoding), timer, 'compress', exclude=('download', 'rewrite'))
+            yield from chunks
+        finally:
+            upstream.close()
     
-    response = app.make_response(processed_content)
+    response = Response(stream_with_context(generate()))
     response.headers['Content-Type'] = content_type
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers.update(validators)
     return response
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+"""
+CSSリライター（url() / @import）のベンチマーク
+
+実行方法（リポジトリのルートで）:
+    python benchmarks/bench_css_rewriter.py
+
+大きな合成スタイルシートについて、変更前の実装（正規表現のsubで参照ごとに
+get_proxy_urlを呼ぶ）と css_rewriter の一括変換・64KiBチャンクでの
+ストリーミング変換の処理速度を比較する。サイズを変えて計測し、処理時間が
+入力サイズに対して線形であることも確認する。
+"""
+
+import logging
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.mais.css_rewriter import IncrementalCSSRewriter, rewrite_css
+from src.mais.proxy_utils import get_proxy_url
+
+ORIGINAL_URL = "https://www.example.co.jp/assets/css/site.css"
+BASE_DOMAIN = "http://localhost:5000/"
+CHUNK_SIZE = 64 * 1024
+
+LEGACY_CSS_URL_PATTERN = re.compile(rb'''url\(\s*(['"]?)([^'")]+)\1\s*\)''', re.IGNORECASE)
+
+def build_stylesheet(rules):
+    # フレームワーク風のルール群（参照なしのルールが大半、一部に画像・フォント・@import）
+    parts = [b'@import "reset.css";\n@import url("https://fonts.example.com/css?family=Noto+Sans+JP");\n']
+    for i in range(rules):
+        parts.append(b'.c%d{margin:0 %dpx;padding:4px;color:#%06x;display:flex}\n' % (i, i % 16, i * 2654435761 % 0xFFFFFF))
+        if i % 10 == 0:
+            parts.append(b'.bg%d{background:url("../img/bg-%d.png") no-repeat}\n' % (i, i % 300))
+        if i % 50 == 0:
+            parts.append(b"@font-face{font-family:f%d;src:url('../fonts/f%d.woff2') format('woff2')}\n" % (i, i % 40))
+    return b''.join(parts)
+
+def legacy_process_css(content):
+    # 変更前の実装
+    def replace(match):
+        quote, target = match.group(1), match.group(2).strip()
+        if target.startswith(b'#'):
+            return match.group(0)
+        proxied = get_proxy_url(ORIGINAL_URL, BASE_DOMAIN, target.decode('utf-8'))
+        return b'url(' + quote + proxied.encode('utf-8') + quote + b')'
+    return LEGACY_CSS_URL_PATTERN.sub(replace, content)
+
+def streaming_process_css(content):
+    rewriter = IncrementalCSSRewriter(ORIGINAL_URL, BASE_DOMAIN)
+    out = [rewriter.feed(content[i:i + CHUNK_SIZE]) for i in range(0, len(content), CHUNK_SIZE)]
+    out.append(rewriter.close())
+    return b''.join(out)
+
+def megabytes_per_second(func, content, repeat=5):
+    best = min(timeit.repeat(lambda: func(content), number=1, repeat=repeat))
+    return len(content) / best / 1e6
+
+def run(sizes=(5000, 20000, 80000)):
+    # ログ整形のコストを除外する
+    logging.disable(logging.CRITICAL)
+
+    results = {}
+    for rules in sizes:
+        content = build_stylesheet(rules)
+        # URLのメモ化を温めた状態で書き換えそのものの速度を比べる
+        legacy_process_css(content)
+        assert rewrite_css(content, ORIGINAL_URL, BASE_DOMAIN) == streaming_process_css(content)
+        results[len(content)] = {
+            'legacy': megabytes_per_second(legacy_process_css, content),
+            'rewrite_css': megabytes_per_second(lambda c: rewrite_css(c, ORIGINAL_URL, BASE_DOMAIN), content),
+            'streaming': megabytes_per_second(streaming_process_css, content),
+        }
+
+    logging.disable(logging.NOTSET)
+    return results
+
+if __name__ == "__main__":
+    for size, row in run().items():
+        print(f"{size / 1e6:6.2f} MB  " + "  ".join(f"{name} {value:7.1f} MB/s" for name, value in row.items()))
@@ -0,0 +1,187 @@
+"""
+/<encoded_id> のエンドツーエンド負荷試験
+
+実行方法（リポジトリのルートで）:
+    python benchmarks/bench_e2e.py                  # gunicorn（既定）
+    python benchmarks/bench_e2e.py --server flask   # gunicornが無い環境向け（werkzeugのスレッドサーバー）
+
+スタブオリジン（stub_origin.StubOrigin）とアプリのサーバーをローカルで起動し、
+複数スレッドから一定時間リクエストを送り続けて、リクエスト数/秒と
+レイテンシ（p50 / p90 / p99）を計測する。キャッシュは既定で無効にし、
+毎回上流から取得して書き換える経路を測る（--cache on で有効）。
+負荷をかける側もPythonのため、CPUが少ない環境ではクライアント側が
+先に頭打ちになることに注意。
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.mais.url_crypto import encode_url
+from stub_origin import BLOB_NAME, StubOrigin, free_port
+
+# 負荷をかけるパス（HTMLの書き換え経路と、バイナリのストリーミング転送経路）
+PATHS = ('blog.html', 'news.html', 'docs.html', 'page-100k.html', BLOB_NAME)
+
+STARTUP_TIMEOUT = 30
+
+def server_command(server, port, workers, threads):
+    if server == 'gunicorn':
+        return [
+            sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+            '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'main:app',
+        ]
+    if server == 'flask':
+        return [sys.executable, '-c', f"from main import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    raise ValueError(f"unknown server: {server}")
+
+def server_env(work_dir, cache):
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': 'sqlite:///' + os.path.join(work_dir, 'bench.db'),
+        'METRICS_DIR': os.path.join(work_dir, 'metrics'),
+        'LOG_LEVEL': 'WARNING',
+        'ACCESS_LOG_SAMPLE_RATE': '0',
+        'RESPONSE_CACHE_BACKEND': 'memory' if cache == 'on' else 'none',
+        'REWRITE_CACHE_BACKEND': 'memory' if cache == 'on' else 'none',
+    })
+    return env
+
+def wait_ready(base_url, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        try:
+            requests.get(base_url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start in time")
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def load(urls, concurrency, duration):
+    """
+    Sends requests from concurrency threads for duration seconds.
+
+    Returns:
+        tuple: (list of (url, latency seconds), error count, elapsed seconds)
+    """
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset):
+        session = requests.Session()
+        local_samples = []
+        local_errors = 0
+        i = offset
+        while time.monotonic() < deadline:
+            url = urls[i % len(urls)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                response = session.get(url, timeout=30)
+                response.content
+                if response.status_code != 200:
+                    local_errors += 1
+                    continue
+            except requests.RequestException:
+                local_errors += 1
+                continue
+            local_samples.append((url, time.perf_counter() - start))
+        with lock:
+            samples.extend(local_samples)
+            errors[0] += local_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, errors[0], time.perf_counter() - started
+
+def run(server='gunicorn', workers=2, threads=4, concurrency=8, duration=10.0, warmup=2.0, cache='off'):
+    logging.disable(logging.CRITICAL)
+    work_dir = tempfile.mkdtemp(prefix='mais-bench-e2e-')
+    process = None
+    try:
+        with StubOrigin() as origin:
+            port = free_port()
+            base_url = f'http://127.0.0.1:{port}/'
+            process = subprocess.Popen(
+                server_command(server, port, workers, threads), cwd=ROOT_DIR, env=server_env(work_dir, cache),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_ready(base_url, process)
+
+            urls = [base_url + encode_url(origin.base_url + path) for path in PATHS]
+            paths = dict(zip(urls, PATHS))
+            if warmup:
+                load(urls, concurrency, warmup)
+            samples, errors, elapsed = load(urls, concurrency, duration)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        logging.disable(logging.NOTSET)
+
+    latencies = [latency for _, latency in samples]
+    if not latencies:
+        raise RuntimeError(f"no successful requests ({errors} errors)")
+    per_path = {}
+    for url, latency in samples:
+        per_path.setdefault(paths[url], []).append(latency)
+    return {
+        'server': server,
+        'workers': workers,
+        'concurrency': concurrency,
+        'cache': cache,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'paths': {path: {'p50_ms': percentile(values, 0.50) * 1000, 'p99_ms': percentile(values, 0.99) * 1000}
+                  for path, values in per_path.items()},
+    }
+
+def add_arguments(parser):
+    parser.add_argument('--server', choices=('gunicorn', 'flask'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--cache', choices=('off', 'on'), default='off')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    args = parser.parse_args()
+    result = run(args.server, args.workers, args.threads, args.concurrency, args.duration, cache=args.cache)
+    print(f"{result['requests']} requests, {result['errors']} errors, {result['rps']:.1f} req/s  "
+          f"p50 {result['p50_ms']:.1f} ms  p90 {result['p90_ms']:.1f} ms  p99 {result['p99_ms']:.1f} ms")
+    for path, row in result['paths'].items():
+        print(f"  {path:16s} p50 {row['p50_ms']:8.1f} ms  p99 {row['p99_ms']:8.1f} ms")
@@ -0,0 +1,65 @@
+"""
+fetch_content のベンチマーク（ローカルのスタブオリジンに対して）
+
+実行方法（リポジトリのルートで）:
+    python benchmarks/bench_fetch.py
+
+stub_origin.StubOrigin が 127.0.0.1 で配信する小さいページ・1MBのページ・
+1MBのバイナリを fetch_content で順に取得し、1回あたりのレイテンシ
+（p50 / p99）とスループットを計測する。接続はプールされたセッションで
+再利用される。最初の1回でHTTPSへの昇格失敗がキャッシュされるため、
+計測前に1回ずつ取得しておく。
+"""
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.mais.proxy_utils import fetch_content
+from stub_origin import BLOB_NAME, StubOrigin
+
+TARGETS = ('blog.html', 'page-1m.html', BLOB_NAME)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def run(requests_per_target=200):
+    # ログ整形のコストを除外する
+    logging.disable(logging.CRITICAL)
+
+    results = {}
+    try:
+        with StubOrigin() as origin:
+            for name in TARGETS:
+                url = origin.base_url + name
+                content, status_code, _ = fetch_content(url)
+                assert status_code == 200, (url, status_code)
+
+                latencies = []
+                started = time.perf_counter()
+                for _ in range(requests_per_target):
+                    start = time.perf_counter()
+                    content, status_code, _ = fetch_content(url)
+                    latencies.append(time.perf_counter() - start)
+                elapsed = time.perf_counter() - started
+
+                results[name] = {
+                    'bytes': len(content),
+                    'p50_ms': percentile(latencies, 0.50) * 1000,
+                    'p99_ms': percentile(latencies, 0.99) * 1000,
+                    'rps': requests_per_target / elapsed,
+                    'mb_per_s': len(content) * requests_per_target / elapsed / 1e6,
+                }
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+if __name__ == "__main__":
+    for name, row in run().items():
+        print(f"{name:14s} {row['bytes'] / 1024:8.1f} KB  p50 {row['p50_ms']:7.2f} ms  p99 {row['p99_ms']:7.2f} ms  "
+              f"{row['rps']:8.1f} req/s  {row['mb_per_s']:7.1f} MB/s")
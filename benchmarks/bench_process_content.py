@@ -0,0 +1,56 @@
+"""
+process_content のコーパスベンチマーク
+
+実行方法（リポジトリのルートで）:
+    python benchmarks/bench_process_content.py
+
+benchmarks/fixtures/pages の保存済みページ（約6KB〜64KB）と、それを拡大した
+100KB・1MBのページについて、ストリーミング（既定）とsoupの両バックエンドの
+1ページあたりの処理時間とスループットを計測する。URLのメモ化が温まった
+状態（同じページを繰り返し処理した場合）の最良値を記録する。
+"""
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.mais import content_processor
+from stub_origin import build_corpus
+
+BASE_DOMAIN = "http://localhost:5000/"
+
+BACKENDS = ('stream', 'soup')
+
+def run(repeat=3, include_large=True):
+    # ログ整形のコストを除外する
+    logging.disable(logging.CRITICAL)
+    original_backend = content_processor.HTML_REWRITER_BACKEND
+
+    results = {}
+    try:
+        for name, content in build_corpus().items():
+            if not include_large and len(content) > 512 * 1024:
+                continue
+            original_url = f"https://www.example.com/{name}"
+            row = {'bytes': len(content)}
+            for backend in BACKENDS:
+                content_processor.HTML_REWRITER_BACKEND = backend
+                process = lambda: content_processor.process_content(content, original_url, BASE_DOMAIN, 'text/html; charset=utf-8')
+                process()
+                best = min(timeit.repeat(process, number=1, repeat=repeat))
+                row[f'{backend}_ms'] = best * 1000
+                row[f'{backend}_mb_per_s'] = len(content) / best / 1e6
+            results[name] = row
+    finally:
+        content_processor.HTML_REWRITER_BACKEND = original_backend
+        logging.disable(logging.NOTSET)
+    return results
+
+if __name__ == "__main__":
+    for name, row in run().items():
+        print(f"{name:16s} {row['bytes'] / 1024:8.1f} KB  "
+              + "  ".join(f"{b} {row[b + '_ms']:8.2f} ms ({row[b + '_mb_per_s']:5.1f} MB/s)" for b in BACKENDS))
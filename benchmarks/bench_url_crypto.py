@@ -0,0 +1,76 @@
+"""
+encode_url / decode_url のマイクロベンチマーク
+
+実行方法（リポジトリのルートで）:
+    python benchmarks/bench_url_crypto.py
+
+旧実装（quote + base64 + SHA-256(エンコード部分 + 鍵)）と現在の実装について、
+1URLあたりの処理時間と平均トークン長を比較する。現在の実装はメモ化が効くため、
+初回（キャッシュなし）と2回目以降（キャッシュあり）を分けて計測する。
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import sys
+import timeit
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.mais import url_crypto
+
+# ページ内のリンクを模したURL群
+URLS = [f"https://www.example.co.jp/category/{i % 50}/item/{i}?ref=top&page={i % 7}" for i in range(2000)]
+URLS += [f"https://日本語.example.com/検索/{i}?q=テスト" for i in range(500)]
+
+def legacy_encode_url(original_url):
+    # 変更前の実装（ログ出力を除く）
+    safe_url = quote(original_url)
+    encoded = base64.urlsafe_b64encode(safe_url.encode()).decode().rstrip("=")
+    hash_signature = hashlib.sha256((encoded + url_crypto.URL_ENCODING_KEY).encode()).hexdigest()[:8]
+    return f"{hash_signature}{encoded}"
+
+def per_url_microseconds(func, repeat=5):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    return best / len(URLS) * 1e6
+
+def run():
+    # DEBUGログの整形コストを除外して純粋な処理時間を比較する
+    logging.disable(logging.CRITICAL)
+
+    results = {}
+    results['legacy encode'] = per_url_microseconds(lambda: [legacy_encode_url(u) for u in URLS])
+
+    def cold_encode():
+        url_crypto._encode_url_cached.cache_clear()
+        url_crypto.encode_urls(URLS)
+    results['encode (cold)'] = per_url_microseconds(cold_encode)
+
+    url_crypto.encode_urls(URLS)
+    results['encode (warm)'] = per_url_microseconds(lambda: url_crypto.encode_urls(URLS))
+
+    encoded = url_crypto.encode_urls(URLS)
+    def cold_decode():
+        url_crypto._decode_url_cached.cache_clear()
+        for encoded_id in encoded:
+            url_crypto.decode_url(encoded_id)
+    results['decode (cold)'] = per_url_microseconds(cold_decode)
+    results['decode (warm)'] = per_url_microseconds(lambda: [url_crypto.decode_url(e) for e in encoded])
+
+    logging.disable(logging.NOTSET)
+    return results
+
+def token_sizes():
+    # 1URLあたりの平均トークン長（文字数）
+    return {
+        'legacy': sum(len(legacy_encode_url(u)) for u in URLS) / len(URLS),
+        'current': sum(len(e) for e in url_crypto.encode_urls(URLS)) / len(URLS),
+    }
+
+if __name__ == "__main__":
+    for name, value in run().items():
+        print(f"{name:16s} {value:8.2f} us/url")
+    for name, value in token_sizes().items():
+        print(f"token ({name}){'':{8 - len(name)}s} {value:8.1f} chars")
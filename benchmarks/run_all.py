@@ -0,0 +1,155 @@
+"""
+ベンチマークスイートの一括実行と回帰比較
+
+実行方法（リポジトリのルートで）:
+    python benchmarks/run_all.py                          # 全スイートを実行して結果をJSONに保存
+    python benchmarks/run_all.py --quick --server flask   # 短時間版（gunicornが無い環境）
+    python benchmarks/run_all.py --only url_crypto,fetch
+    python benchmarks/run_all.py --compare benchmarks/results/baseline.json
+
+結果は benchmarks/results/<日時>-<コミット>.json に保存する（--output で変更可）。
+--compare を指定すると、数値ごとに基準との差を表示し、--threshold（%）を
+超えて悪化した項目があれば終了コード1で終わる。すべてローカルの
+フィクスチャとスタブオリジンに対して実行し、ネットワークには出ない。
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import bench_css_rewriter
+import bench_e2e
+import bench_fetch
+import bench_html_rewriter
+import bench_process_content
+import bench_url_crypto
+
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# スイート名 -> (実行関数, 値の向き: 'lower' = 小さいほど良い / 'higher' = 大きいほど良い)
+SUITES = {
+    'url_crypto': (lambda args: bench_url_crypto.run(), 'lower'),
+    'css_rewriter': (lambda args: bench_css_rewriter.run(sizes=(5000,) if args.quick else (5000, 20000, 80000)), 'higher'),
+    'html_rewriter': (lambda args: bench_html_rewriter.run(repeat=1 if args.quick else 3), 'lower'),
+    'process_content': (lambda args: bench_process_content.run(repeat=1 if args.quick else 3, include_large=not args.quick), 'lower'),
+    'fetch': (lambda args: bench_fetch.run(requests_per_target=20 if args.quick else 200), 'lower'),
+    'e2e': (lambda args: bench_e2e.run(
+        args.server, args.workers, args.threads, args.concurrency, 3.0 if args.quick else args.duration,
+        warmup=1.0 if args.quick else 2.0, cache=args.cache), 'lower'),
+}
+
+# 向きをキー名から判断する値と、比較しない値（件数や設定）
+HIGHER_IS_BETTER_SUFFIXES = ('mb_per_s', 'rps')
+LOWER_IS_BETTER_SUFFIXES = ('_ms', 'ms/page')
+INFORMATIONAL_KEYS = ('bytes', 'passes', 'urls', 'requests', 'errors', 'workers', 'concurrency')
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(value, prefix=''):
+    """
+    Yields (path, number) for every numeric leaf of a nested result dict.
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f'{prefix}/{key}' if prefix else str(key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+def direction(path):
+    suite, _, rest = path.partition('/')
+    key = rest.rsplit('/', 1)[-1]
+    if key in INFORMATIONAL_KEYS:
+        return None
+    if key.endswith(HIGHER_IS_BETTER_SUFFIXES):
+        return 'higher'
+    if key.endswith(LOWER_IS_BETTER_SUFFIXES):
+        return 'lower'
+    return SUITES[suite][1] if suite in SUITES else None
+
+def compare(baseline, current, threshold):
+    """
+    Prints the change of every comparable value and returns the regressions.
+    """
+    base_values = dict(flatten(baseline['results']))
+    regressions = []
+    for path, value in flatten(current['results']):
+        better = direction(path)
+        base = base_values.get(path)
+        if better is None or not base:
+            continue
+        change = (value - base) / base * 100
+        worse = change > threshold if better == 'lower' else change < -threshold
+        if worse:
+            regressions.append(path)
+        print(f"{'!' if worse else ' '} {path:60s} {base:12.3f} -> {value:12.3f}  {change:+7.1f}%")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', help='comma separated suite names (%s)' % ', '.join(SUITES))
+    parser.add_argument('--skip', help='comma separated suite names to skip')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs and shorter load test')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<time>-<commit>.json)')
+    parser.add_argument('--compare', help='baseline result file to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='regression threshold in percent')
+    bench_e2e.add_arguments(parser)
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(SUITES)
+    skipped = set(args.skip.split(',')) if args.skip else set()
+    unknown = [name for name in names + list(skipped) if name not in SUITES]
+    if unknown:
+        parser.error(f"unknown suite: {', '.join(unknown)}")
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'quick': args.quick,
+        },
+        'results': {},
+    }
+    for name in names:
+        if name in skipped:
+            continue
+        print(f"running {name} ...", flush=True)
+        started = time.perf_counter()
+        report['results'][name] = SUITES[name][0](args)
+        print(f"  done in {time.perf_counter() - started:.1f}s", flush=True)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{report['meta']['commit'] or 'unknown'}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} value(s) regressed by more than {args.threshold}%")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+ベンチマーク用のローカル上流サーバー（スタブオリジン）
+
+benchmarks/fixtures/pages のページに加えて、サイズ違いのページ
+（page-100k.html / page-1m.html）と画像相当のバイナリ（blob-1m.bin）を
+一時ディレクトリに用意し、127.0.0.1 の空きポートで配信する。
+ネットワークには一切アクセスしない。
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pages')
+
+# 生成する大きいページ（ファイル名 -> おおよそのバイト数）
+SCALED_PAGES = {'page-100k.html': 100 * 1024, 'page-1m.html': 1024 * 1024}
+
+BLOB_NAME = 'blob-1m.bin'
+
+def load_pages():
+    """
+    Returns the fixture pages as {file name: bytes}, in name order.
+    """
+    pages = {}
+    for name in sorted(os.listdir(FIXTURE_DIR)):
+        if name.endswith('.html'):
+            with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+                pages[name] = f.read()
+    return pages
+
+def scale_page(content, size):
+    """
+    Repeats the <body> of a page until the document is about size bytes.
+    """
+    start = content.index(b'<body>') + len(b'<body>')
+    end = content.rindex(b'</body>')
+    body = content[start:end]
+    repeat = max(1, round((size - len(content) + len(body)) / len(body)))
+    return content[:start] + body * repeat + content[end:]
+
+def build_corpus():
+    """
+    Returns the fixture pages plus the scaled pages as {file name: bytes}.
+    """
+    pages = load_pages()
+    source = pages['news.html']
+    for name, size in SCALED_PAGES.items():
+        pages[name] = scale_page(source, size)
+    return pages
+
+def prepare_fixture_dir():
+    """
+    Writes the corpus and the binary blob to a new temporary directory.
+
+    Returns:
+        str: The directory (remove it with shutil.rmtree when done)
+    """
+    directory = tempfile.mkdtemp(prefix='mais-bench-origin-')
+    for name, content in build_corpus().items():
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(content)
+    with open(os.path.join(directory, BLOB_NAME), 'wb') as f:
+        # 圧縮の効かないバイト列（画像・動画の代わり）
+        f.write(os.urandom(1024 * 1024))
+    return directory
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーと本文が別々に送られるため、Nagleと遅延ACKで小さい応答が約40ms待たされるのを防ぐ
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class StubOrigin:
+    """
+    Serves a fixture directory over HTTP on 127.0.0.1 in a background thread.
+
+    Usable as a context manager; base_url is e.g. 'http://127.0.0.1:54321/'.
+    """
+
+    def __init__(self, directory=None):
+        self._owns_directory = directory is None
+        self.directory = directory or prepare_fixture_dir()
+        self.server = ThreadingHTTPServer(('127.0.0.1', free_port()), partial(QuietHandler, directory=self.directory))
+        self.server.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
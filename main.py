@@ -1,5 +1,19 @@
+import os
 
-from app import app
+# 起動モード: 'flask'（既定、WSGI）または 'asgi'（asyncioベースのプロキシエンジン）
+#   gunicorn --worker-class gthread --threads 8 main:app
+#   （同じURLへの同時リクエストの取得の共有はワーカー内でのみ行われるため、スレッドワーカーで起動する）
+#   MAIS_SERVER_MODE=asgi gunicorn -k uvicorn.workers.UvicornWorker main:app
+SERVER_MODE = os.environ.get("MAIS_SERVER_MODE", "flask")
+
+if SERVER_MODE == "asgi":
+    from src.mais.asgi import app
+else:
+    from app import app
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    if SERVER_MODE == "asgi":
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=5000)
+    else:
+        app.run(host="0.0.0.0", port=5000, debug=True)
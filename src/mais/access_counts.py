@@ -0,0 +1,158 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# /<encoded_id> へのアクセス数をURLMapping.access_countに記録する（'0'で無効）
+ACCESS_COUNT_ENABLED = os.environ.get("ACCESS_COUNT_ENABLED", "1") != "0"
+
+# 未反映のアクセス数をまとめてDBに書き込む間隔（秒）
+ACCESS_COUNT_FLUSH_INTERVAL = float(os.environ.get("ACCESS_COUNT_FLUSH_INTERVAL", "10"))
+
+# 未反映のIDがこの件数に達したら間隔を待たずに書き込む
+ACCESS_COUNT_FLUSH_THRESHOLD = int(os.environ.get("ACCESS_COUNT_FLUSH_THRESHOLD", "1000"))
+
+# 未反映として保持するIDの上限（DBに書き込めない間にメモリを使い続けないように、超えた分の新しいIDは数えない）
+ACCESS_COUNT_MAX_PENDING = int(os.environ.get("ACCESS_COUNT_MAX_PENDING", "100000"))
+
+# 対応表に行があるかを確認済みのIDとして覚えておく件数（古いものから忘れる）
+ACCESS_COUNT_KNOWN_IDS = int(os.environ.get("ACCESS_COUNT_KNOWN_IDS", "100000"))
+
+# 対応表に行があるかを1回のSELECTで確認するIDの件数（IN句の上限に収めるため）
+ACCESS_COUNT_LOOKUP_BATCH = 500
+
+# エンコードID -> 未反映のアクセス数
+_pending = Counter()
+
+# エンコードID -> 対応表に行があるか
+# 行が無いID（短縮URLを発行していないページのサブリソースなど）は数えず、UPDATEも発行しない
+_known = OrderedDict()
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_flushing = False
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def record(encoded_id):
+    """
+    アクセスを1件記録する関数（メモリ上で数えるだけで、DBには触れない）
+
+    書き込みが必要になった場合はバックグラウンドのスレッドに任せるため、
+    リクエストを処理するスレッドやイベントループを待たせない。
+    オリジン相対の参照（'/'を含むID）と、書き込み時に対応表に無いと
+    確認済みのIDは数えない。
+
+    Args:
+        encoded_id (str): エンコードID
+    """
+    global _flushing
+    if not ACCESS_COUNT_ENABLED or '/' in encoded_id:
+        return
+    with _lock:
+        if _known.get(encoded_id) is False:
+            _known.move_to_end(encoded_id)
+            return
+        if encoded_id in _pending or len(_pending) < ACCESS_COUNT_MAX_PENDING:
+            _pending[encoded_id] += 1
+        due = not _flushing and (
+            len(_pending) >= ACCESS_COUNT_FLUSH_THRESHOLD or time.monotonic() - _last_flush >= ACCESS_COUNT_FLUSH_INTERVAL)
+        if due:
+            _flushing = True
+    if due:
+        _get_executor().submit(flush)
+
+def _remember(encoded_id, mapped):
+    # _lock を取得した状態で呼ぶ
+    _known[encoded_id] = mapped
+    _known.move_to_end(encoded_id)
+    if len(_known) > ACCESS_COUNT_KNOWN_IDS:
+        _known.popitem(last=False)
+
+def mark_mapped(encoded_id):
+    """
+    エンコードIDが対応表に載っていることを記録する関数
+
+    短縮URLの発行・解決時に呼び、書き込み時の確認を省く（対応表に無いと
+    確認済みのIDが後から発行された場合も、ここで数え始める）。
+
+    Args:
+        encoded_id (str): エンコードID
+    """
+    if not ACCESS_COUNT_ENABLED:
+        return
+    with _lock:
+        _remember(encoded_id, True)
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='access-counts')
+        return _executor
+
+def _write(batch):
+    from sqlalchemy import bindparam, func, select, update
+    from app import app, db
+    from src.mais.models import URLMapping
+
+    table = URLMapping.__table__
+    with _lock:
+        mapped = {key for key in batch if _known.get(key)}
+        unknown = [key for key in batch if key not in _known]
+    with app.app_context():
+        with db.engine.begin() as connection:
+            # 初めて見るIDは対応表に行があるかをまとめて確認し、結果を覚えておく
+            if unknown:
+                found = set()
+                for start in range(0, len(unknown), ACCESS_COUNT_LOOKUP_BATCH):
+                    keys = unknown[start:start + ACCESS_COUNT_LOOKUP_BATCH]
+                    found.update(connection.scalars(select(table.c.encoded_id).where(table.c.encoded_id.in_(keys))))
+                with _lock:
+                    for key in unknown:
+                        _remember(key, key in found)
+                mapped |= found
+            if not mapped:
+                return 0
+
+            # 1回のexecutemanyでまとめて加算する（encoded_idのユニークインデックスで行を引く）
+            statement = (
+                update(table)
+                .where(table.c.encoded_id == bindparam('key'))
+                .values(access_count=func.coalesce(table.c.access_count, 0) + bindparam('hits'))
+            )
+            connection.execute(statement, [{'key': key, 'hits': batch[key]} for key in mapped])
+    return len(mapped)
+
+def flush():
+    """
+    未反映のアクセス数をまとめてDBに書き込む関数
+
+    対応表に無いID（短縮URLを発行していないURL）の分はUPDATEせずに捨て、
+    以後は数えない。書き込みに失敗した場合は次回の書き込みに持ち越す。
+    """
+    global _pending, _last_flush, _flushing
+    with _lock:
+        batch, _pending = _pending, Counter()
+        _last_flush = time.monotonic()
+    try:
+        if batch:
+            written = _write(batch)
+            logger.debug("Flushed access counts for %d of %d ids", written, len(batch))
+    except Exception as e:
+        logger.warning("Could not write access counts (%d mappings): %s", len(batch), e)
+        with _lock:
+            for key, hits in batch.items():
+                if key in _pending or len(_pending) < ACCESS_COUNT_MAX_PENDING:
+                    _pending[key] += hits
+    finally:
+        with _lock:
+            _flushing = False
+
+# 終了時に残りを書き込む
+atexit.register(flush)
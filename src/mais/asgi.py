@@ -0,0 +1,633 @@
+"""
+asyncioベースのプロキシエンジン（ASGIアプリケーション）
+
+Flask版（app.py）と同じ '/', '/create_short_url', '/<encoded_id>' を非同期で提供する。
+上流への取得はhttpx.AsyncClientで行うため、1ワーカーで多数の上流リクエストを
+同時に待つことができる。
+
+起動例:
+    MAIS_SERVER_MODE=asgi gunicorn -k uvicorn.workers.UvicornWorker main:app
+    uvicorn src.mais.asgi:app --port 5000
+"""
+
+import asyncio
+import logging
+import mimetypes
+import os
+import time
+from urllib.parse import parse_qs, urlparse
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from werkzeug.http import is_resource_modified
+
+from src.mais import access_counts, coalescing, compression, metrics, prefetch, response_cache, rewrite_cache
+from src.mais.content_processor import get_content_kind, process_response
+from src.mais.logging_config import configure_logging, log_access_sampled
+from src.mais.proxy_utils import (
+    DEFAULT_HEADERS, POOL_CONNECTIONS, POOL_IDLE_TIMEOUT, POOL_MAXSIZE, REQUEST_TIMEOUT,
+    BodyTooLargeError, check_body_size, check_content_length, fetch_content, get_body_limit, get_https_support,
+    record_upstream_response, set_https_support,
+)
+from src.mais.url_crypto import decode_url, encode_url
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - optional dependency
+    httpx = None
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TEMPLATE_DIR = os.path.join(ROOT_DIR, 'templates')
+STATIC_DIR = os.path.join(ROOT_DIR, 'static')
+
+# 検索エンジンにはトップページ以外（プロキシしたページ）を収集させない
+ROBOTS_TXT = "User-agent: *\nAllow: /$\nDisallow: /\n"
+
+# よく要求されるパスは、トークンとして扱わずに専用の応答を返す
+WELL_KNOWN_CACHE_CONTROL = 'public, max-age=86400'
+
+# 上流から透過的に転送するレスポンスヘッダー
+PASSTHROUGH_HEADERS = ('content-type', 'content-length', 'content-range', 'accept-ranges', 'content-encoding')
+
+# ブラウザからの条件付きリクエストヘッダー
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since')
+
+# 上流からの読み込みチャンクサイズ
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# これより大きいチャンク・本文の書き換えはワーカースレッドで行う（イベントループを止めないため）
+REWRITE_OFFLOAD_BYTES = int(os.environ.get("REWRITE_OFFLOAD_BYTES", str(16 * 1024)))
+
+def _url_for(endpoint, **values):
+    # テンプレート内のurl_for()をFlaskなしで解決する
+    if endpoint == 'static':
+        return '/static/' + values['filename']
+    if endpoint == 'index':
+        return '/'
+    return '/' + endpoint
+
+templates = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(['html']))
+templates.globals['url_for'] = _url_for
+
+def render_template(name, **context):
+    return templates.get_template(name).render(**context).encode('utf-8')
+
+_client = None
+
+def get_client():
+    """
+    Returns the shared httpx.AsyncClient, creating it on first use.
+    """
+    global _client
+    if httpx is None:
+        raise RuntimeError("ASGIモードにはhttpxが必要です: pip install httpx")
+    if _client is None:
+        limits = httpx.Limits(
+            max_connections=POOL_CONNECTIONS * POOL_MAXSIZE,
+            max_keepalive_connections=POOL_CONNECTIONS * POOL_MAXSIZE,
+            keepalive_expiry=POOL_IDLE_TIMEOUT,
+        )
+        _client = httpx.AsyncClient(headers=DEFAULT_HEADERS, limits=limits, timeout=REQUEST_TIMEOUT, follow_redirects=True)
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def request_upstream(url, headers=None):
+    """
+    Sends a streaming GET request to the origin, upgrading http: URLs to HTTPS when possible.
+
+    Uses the same per-host upgrade cache as proxy_utils.request_upstream.
+
+    Args:
+        url (str): The http(s) URL to fetch
+        headers (dict): Extra request headers
+
+    Returns:
+        httpx.Response: The upstream response; the caller must aclose() it
+    """
+    try:
+        response = await _request_upstream(url, headers)
+    except Exception:
+        record_upstream_response(url, 'error')
+        raise
+    record_upstream_response(url, response.status_code)
+    return response
+
+async def _request_upstream(url, headers):
+    client = get_client()
+
+    if url.startswith('http:'):
+        host = urlparse(url).netloc
+        supports_https = get_https_support(host)
+
+        if supports_https is not False:
+            https_url = url.replace('http:', 'https:', 1)
+            try:
+                response = await client.send(client.build_request('GET', https_url, headers=headers), stream=True)
+                if supports_https is None:
+                    set_https_support(host, True)
+                return response
+            except httpx.HTTPError:
+                logger.debug("HTTPS upgrade failed, falling back to original URL: %s", url)
+                set_https_support(host, False)
+
+    return await client.send(client.build_request('GET', url, headers=headers), stream=True)
+
+class Request:
+    """
+    Minimal view of an ASGI HTTP request.
+    """
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.timer = metrics.RequestTimer()
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        scheme = scope.get('scheme', 'http')
+        host = self.headers.get('host') or '%s:%d' % scope['server']
+        self.host_url = f"{scheme}://{host}/"
+
+    async def body(self):
+        chunks = []
+        while True:
+            message = await self.receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def form(self):
+        fields = parse_qs((await self.body()).decode('utf-8', 'replace'))
+        return {name: values[0] for name, values in fields.items()}
+
+async def send_response(send, status, headers, body=b''):
+    raw_headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()]
+    if status != 304 and 'content-length' not in headers and 'Content-Length' not in headers:
+        raw_headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_stream(send, status, headers, chunks):
+    raw_headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    async for chunk in chunks:
+        if chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def send_html(send, body, status=200):
+    await send_response(send, status, {'Content-Type': 'text/html; charset=utf-8'}, body)
+
+# エラーページはメッセージごとに一度だけ描画して使い回す
+_error_pages = {}
+
+async def send_error(send, message, status=200):
+    body = _error_pages.get(message)
+    if body is None:
+        body = _error_pages[message] = render_template('error.html', message=message)
+    await send_html(send, body, status)
+
+async def aiter_limited(chunks, limit, url):
+    """
+    Async counterpart of proxy_utils.iter_limited (limit 0 = unlimited).
+    """
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        check_body_size(size, limit, url)
+        yield chunk
+
+async def run_blocking(offload, func, *args):
+    """
+    Calls func(*args), in a worker thread if offload is true.
+
+    Used for disk cache I/O and for rewriting large chunks, which would
+    otherwise stall every connection handled by the event loop.
+    """
+    if offload:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+def is_not_modified(request, validators):
+    """
+    Returns True if the browser's cached copy matches the given validators.
+    """
+    if not any(header in request.headers for header in CONDITIONAL_HEADERS):
+        return False
+    environ = {
+        'HTTP_IF_NONE_MATCH': request.headers.get('if-none-match'),
+        'HTTP_IF_MODIFIED_SINCE': request.headers.get('if-modified-since'),
+    }
+    return not is_resource_modified(environ, etag=validators.get('ETag'), last_modified=validators.get('Last-Modified'))
+
+async def send_cached(send, request, entry):
+    validators = response_cache.client_validators(entry['headers'], request.host_url, entry.get('rewritten', False))
+    if is_not_modified(request, validators):
+        await send_response(send, 304, validators)
+        return 304
+    body, content_encoding = compression.encode_cached_body(entry, request.headers.get('accept-encoding'))
+    headers = {name: entry['headers'][name] for name in ('Content-Type',) if name in entry['headers']}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    links = prefetch.preload_links(entry.get('resources'), request.host_url)
+    if links:
+        headers['Link'] = links
+    headers['Vary'] = 'Accept-Encoding'
+    headers.update(validators)
+    await send_response(send, entry['status'], headers, body)
+    return entry['status']
+
+async def index(request, send):
+    await send_html(send, render_template('index.html'))
+    return 200
+
+async def create_short_url(request, send):
+    url = (await request.form()).get('url')
+    if not url:
+        await send_error(send, 'URLを入力してください')
+        return 200
+
+    # URLにスキームがない場合は追加
+    if not url.startswith(('http://', 'https://')):
+        url = 'https://' + url
+
+    encoded_id = encode_url(url)
+    if not encoded_id:
+        await send_error(send, 'URLの暗号化に失敗しました')
+        return 200
+
+    from app import app as flask_app
+    from src.mais.short_codes import create_short_code, schedule_external_shortening
+
+    # ローカルの短縮コードを発行（DBアクセスはスレッドで実行する）
+    def create():
+        with flask_app.app_context():
+            return create_short_code(url, encoded_id)
+
+    short_code = await asyncio.to_thread(create)
+    schedule_external_shortening(flask_app, url, request.host_url + encoded_id)
+
+    await send_html(send, render_template('result.html', tiny_url=request.host_url + 's/' + short_code, original_url=url))
+    return 200
+
+async def resolve_short_url(request, send, code):
+    from app import app as flask_app
+    from src.mais.short_codes import resolve_short_code
+
+    def resolve():
+        with flask_app.app_context():
+            return resolve_short_code(code)
+
+    encoded_id = await asyncio.to_thread(resolve)
+    if not encoded_id:
+        await send_response(send, 404, {'Content-Type': 'text/plain'}, b'Not Found')
+        return 404
+    await send_response(send, 302, {'Location': '/' + encoded_id})
+    return 302
+
+async def static_file(request, send):
+    path = os.path.normpath(os.path.join(STATIC_DIR, request.path[len('/static/'):]))
+    if not path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(path):
+        await send_response(send, 404, {'Content-Type': 'text/plain'}, b'Not Found')
+        return 404
+    with open(path, 'rb') as f:
+        body = f.read()
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    await send_response(send, 200, {'Content-Type': content_type}, body)
+    return 200
+
+async def redirect_to_url(request, send, encoded_id):
+    timer = request.timer
+    with timer.stage('decode'):
+        original_url = decode_url(encoded_id)
+    if not original_url:
+        await send_error(send, '無効なURLです')
+        return 200
+
+    # アクセス数はメモリ上で数え、DBへはまとめて書き込む
+    access_counts.record(encoded_id)
+
+    # data: URIやhttp(s)以外はまとめて取得する
+    if not original_url.startswith(('http://', 'https://')):
+        with timer.stage('fetch'):
+            content, status_code, content_type = fetch_content(original_url)
+        if status_code != 200:
+            await send_error(send, 'コンテンツの取得に失敗しました')
+            return 200
+        body = process_response(content, content_type, original_url, request.host_url)
+        await send_response(send, 200, {'Content-Type': content_type}, body)
+        return 200
+
+    # 上流には書き換え時に展開でき、かつブラウザが受け付ける圧縮形式だけを要求する
+    # （書き換えない本文は圧縮されたまま転送するため）
+    upstream_headers = {'Accept-Encoding': compression.upstream_accept_encoding(request.headers.get('accept-encoding'))}
+
+    # Rangeリクエストは上流にそのまま転送する（キャッシュは使わない）
+    cacheable = 'range' not in request.headers
+    if not cacheable:
+        upstream_headers['Range'] = request.headers['range']
+
+    # キャッシュが新鮮ならそのまま返し、古ければ条件付きリクエストで再検証する
+    entry = None
+    if cacheable:
+        with timer.stage('cache'):
+            entry, is_fresh = await run_blocking(
+                response_cache.uses_disk(), response_cache.lookup, original_url, request.host_url)
+        if entry is not None:
+            if is_fresh:
+                return await send_cached(send, request, entry)
+            upstream_headers.update(response_cache.revalidation_headers(entry))
+
+    # ブラウザの条件付きヘッダーは上流へ転送しない（上流の304をそのまま返すと、書き換え対象でも
+    # 上流のETagがブラウザに保存され、書き換え後のETagの世代が変わっても無効にならないため）
+    # 本文を送るかどうかは上流の200を受け取った後、送るバリデーターで判定する
+
+    # 同じURLを同時に取得中の要求があれば、その取得と書き換えの結果を待って使う
+    # （最初の要求だけが上流に取得しに行き、結果を共有できなかった場合や待ちきれない場合は各自で取得する）
+    flight = None
+    if cacheable:
+        flight, is_leader = coalescing.async_flights.join((original_url, request.host_url))
+        if flight is not None and not is_leader:
+            with timer.stage('coalesce'):
+                shared = await flight.wait()
+            flight = None
+            if shared is not None:
+                coalescing.record('shared')
+                return await send_cached(send, request, shared)
+            coalescing.record('fallback')
+        elif flight is not None:
+            coalescing.record('leader')
+
+    try:
+        # 接続から応答ヘッダー受信まで（TTFB）
+        with timer.stage('upstream'):
+            upstream = await request_upstream(original_url, upstream_headers)
+    except Exception as e:
+        logger.exception("Error fetching content from %s: %s", original_url, e)
+        if flight is not None:
+            flight.abandon()
+        await send_error(send, 'コンテンツの取得に失敗しました')
+        return 200
+
+    try:
+        if entry is not None and upstream.status_code == 304:
+            entry = await run_blocking(
+                response_cache.uses_disk(), response_cache.refresh, original_url, request.host_url, entry, upstream.headers)
+            if flight is not None:
+                flight.publish_entry(entry)
+            return await send_cached(send, request, entry)
+
+        content_type = upstream.headers.get('Content-Type', 'text/html')
+        content_kind = get_content_kind(content_type)
+
+        # 書き換えた200応答以外は共有しないため、待っている要求はすぐに解放して各自で取得させる
+        # （書き換えない本文の転送が終わるまで待たせない）
+        if flight is not None and (content_kind is None or upstream.status_code != 200):
+            flight.abandon()
+
+        # 種類ごとの上限を超える本文は、Content-Lengthで分かる場合は受信前に断る
+        # （宣言が無い・偽りの場合は受信中に上限を超えた時点で打ち切る）
+        body_limit = get_body_limit(content_type)
+        try:
+            check_content_length(upstream.headers, body_limit, original_url)
+        except BodyTooLargeError:
+            await send_error(send, 'コンテンツが大きすぎるため表示できません', 502)
+            return 502
+
+        # 書き換え対象（HTML/CSS）以外はそのままストリーミングで転送する
+        if content_kind is None:
+            if upstream.status_code not in (200, 206):
+                await send_error(send, 'コンテンツの取得に失敗しました')
+                return 200
+            validators = response_cache.client_validators(upstream.headers, request.host_url)
+            if upstream.status_code == 200 and is_not_modified(request, validators):
+                await send_response(send, 304, validators)
+                return 304
+            headers = {name: upstream.headers[name] for name in PASSTHROUGH_HEADERS if name in upstream.headers}
+            headers['Vary'] = 'Accept-Encoding'
+            headers.update(validators)
+            collector = None
+            if cacheable and upstream.status_code == 200:
+                collector = response_cache.CacheCollector(original_url, request.host_url, 200, upstream.headers)
+
+            async def passthrough():
+                chunks = metrics.atimed_iter(upstream.aiter_raw(STREAM_CHUNK_SIZE), timer, 'download', direction='in')
+                if body_limit:
+                    chunks = aiter_limited(chunks, body_limit, original_url)
+                async for chunk in chunks:
+                    if collector is not None:
+                        collector.add(chunk)
+                    yield chunk
+                if collector is not None:
+                    await run_blocking(response_cache.uses_disk(), collector.finish)
+
+            await send_stream(send, upstream.status_code, headers, passthrough())
+            return upstream.status_code
+
+        if upstream.status_code != 200:
+            await send_error(send, 'コンテンツの取得に失敗しました')
+            return 200
+
+        # 書き換え後の内容がブラウザのキャッシュと同じなら本文を送らない
+        validators = response_cache.client_validators(upstream.headers, request.host_url, rewritten=True)
+        if is_not_modified(request, validators):
+            await send_response(send, 304, validators)
+            return 304
+
+        # 書き換え結果は非圧縮でキャッシュし、ブラウザが受け付ける形式で圧縮して送る
+        encoding = compression.negotiate(request.headers.get('accept-encoding'))
+        headers = {'Content-Type': content_type}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        headers['Vary'] = 'Accept-Encoding'
+        headers.update(validators)
+
+        # HTML/CSSを書き換えて送る（同じ内容の本文は前回の書き換え結果を再利用し、大きな本文は受信しながら書き換える）
+        # HTML中のサブリソース（CSS・JS・画像）は書き換え中に集め、見つかったチャンクを送る前にバックグラウンドでの取得を始める
+        resources = prefetch.new_resource_list()
+        collector = response_cache.CacheCollector(
+            original_url, request.host_url, 200, upstream.headers, rewritten=True, resources=resources)
+
+        async def compressed(chunks):
+            compressor = compression.StreamingCompressor(encoding)
+            size_in = size_out = 0
+            elapsed = 0.0
+            try:
+                async for chunk in chunks:
+                    start = time.perf_counter()
+                    out = compressor.feed(chunk)
+                    elapsed += time.perf_counter() - start
+                    size_in += len(chunk)
+                    size_out += len(out)
+                    yield out
+                start = time.perf_counter()
+                out = compressor.close()
+                elapsed += time.perf_counter() - start
+                size_out += len(out)
+                yield out
+                compression.record(encoding, size_in, size_out)
+            finally:
+                timer.add('compress', elapsed)
+
+        async def rewritten():
+            chunks = metrics.atimed_iter(upstream.aiter_bytes(STREAM_CHUNK_SIZE), timer, 'download', direction='in')
+            chunks = aiter_limited(chunks, body_limit, original_url)
+            head = []
+            buffer_limit = rewrite_cache.get_buffer_limit()
+            if buffer_limit:
+                size = 0
+                async for chunk in chunks:
+                    head.append(chunk)
+                    size += len(chunk)
+                    if size > buffer_limit:
+                        break
+                else:
+                    content = b''.join(head)
+                    with timer.stage('rewrite'):
+                        out = await run_blocking(
+                            len(content) > REWRITE_OFFLOAD_BYTES or rewrite_cache.uses_disk(),
+                            rewrite_cache.rewrite, content, content_type, original_url, request.host_url, resources)
+                    collector.add(out)
+                    yield out
+                    await run_blocking(response_cache.uses_disk(), collector.finish)
+                    return
+
+            processor = rewrite_cache.create_processor(content_type, original_url, request.host_url, resources)
+            elapsed = 0.0
+            try:
+                for chunk in head:
+                    start = time.perf_counter()
+                    out = await run_blocking(len(chunk) > REWRITE_OFFLOAD_BYTES, processor.feed, chunk)
+                    elapsed += time.perf_counter() - start
+                    collector.add(out)
+                    yield out
+                async for chunk in chunks:
+                    start = time.perf_counter()
+                    out = await run_blocking(len(chunk) > REWRITE_OFFLOAD_BYTES, processor.feed, chunk)
+                    elapsed += time.perf_counter() - start
+                    collector.add(out)
+                    yield out
+                # 'soup' は文書全体をここで書き換え、書き換えキャッシュへの保存もここで行う
+                start = time.perf_counter()
+                out = await run_blocking(True, processor.close)
+                elapsed += time.perf_counter() - start
+                collector.add(out)
+                yield out
+                await run_blocking(response_cache.uses_disk(), collector.finish)
+            finally:
+                timer.add('rewrite', elapsed)
+
+        body = prefetch.aiter_schedule(rewritten(), resources, request.host_url)
+        if flight is not None:
+            body = flight.atee(body, upstream.headers, resources)
+        if encoding:
+            body = compressed(body)
+        await send_stream(send, 200, headers, body)
+        return 200
+    finally:
+        # 結果を共有しないまま終わった場合は待っていた要求を解放する
+        if flight is not None:
+            flight.abandon()
+        await upstream.aclose()
+
+async def metrics_endpoint(request, send):
+    # トークンが無い・一致しない場合は存在を明かさない
+    if not metrics.is_authorized(request.headers.get('authorization')):
+        await send_response(send, 404, {'Content-Type': 'text/plain'}, b'Not Found')
+        return 404
+    await send_response(send, 200, {'Content-Type': metrics.CONTENT_TYPE}, metrics.render().encode('utf-8'))
+    return 200
+
+async def handle_http(scope, receive, send):
+    request = Request(scope, receive)
+    timer = request.timer
+    started = time.perf_counter()
+    written = {'bytes': 0, 'seconds': 0.0}
+
+    async def instrumented_send(message):
+        # ストリーミング応答はヘッダー送信時点までの段階だけがServer-Timingに載る
+        if message['type'] == 'http.response.start':
+            server_timing = timer.server_timing()
+            if server_timing:
+                message = dict(message, headers=list(message['headers']) + [(b'server-timing', server_timing.encode('latin-1'))])
+        elif message['type'] == 'http.response.body':
+            start = time.perf_counter()
+            await send(message)
+            written['seconds'] += time.perf_counter() - start
+            written['bytes'] += len(message.get('body', b''))
+            return
+        await send(message)
+
+    route, status = await route_http(scope, request, instrumented_send)
+
+    metrics.inc('mais_requests_total', route=route, status=str(status))
+    metrics.inc('mais_bytes_total', written['bytes'], direction='out')
+    if route == 'redirect_to_url':
+        timer.add('write', written['seconds'])
+    metrics.observe('mais_request_seconds', time.perf_counter() - started, route=route)
+    metrics.maybe_flush()
+    return status
+
+async def route_http(scope, request, send):
+    """
+    Dispatches a request and returns (route name, status code).
+
+    Route names match the Flask endpoint names used as metric labels.
+    """
+    path = request.path
+
+    if path == '/' and request.method in ('GET', 'HEAD'):
+        return 'index', await index(request, send)
+    if path == '/create_short_url' and request.method == 'POST':
+        return 'create_short_url', await create_short_url(request, send)
+    if path == '/metrics' and request.method in ('GET', 'HEAD'):
+        return 'metrics_endpoint', await metrics_endpoint(request, send)
+    if path.startswith('/static/'):
+        return 'static', await static_file(request, send)
+    if path == '/robots.txt':
+        await send_response(send, 200, {'Content-Type': 'text/plain; charset=utf-8', 'Cache-Control': WELL_KNOWN_CACHE_CONTROL},
+                            ROBOTS_TXT.encode())
+        return 'robots_txt', 200
+    if path == '/favicon.ico':
+        await send_response(send, 404, {'Cache-Control': WELL_KNOWN_CACHE_CONTROL})
+        return 'favicon', 404
+    if path.startswith('/s/') and request.method in ('GET', 'HEAD'):
+        return 'resolve_short_url', await resolve_short_url(request, send, path[len('/s/'):])
+
+    # オリジン相対の参照（/<トークン>/<パスとクエリ>）はデコード前のパスを使う
+    encoded_id = path[1:]
+    if '/' in encoded_id:
+        encoded_id = scope.get('raw_path', path.encode()).decode('latin-1')[1:]
+        if scope.get('query_string'):
+            encoded_id += '?' + scope['query_string'].decode('latin-1')
+    if encoded_id and request.method in ('GET', 'HEAD'):
+        started = time.perf_counter()
+        status = await redirect_to_url(request, send, encoded_id)
+        log_access_sampled(request.method, path, status, time.perf_counter() - started)
+        return 'redirect_to_url', status
+
+    await send_response(send, 404, {'Content-Type': 'text/plain'}, b'Not Found')
+    return 'other', 404
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point.
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    elif scope['type'] == 'http':
+        await handle_http(scope, receive, send)
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from src.mais import metrics
+from src.mais.response_cache import make_entry
+
+logger = logging.getLogger(__name__)
+
+# Let concurrent requests for the same URL share one upstream fetch and rewrite ('0' to disable)
+# Flights live in one worker process: the Flask app only shares them when a worker serves several
+# requests at once (gunicorn --worker-class gthread --threads N, the shipped run command); with
+# sync workers each request is alone in its worker and nothing is coalesced
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "1") != "0"
+
+# How long followers wait for the leader before fetching on their own (seconds)
+COALESCE_TIMEOUT = float(os.environ.get("COALESCE_TIMEOUT", "15"))
+
+# Larger rewritten bodies are not kept for followers (they fetch on their own)
+COALESCE_MAX_BYTES = int(os.environ.get("COALESCE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+class Flight:
+    """
+    One in-flight upstream fetch and rewrite that concurrent requests wait for.
+
+    The leader streams its own response as usual while passing the
+    rewritten chunks through tee(), which publishes the complete body.
+    As soon as the result turns out not to be shareable (passthrough
+    content, a non-200 status, an error or a body over COALESCE_MAX_BYTES)
+    the flight is abandoned, so followers do not wait for the leader's
+    transfer to end. Followers receive a response-cache style entry, or None, in
+    which case they fetch on their own.
+    """
+
+    def __init__(self, group, key):
+        self._group = group
+        self.key = key
+        self.started = time.monotonic()
+        self.finished = False
+        self.entry = None
+        self._chunks = []
+        self._size = 0
+        self._sharing = True
+        self._done = self._make_event()
+
+    def _make_event(self):
+        return threading.Event()
+
+    def add(self, chunk):
+        if not self._sharing:
+            return
+        self._size += len(chunk)
+        if self._size > COALESCE_MAX_BYTES:
+            # Release the followers now rather than when the leader's response ends
+            self._sharing = False
+            self.abandon()
+        else:
+            self._chunks.append(chunk)
+
+    def publish(self, upstream_headers, resources=None):
+        """
+        Shares the collected rewritten body with the followers.
+        """
+        if not self._sharing:
+            self.abandon()
+            return
+        self._finish(make_entry(200, upstream_headers, b''.join(self._chunks), rewritten=True, resources=resources))
+
+    def publish_entry(self, entry):
+        """
+        Shares a response cache entry (e.g. one the leader just revalidated).
+        """
+        self._finish(entry)
+
+    def abandon(self):
+        """
+        Releases the followers without a result. Does nothing once finished.
+        """
+        self._finish(None)
+
+    def _finish(self, entry):
+        if self.finished:
+            return
+        self.finished = True
+        self.entry = entry
+        self._chunks = []
+        self._group.remove(self)
+        self._done.set()
+
+    def tee(self, chunks, upstream_headers, resources=None):
+        """
+        Passes the rewritten chunks through and publishes the complete body.
+        """
+        for chunk in chunks:
+            self.add(chunk)
+            yield chunk
+        self.publish(upstream_headers, resources)
+
+    def wait(self):
+        """
+        Waits for the leader.
+
+        Returns:
+            dict: The shared entry, or None on timeout or if nothing was shared
+        """
+        if not self._done.wait(COALESCE_TIMEOUT):
+            return None
+        return self.entry
+
+class AsyncFlight(Flight):
+    """
+    Flight for the asyncio server; all methods must run on the event loop.
+    """
+
+    def _make_event(self):
+        return asyncio.Event()
+
+    async def atee(self, chunks, upstream_headers, resources=None):
+        """
+        Async counterpart of tee.
+        """
+        async for chunk in chunks:
+            self.add(chunk)
+            yield chunk
+        self.publish(upstream_headers, resources)
+
+    async def wait(self):
+        try:
+            await asyncio.wait_for(self._done.wait(), COALESCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        return self.entry
+
+class FlightGroup:
+    """
+    The in-flight fetches of one process, by key.
+    """
+
+    def __init__(self, flight_class):
+        self._flight_class = flight_class
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """
+        Joins the flight for key, starting one if there is none.
+
+        A leader that has not finished within COALESCE_TIMEOUT (for example
+        because its client went away before the body was read) is replaced.
+
+        Returns:
+            tuple: (flight, is_leader), or (None, False) if coalescing is disabled
+        """
+        if not COALESCE_ENABLED:
+            return None, False
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and time.monotonic() - flight.started < COALESCE_TIMEOUT:
+                return flight, False
+            flight = self._flights[key] = self._flight_class(self, key)
+            return flight, True
+
+    def remove(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+def record(result):
+    """
+    Counts a coalescing outcome: 'leader', 'shared' or 'fallback'.
+    """
+    metrics.inc('mais_coalesced_requests_total', result=result)
+
+# Threads (Flask) and the event loop (ASGI) keep separate groups
+flights = FlightGroup(Flight)
+async_flights = FlightGroup(AsyncFlight)
@@ -0,0 +1,263 @@
+import hashlib
+import logging
+import os
+import zlib
+from src.mais import metrics
+from src.mais.response_cache import MemoryCacheBackend
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Compress rewritten HTML/CSS for clients that accept it ('0' to disable)
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "1") != "0"
+
+# Encodings offered to clients, in order of preference (unavailable ones are skipped)
+COMPRESSION_ENCODINGS = [
+    name.strip() for name in os.environ.get("COMPRESSION_ENCODINGS", "br,zstd,gzip").split(',') if name.strip()
+]
+
+# Compression levels (brotli and zstd levels favour speed, since output is compressed per request)
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", "3"))
+
+# Complete bodies smaller than this are sent uncompressed
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "512"))
+
+# Size budget of the compressed variants of cached bodies (bytes, 0 = no caching)
+COMPRESSION_CACHE_MAX_BYTES = int(os.environ.get("COMPRESSION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Encodings we can compress to and decode, by whether their module is installed
+AVAILABLE_ENCODINGS = {'gzip', 'deflate'} | ({'br'} if brotli else set()) | ({'zstd'} if zstandard else set())
+
+# Accept-Encoding sent upstream when the client's preferences don't matter (fetch_content)
+UPSTREAM_ACCEPT_ENCODING = ', '.join(name for name in ('gzip', 'deflate', 'br', 'zstd') if name in AVAILABLE_ENCODINGS)
+
+_variants = MemoryCacheBackend(COMPRESSION_CACHE_MAX_BYTES) if COMPRESSION_CACHE_MAX_BYTES > 0 else None
+
+def parse_accept_encoding(header):
+    """
+    Parses an Accept-Encoding header.
+
+    Args:
+        header (str): The header value (may be None)
+
+    Returns:
+        dict: Lowercase coding -> q value
+    """
+    codings = {}
+    for item in (header or '').split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+def accepts(codings, encoding):
+    """
+    Returns True if the parsed Accept-Encoding allows encoding.
+    """
+    q = codings.get(encoding, codings.get('*', 0.0))
+    return q > 0
+
+def negotiate(accept_encoding):
+    """
+    Picks the encoding for a rewritten response.
+
+    Args:
+        accept_encoding (str): The client's Accept-Encoding header
+
+    Returns:
+        str: 'br', 'zstd' or 'gzip', or None to send the body uncompressed
+    """
+    if not COMPRESSION_ENABLED or not accept_encoding:
+        return None
+    codings = parse_accept_encoding(accept_encoding)
+    for encoding in COMPRESSION_ENCODINGS:
+        if encoding in AVAILABLE_ENCODINGS and accepts(codings, encoding):
+            return encoding
+    return None
+
+def upstream_accept_encoding(accept_encoding):
+    """
+    Builds the Accept-Encoding sent upstream on behalf of a client.
+
+    Only encodings that both we can decode (for rewriting) and the client
+    accepts (for bodies passed through untouched) are requested.
+
+    Args:
+        accept_encoding (str): The client's Accept-Encoding header
+
+    Returns:
+        str: The header value ('identity' if there is no common encoding)
+    """
+    codings = parse_accept_encoding(accept_encoding)
+    common = [name for name in ('gzip', 'deflate', 'br', 'zstd') if name in AVAILABLE_ENCODINGS and accepts(codings, name)]
+    return ', '.join(common) or 'identity'
+
+class StreamingCompressor:
+    """
+    Incremental compressor with the same feed()/close() shape as the rewriters.
+
+    Every fed chunk is flushed, so the browser can start parsing streamed
+    HTML before the whole document has been rewritten.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'br':
+            self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+        elif encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    def feed(self, chunk):
+        if not chunk:
+            return b''
+        if self.encoding == 'gzip':
+            return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == 'br':
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def close(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+def compress(body, encoding):
+    """
+    Compresses a complete body.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if encoding == 'br':
+        return brotli.compress(body, mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+def decompress(body, encoding):
+    """
+    Decodes a complete body in one of AVAILABLE_ENCODINGS.
+    """
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        # Some servers send raw deflate data instead of the zlib format
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    if encoding == 'br':
+        return brotli.decompress(body)
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+def iter_compress(chunks, encoding):
+    """
+    Compresses a streamed body.
+
+    Args:
+        chunks (iterable): The body as an iterable of bytes
+        encoding (str): The encoding returned by negotiate
+
+    Yields:
+        bytes: The compressed body
+    """
+    compressor = StreamingCompressor(encoding)
+    size_in = 0
+    size_out = 0
+    for chunk in chunks:
+        size_in += len(chunk)
+        out = compressor.feed(chunk)
+        if out:
+            size_out += len(out)
+            yield out
+    out = compressor.close()
+    size_out += len(out)
+    yield out
+    record(encoding, size_in, size_out)
+
+def record(encoding, size_in, size_out):
+    metrics.inc('mais_compression_bytes_total', size_in, encoding=encoding, direction='in')
+    metrics.inc('mais_compression_bytes_total', size_out, encoding=encoding, direction='out')
+
+def compress_cached(body, encoding):
+    """
+    Compresses a complete body, reusing the result for identical bytes.
+
+    Cached responses are served many times, so their compressed variants
+    are kept in a per-worker LRU keyed by the body's digest.
+
+    Returns:
+        bytes: The compressed body
+    """
+    if _variants is None:
+        compressed = compress(body, encoding)
+    else:
+        key = f"{encoding}:{hashlib.blake2b(body, digest_size=16).hexdigest()}"
+        entry = _variants.get(key)
+        if entry is not None:
+            compressed = entry['body']
+        else:
+            compressed = compress(body, encoding)
+            _variants.set(key, {'body': compressed})
+    record(encoding, len(body), len(compressed))
+    return compressed
+
+def encode_cached_body(entry, accept_encoding):
+    """
+    Chooses the body and Content-Encoding to send for a response cache entry.
+
+    Rewritten bodies are stored uncompressed and compressed here for the
+    client. Passthrough bodies are stored as the origin sent them; if the
+    origin's encoding is not acceptable to this client they are decoded.
+
+    Args:
+        entry (dict): The response cache entry
+        accept_encoding (str): The client's Accept-Encoding header
+
+    Returns:
+        tuple: (body, Content-Encoding value or None)
+    """
+    body = entry['body']
+    stored = entry['headers'].get('Content-Encoding')
+    if stored:
+        stored = stored.strip().lower()
+        if stored == 'identity' or accepts(parse_accept_encoding(accept_encoding), stored) or stored not in AVAILABLE_ENCODINGS:
+            return body, entry['headers']['Content-Encoding']
+        try:
+            return decompress(body, stored), None
+        except Exception as e:
+            logger.warning("Could not decode cached %s body: %s", stored, e)
+            return body, entry['headers']['Content-Encoding']
+
+    if entry.get('rewritten') and len(body) >= COMPRESSION_MIN_BYTES:
+        encoding = negotiate(accept_encoding)
+        if encoding:
+            return compress_cached(body, encoding), encoding
+    return body, None
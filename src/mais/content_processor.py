@@ -1,12 +1,85 @@
 import logging
-import re
+import os
 from urllib.parse import urljoin
 from bs4 import BeautifulSoup
-from proxy_utils import get_proxy_url
+from src.mais.css_rewriter import IncrementalCSSRewriter, rewrite_css
+from src.mais.html_rewriter import (
+    REWRITE_ATTRIBUTES, SUBRESOURCE_TAGS, IncrementalHTMLRewriter, is_refresh_meta, rewrite_attribute,
+    rewrite_html_stream, subresource,
+)
+from src.mais.proxy_utils import secure_base_domain, get_proxy_urls
 
 logger = logging.getLogger(__name__)
 
-def process_content(content, original_url, base_domain):
+# HTML rewriter backend:
+#   'stream' - single-pass incremental rewriter on the stdlib tokenizer (default)
+#   'soup'   - full BeautifulSoup tree, parser chosen by SOUP_PARSER
+#              ('html.parser', 'lxml' or 'html5lib')
+HTML_REWRITER_BACKEND = os.environ.get("HTML_REWRITER_BACKEND", "stream")
+SOUP_PARSER = os.environ.get("SOUP_PARSER", "html.parser")
+
+# Media types rewritten as HTML documents
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+# Media types rewritten as stylesheets
+CSS_CONTENT_TYPES = ('text/css',)
+
+def get_content_kind(content_type):
+    """
+    Classifies a Content-Type header value for rewriting.
+    
+    Args:
+        content_type (str): The Content-Type header value
+        
+    Returns:
+        str: 'html', 'css', or None if the content is passed through untouched
+    """
+    media_type = (content_type or '').split(';', 1)[0].strip().lower()
+    if media_type in HTML_CONTENT_TYPES:
+        return 'html'
+    if media_type in CSS_CONTENT_TYPES:
+        return 'css'
+    return None
+
+def process_response(content, content_type, original_url, base_domain, resources=None):
+    """
+    Dispatches content to the rewriter matching its content type.
+    
+    HTML goes through process_content, CSS through process_css, and any
+    other content is returned as the same object without being copied.
+    
+    Args:
+        content (bytes): The response body
+        content_type (str): The Content-Type header value
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy server
+        resources (list): If given, sub-resources found in HTML are appended as (destination, URL)
+        
+    Returns:
+        bytes: The processed content
+    """
+    kind = get_content_kind(content_type)
+    if kind == 'html':
+        return process_content(content, original_url, base_domain, content_type, resources)
+    if kind == 'css':
+        return process_css(content, original_url, base_domain)
+    return content
+
+def process_css(content, original_url, base_domain):
+    """
+    Process a stylesheet to rewrite url() and @import references through the proxy.
+    
+    Args:
+        content (bytes): The CSS content to process
+        original_url (str): The URL of the stylesheet
+        base_domain (str): The base domain of our proxy server
+        
+    Returns:
+        bytes: The processed CSS content
+    """
+    return rewrite_css(content, original_url, secure_base_domain(base_domain))
+
+def process_content(content, original_url, base_domain, content_type=None, resources=None):
     """
     Process HTML content to rewrite URLs and maintain proxy context.
     
@@ -14,46 +87,196 @@ def process_content(content, original_url, base_domain):
         content (bytes): The HTML content to process
         original_url (str): The original URL that we're proxying
         base_domain (str): The base domain of our proxy server
+        content_type (str): The Content-Type header value, used for the charset
+        resources (list): If given, discovered sub-resources are appended as (destination, URL)
         
     Returns:
         bytes: The processed HTML content
     """
     try:
-        # Ensure base_domain uses HTTPS only in production environments
-        if base_domain.startswith('http:') and not base_domain.startswith('http://localhost') and not base_domain.startswith('http://127.0.0.1'):
-            base_domain = base_domain.replace('http:', 'https:', 1)
-            
+        base_domain = secure_base_domain(base_domain)
+        if HTML_REWRITER_BACKEND == 'soup':
+            return _process_content_soup(content, original_url, base_domain, resources)
+        return b''.join(rewrite_html_stream([content], original_url, base_domain, content_type, resources))
+    
+    except Exception as e:
+        logger.exception(f"Error processing content: {str(e)}")
+        return content  # Return original content on error
+
+def iter_process_content(chunks, original_url, base_domain, content_type=None, resources=None):
+    """
+    Process an HTML document incrementally, yielding output as it is rewritten.
+    
+    With the 'soup' backend the whole document is collected first.
+    
+    Args:
+        chunks (iterable): The HTML content as an iterable of bytes
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy server
+        content_type (str): The Content-Type header value, used for the charset
+        resources (list): If given, discovered sub-resources are appended as (destination, URL)
+        
+    Yields:
+        bytes: The processed HTML content
+    """
+    base_domain = secure_base_domain(base_domain)
+    if HTML_REWRITER_BACKEND == 'soup':
+        processor = _BufferedSoupProcessor(original_url, base_domain, content_type, resources)
+        for chunk in chunks:
+            processor.feed(chunk)
+        yield processor.close()
+    else:
+        yield from rewrite_html_stream(chunks, original_url, base_domain, content_type, resources)
+
+class _BufferedSoupProcessor:
+    """
+    Collects the whole document for the 'soup' backend and rewrites it on close().
+    
+    Callers bound the document size with the per-type body limits.
+    """
+    
+    def __init__(self, original_url, base_domain, content_type=None, resources=None):
+        self.original_url = original_url
+        self.base_domain = base_domain
+        self.content_type = content_type
+        self.resources = resources
+        self._chunks = []
+    
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+        return b''
+    
+    def close(self):
+        content = b''.join(self._chunks)
+        self._chunks = []
+        return process_content(content, self.original_url, self.base_domain, self.content_type, self.resources)
+
+def create_html_processor(original_url, base_domain, content_type=None, resources=None):
+    """
+    Creates a push-style HTML processor with feed(bytes) and close() methods.
+    
+    Both methods return the rewritten bytes available so far, which lets
+    asyncio code rewrite a document while it is being received.
+    
+    Args:
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy server
+        content_type (str): The Content-Type header value, used for the charset
+        resources (list): If given, discovered sub-resources are appended as (destination, URL)
+        
+    Returns:
+        object: The processor
+    """
+    base_domain = secure_base_domain(base_domain)
+    if HTML_REWRITER_BACKEND == 'soup':
+        return _BufferedSoupProcessor(original_url, base_domain, content_type, resources)
+    return IncrementalHTMLRewriter(original_url, base_domain, content_type, resources)
+
+def create_processor(content_type, original_url, base_domain, resources=None):
+    """
+    Creates the push-style processor (feed/close) matching a content type.
+    
+    Args:
+        content_type (str): The Content-Type header value
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy server
+        resources (list): If given, sub-resources found in HTML are appended as (destination, URL)
+        
+    Returns:
+        object: The processor, or None if the content is passed through untouched
+    """
+    kind = get_content_kind(content_type)
+    if kind == 'html':
+        return create_html_processor(original_url, base_domain, content_type, resources)
+    if kind == 'css':
+        return IncrementalCSSRewriter(original_url, secure_base_domain(base_domain))
+    return None
+
+def iter_process_response(chunks, content_type, original_url, base_domain, resources=None):
+    """
+    Streaming counterpart of process_response.
+    
+    Args:
+        chunks (iterable): The response body as an iterable of bytes
+        content_type (str): The Content-Type header value
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy server
+        resources (list): If given, sub-resources found in HTML are appended as (destination, URL)
+        
+    Yields:
+        bytes: The processed content
+    """
+    processor = create_processor(content_type, original_url, base_domain, resources)
+    if processor is None:
+        yield from chunks
+        return
+    for chunk in chunks:
+        out = processor.feed(chunk)
+        if out:
+            yield out
+    out = processor.close()
+    if out:
+        yield out
+
+def _process_content_soup(content, original_url, base_domain, resources=None):
+    """
+    Rewrites HTML by building a full BeautifulSoup tree (legacy backend).
+    """
+    try:
         # Parse the content with BeautifulSoup
-        soup = BeautifulSoup(content, 'html.parser')
+        soup = BeautifulSoup(content, SOUP_PARSER)
         
-        # Process links (a tags)
-        for a_tag in soup.find_all('a', href=True):
-            a_tag['href'] = get_proxy_url(original_url, base_domain, a_tag['href'])
-            
-        # Process CSS links
-        for link_tag in soup.find_all('link', href=True):
-            link_tag['href'] = get_proxy_url(original_url, base_domain, link_tag['href'])
-            
-        # Process images (data: URLはそのまま保持)
-        for img_tag in soup.find_all('img', src=True):
-            if not img_tag['src'].startswith('data:'):
-                img_tag['src'] = get_proxy_url(original_url, base_domain, img_tag['src'])
-            
-        # Process scripts
-        for script_tag in soup.find_all('script', src=True):
-            script_tag['src'] = get_proxy_url(original_url, base_domain, script_tag['src'])
-            
-        # Process form actions
-        for form_tag in soup.find_all('form', action=True):
-            form_tag['action'] = get_proxy_url(original_url, base_domain, form_tag['action'])
+        # One traversal collects every URL-bearing attribute so the plain URLs
+        # can be encoded in one batch once <base href> is known
+        base_url = original_url
+        base_seen = False
+        head_tag = None
+        targets = []
+        others = []
+        found = []
+        for tag in soup.find_all(True):
+            if tag.name == 'head' and head_tag is None:
+                head_tag = tag
+            elif tag.name == 'style' and tag.string:
+                others.append((tag, None, 'css'))
+            if tag.has_attr('style'):
+                others.append((tag, 'style', 'css'))
+            for attr, kind in REWRITE_ATTRIBUTES.get(tag.name, ()):
+                if not tag.has_attr(attr):
+                    continue
+                if kind == 'url':
+                    targets.append((tag, attr))
+                elif kind != 'refresh' or is_refresh_meta(tag.attrs):
+                    others.append((tag, attr, kind))
+            if tag.name == 'base' and not base_seen and tag.has_attr('href'):
+                base_url = urljoin(original_url, tag['href'].strip())
+                base_seen = True
+            if resources is not None and tag.name in SUBRESOURCE_TAGS:
+                reference = subresource(tag.name, tag.attrs)
+                if reference is not None and tag.get(reference[0]):
+                    found.append((reference[1], tag[reference[0]].strip()))
+        
+        # Sub-resources resolve against the final <base href>, like the rewritten links
+        if resources is not None:
+            resources.extend((destination, urljoin(base_url, url)) for destination, url in found)
+        
+        proxy_urls = get_proxy_urls(base_url, base_domain, [tag[attr].strip() for tag, attr in targets])
+        for (tag, attr), proxy_url in zip(targets, proxy_urls):
+            tag[attr] = proxy_url
+        
+        for tag, attr, kind in others:
+            if attr is None:
+                # <style> block
+                tag.string.replace_with(rewrite_attribute(kind, str(tag.string), base_url, base_domain))
+            else:
+                tag[attr] = rewrite_attribute(kind, tag[attr], base_url, base_domain)
             
         # Add Content-Security-Policy meta tag to help prevent mixed content
         meta_csp = soup.new_tag('meta')
         meta_csp.attrs['http-equiv'] = 'Content-Security-Policy'
         meta_csp.attrs['content'] = "upgrade-insecure-requests"
         
-        # Find head tag and insert meta tag
-        head_tag = soup.find('head')
+        # Insert meta tag into the head tag found above
         if head_tag:
             head_tag.insert(0, meta_csp)
         else:
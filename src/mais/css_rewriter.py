@@ -0,0 +1,132 @@
+import logging
+import re
+from src.mais.proxy_utils import get_proxy_urls
+
+logger = logging.getLogger(__name__)
+
+# url(...) and @import "..." references (a single left-to-right scan, no AST).
+# Matched against buffer.lower(), which keeps byte offsets and is much
+# cheaper than re.IGNORECASE.
+CSS_REFERENCE_PATTERN = re.compile(
+    rb'''url\(\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<bare>[^\s'"()]*))\s*\)'''
+    rb'''|@import\s*(?:"(?P<idq>[^"]*)"|'(?P<isq>[^']*)')'''
+)
+
+# Start of a reference that may still be incomplete at the end of a chunk
+CSS_REFERENCE_START = re.compile(rb'url\(|@import')
+
+# Bytes kept back at the end of a chunk in case a keyword is split ("@impor" + "t")
+CSS_KEYWORD_TAIL = len(b'@import') - 1
+
+# An unterminated reference longer than this is passed through as is
+CSS_MAX_REFERENCE = 8192
+
+QUOTES = {'dq': b'"', 'sq': b"'", 'bare': b'', 'idq': b'"', 'isq': b"'"}
+
+def _scan(buffer, final):
+    """
+    Finds the references in buffer and the offset up to which it can be emitted.
+
+    Returns:
+        tuple: (list of matches, cut offset)
+    """
+    lowered = buffer.lower()
+    matches = list(CSS_REFERENCE_PATTERN.finditer(lowered))
+    if final:
+        return matches, len(buffer)
+    last_end = matches[-1].end() if matches else 0
+    start = CSS_REFERENCE_START.search(lowered, last_end)
+    if start is not None and len(buffer) - start.start() <= CSS_MAX_REFERENCE:
+        return matches, start.start()
+    return matches, max(last_end, len(buffer) - CSS_KEYWORD_TAIL)
+
+def _rewrite(buffer, matches, end, original_url, base_domain):
+    """
+    Rewrites buffer[:end] using the matches found by _scan.
+
+    All URLs found are converted with one get_proxy_urls call.
+    """
+    references = []
+    targets = []
+    for match in matches:
+        group = match.lastgroup
+        value = buffer[match.start(group):match.end(group)].strip()
+        # SVG fragment references stay inside the document
+        if not value or value.startswith(b'#'):
+            continue
+        references.append((match, group))
+        targets.append(value.decode('utf-8', 'surrogateescape'))
+
+    if not references:
+        return buffer[:end]
+
+    proxy_urls = get_proxy_urls(original_url, base_domain, targets)
+
+    out = []
+    position = 0
+    for (match, group), proxy_url in zip(references, proxy_urls):
+        out.append(buffer[position:match.start()])
+        quote = QUOTES[group]
+        proxied = quote + proxy_url.encode('utf-8', 'surrogateescape') + quote
+        if group in ('idq', 'isq'):
+            out.append(b'@import ' + proxied)
+        else:
+            out.append(b'url(' + proxied + b')')
+        position = match.end()
+    out.append(buffer[position:end])
+    return b''.join(out)
+
+class IncrementalCSSRewriter:
+    """
+    Streaming url()/@import rewriter for stylesheets.
+
+    Each feed() rewrites everything up to the last position where no
+    reference can still be open and keeps only the (bounded) remainder,
+    so the total work stays linear in the size of the stylesheet.
+    """
+
+    def __init__(self, original_url, base_domain):
+        self.original_url = original_url
+        self.base_domain = base_domain
+        self._pending = b''
+
+    def feed(self, chunk):
+        return self._process(self._pending + chunk, final=False)
+
+    def close(self):
+        return self._process(self._pending, final=True)
+
+    def _process(self, buffer, final):
+        try:
+            matches, cut = _scan(buffer, final)
+            self._pending = buffer[cut:]
+            return _rewrite(buffer, matches, cut, self.original_url, self.base_domain)
+        except Exception as e:
+            logger.exception("Error processing CSS: %s", e)
+            self._pending = b''
+            return buffer
+
+def rewrite_css(content, original_url, base_domain):
+    """
+    Rewrites url() and @import references of a whole stylesheet.
+
+    Args:
+        content (bytes): The CSS content
+        original_url (str): The URL of the stylesheet (or of the page for inline CSS)
+        base_domain (str): The base domain of our proxy server
+
+    Returns:
+        bytes: The rewritten CSS
+    """
+    rewriter = IncrementalCSSRewriter(original_url, base_domain)
+    return rewriter.feed(content) + rewriter.close()
+
+def rewrite_css_text(text, original_url, base_domain):
+    """
+    Rewrites url() and @import references in CSS held as a str
+    (<style> blocks and style attributes).
+    """
+    if 'url(' not in text.lower() and '@import' not in text.lower():
+        return text
+    content = text.encode('utf-8', 'surrogateescape')
+    return rewrite_css(content, original_url, base_domain).decode('utf-8', 'surrogateescape')
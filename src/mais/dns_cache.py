@@ -0,0 +1,327 @@
+import errno
+import ipaddress
+import logging
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict
+from src.mais import metrics
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:  # pragma: no cover - optional dependency
+    dns = None
+
+logger = logging.getLogger(__name__)
+
+# Cache upstream host name lookups in the worker process ('0' to use the system resolver on every connect)
+DNS_CACHE_ENABLED = os.environ.get("DNS_CACHE_ENABLED", "1") != "0"
+
+# Number of (host, port) lookups kept
+DNS_CACHE_SIZE = int(os.environ.get("DNS_CACHE_SIZE", "4096"))
+
+# Lifetime of answers whose TTL is unknown (the system resolver does not report it), in seconds
+DNS_CACHE_TTL = float(os.environ.get("DNS_CACHE_TTL", "60"))
+
+# Bounds applied to record TTLs (seconds)
+DNS_CACHE_MIN_TTL = float(os.environ.get("DNS_CACHE_MIN_TTL", "5"))
+DNS_CACHE_MAX_TTL = float(os.environ.get("DNS_CACHE_MAX_TTL", "3600"))
+
+# Lifetime of failed lookups (NXDOMAIN and the like), in seconds
+DNS_NEGATIVE_TTL = float(os.environ.get("DNS_NEGATIVE_TTL", "30"))
+
+# 'system' (getaddrinfo) or 'dnspython' (queries DNS_NAMESERVERS directly and respects record TTLs)
+DNS_RESOLVER = os.environ.get("DNS_RESOLVER", "system")
+
+# Comma-separated nameservers for the dnspython resolver, as 'ip' or 'ip:port' (empty = /etc/resolv.conf)
+DNS_NAMESERVERS = [
+    server.strip() for server in os.environ.get("DNS_NAMESERVERS", "").split(',') if server.strip()
+]
+
+# Delay before trying the next address while a connection attempt is still pending (RFC 8305), in seconds
+HAPPY_EYEBALLS_DELAY = float(os.environ.get("HAPPY_EYEBALLS_DELAY", "0.25"))
+
+class SystemResolver:
+    """
+    Resolves with getaddrinfo; answers are cached for DNS_CACHE_TTL.
+    """
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        """
+        Looks up the addresses of a host.
+
+        Args:
+            host (str): The host name
+            port (int): The port to put in the socket addresses
+            family (int): AF_UNSPEC, AF_INET or AF_INET6
+
+        Returns:
+            tuple: (getaddrinfo-style list, TTL in seconds or None if unknown)
+
+        Raises:
+            socket.gaierror: If the name does not resolve
+        """
+        return socket.getaddrinfo(host, port, family, socket.SOCK_STREAM), None
+
+class DnspythonResolver:
+    """
+    Queries A and AAAA records with dnspython, reporting their TTL.
+    """
+
+    def __init__(self, nameservers=None):
+        if dns is None:
+            raise RuntimeError("DNS_RESOLVER=dnspython requires the dnspython package")
+        self._resolver = dns.resolver.Resolver(configure=not nameservers)
+        if nameservers:
+            self._resolver.nameservers = []
+            for server in nameservers:
+                address, _, port = server.rpartition(':') if server.count(':') == 1 else (server, '', '')
+                self._resolver.nameservers.append(address)
+                if port:
+                    self._resolver.port = int(port)
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        record_types = []
+        if family in (socket.AF_UNSPEC, socket.AF_INET6):
+            record_types.append(('AAAA', socket.AF_INET6))
+        if family in (socket.AF_UNSPEC, socket.AF_INET):
+            record_types.append(('A', socket.AF_INET))
+        infos = []
+        ttl = None
+        for record_type, address_family in record_types:
+            try:
+                answer = self._resolver.resolve(host, record_type)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers):
+                continue
+            except dns.exception.Timeout as e:
+                raise socket.gaierror(socket.EAI_AGAIN, str(e)) from e
+            ttl = answer.rrset.ttl if ttl is None else min(ttl, answer.rrset.ttl)
+            for record in answer:
+                sockaddr = (record.address, port, 0, 0) if address_family == socket.AF_INET6 else (record.address, port)
+                infos.append((address_family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', sockaddr))
+        if not infos:
+            raise socket.gaierror(socket.EAI_NONAME, f"No addresses for {host}")
+        return infos, ttl
+
+class DNSCache:
+    """
+    LRU of lookups with per-entry expiry, including failed ones.
+
+    Concurrent lookups of a name that is not cached each go to the
+    resolver; only the cached answer is shared.
+    """
+
+    def __init__(self, resolver, max_entries=DNS_CACHE_SIZE):
+        self.resolver = resolver
+        self.max_entries = max_entries
+        # (host, port, family) -> (infos or gaierror, expires_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        """
+        Returns the getaddrinfo-style addresses of a host, from the cache when fresh.
+
+        Raises:
+            socket.gaierror: If the name does not resolve (also when the failure is cached)
+        """
+        key = (host, port, family)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[1] > now:
+                self._entries.move_to_end(key)
+                result = cached[0]
+            else:
+                result = None
+        if result is not None:
+            if isinstance(result, socket.gaierror):
+                metrics.inc('mais_dns_lookups_total', result='negative')
+                raise result
+            metrics.inc('mais_dns_lookups_total', result='hit')
+            return result
+
+        metrics.inc('mais_dns_lookups_total', result='miss')
+        try:
+            infos, ttl = self.resolver.resolve(host, port, family)
+        except socket.gaierror as e:
+            # Temporary failures are not cached, so the next request tries again
+            if e.errno != socket.EAI_AGAIN and DNS_NEGATIVE_TTL > 0:
+                self._set(key, e, DNS_NEGATIVE_TTL)
+            raise
+        ttl = DNS_CACHE_TTL if ttl is None else min(max(ttl, DNS_CACHE_MIN_TTL), DNS_CACHE_MAX_TTL)
+        if ttl > 0:
+            self._set(key, infos, ttl)
+        return infos
+
+    def _set(self, key, result, ttl):
+        with self._lock:
+            self._entries[key] = (result, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def _create_resolver():
+    if DNS_RESOLVER == 'dnspython':
+        return DnspythonResolver(DNS_NAMESERVERS)
+    return SystemResolver()
+
+_cache = DNSCache(_create_resolver())
+
+def set_resolver(resolver):
+    """
+    Replaces the resolver behind the cache and empties it.
+
+    Any object with a resolve(host, port, family) method returning
+    (getaddrinfo-style list, TTL or None) can be used, e.g. a stub that
+    answers from a dict in tests.
+    """
+    _cache.resolver = resolver
+    _cache.clear()
+
+def getaddrinfo(host, port, family=socket.AF_UNSPEC):
+    """
+    Resolves a host for a TCP connection through the cache.
+
+    IP literals are returned without a lookup.
+
+    Returns:
+        list: getaddrinfo-style (family, type, proto, canonname, sockaddr) tuples
+    """
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        pass
+    else:
+        if address.version == 6:
+            return [(socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (host, port, 0, 0))]
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (host, port))]
+    if not DNS_CACHE_ENABLED:
+        return socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)
+    return _cache.resolve(host, port, family)
+
+def _interleave(infos):
+    """
+    Orders addresses so that the two families alternate (RFC 8305 section 4),
+    starting with the family the resolver listed first.
+    """
+    if not infos:
+        return []
+    first = [info for info in infos if info[0] == infos[0][0]]
+    other = [info for info in infos if info[0] != infos[0][0]]
+    ordered = []
+    for index in range(max(len(first), len(other))):
+        ordered.extend(group[index] for group in (first, other) if index < len(group))
+    return ordered
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None, socket_options=None,
+                      family=socket.AF_UNSPEC):
+    """
+    Connects to a host, racing its addresses in the style of happy eyeballs.
+
+    Addresses are tried in interleaved IPv6/IPv4 order. The next attempt
+    starts when the previous one fails or HAPPY_EYEBALLS_DELAY has passed
+    without an answer, and the first connection to succeed is used, so an
+    unreachable address family costs at most the delay instead of the
+    whole connect timeout.
+
+    Args:
+        address (tuple): (host, port)
+        timeout (float): Timeout for the whole connect and for the returned socket
+        source_address (tuple): Local (host, port) to bind to, if any
+        socket_options (list): setsockopt() arguments applied before connecting
+        family (int): AF_UNSPEC, AF_INET or AF_INET6
+
+    Returns:
+        socket.socket: The connected socket
+
+    Raises:
+        socket.gaierror: If the host does not resolve
+        TimeoutError: If no address answered within the timeout
+        OSError: The last connection error if every address failed
+    """
+    host, port = address
+    if host.startswith('['):
+        host = host.strip('[]')
+    infos = _interleave(getaddrinfo(host, port, family))
+    if not infos:
+        raise OSError("getaddrinfo returns an empty list")
+
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    selector = selectors.DefaultSelector()
+    pending = []
+    winner = None
+    error = None
+    next_index = 0
+    next_attempt = time.monotonic()
+    try:
+        while winner is None:
+            now = time.monotonic()
+            if next_index < len(infos) and (now >= next_attempt or not pending):
+                af, socktype, proto, _canonname, sockaddr = infos[next_index]
+                next_index += 1
+                next_attempt = now + HAPPY_EYEBALLS_DELAY
+                sock = None
+                try:
+                    sock = socket.socket(af, socktype, proto)
+                    for option in socket_options or ():
+                        sock.setsockopt(*option)
+                    if source_address:
+                        sock.bind(source_address)
+                    sock.setblocking(False)
+                    result = sock.connect_ex(sockaddr)
+                    if result == 0:
+                        winner = sock
+                    elif result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        selector.register(sock, selectors.EVENT_WRITE)
+                        pending.append(sock)
+                    else:
+                        raise OSError(result, os.strerror(result))
+                except OSError as e:
+                    error = e
+                    if sock is not None:
+                        sock.close()
+                    next_attempt = now
+                continue
+
+            if not pending:
+                break
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f"Connection to {host} timed out")
+            wait = None if deadline is None else deadline - now
+            if next_index < len(infos):
+                wait = next_attempt - now if wait is None else min(wait, next_attempt - now)
+            for key, _events in selector.select(max(wait, 0) if wait is not None else None):
+                sock = key.fileobj
+                selector.unregister(sock)
+                pending.remove(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0 and winner is None:
+                    winner = sock
+                else:
+                    if result:
+                        error = OSError(result, os.strerror(result))
+                    sock.close()
+                    # A failed attempt starts the next one right away
+                    next_attempt = time.monotonic()
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+    if winner is None:
+        if error is not None:
+            raise error
+        raise TimeoutError(f"Connection to {host} timed out")
+    winner.settimeout(timeout)
+    return winner
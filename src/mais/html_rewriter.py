@@ -0,0 +1,455 @@
+import codecs
+import logging
+import re
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+from src.mais.css_rewriter import rewrite_css_text
+from src.mais.proxy_utils import get_proxy_url, get_proxy_urls
+
+logger = logging.getLogger(__name__)
+
+# URL-bearing attributes per tag, as (attribute, kind) pairs:
+#   'url'     - a single URL
+#   'urls'    - a space separated list of URLs (ping)
+#   'ref'     - a URL, or a same-document "#id" reference that is left as is (SVG)
+#   'srcset'  - a comma separated list of "URL [descriptor]" candidates
+#   'refresh' - <meta http-equiv="refresh" content="N; url=...">
+# style="" attributes are rewritten as CSS on every tag.
+REWRITE_ATTRIBUTES = {
+    'a': (('href', 'url'), ('ping', 'urls')),
+    'area': (('href', 'url'), ('ping', 'urls')),
+    'link': (('href', 'url'), ('imagesrcset', 'srcset')),
+    'img': (('src', 'url'), ('srcset', 'srcset')),
+    'script': (('src', 'url'),),
+    'form': (('action', 'url'),),
+    'button': (('formaction', 'url'),),
+    'input': (('src', 'url'), ('formaction', 'url')),
+    'iframe': (('src', 'url'),),
+    'frame': (('src', 'url'),),
+    'embed': (('src', 'url'),),
+    'object': (('data', 'url'),),
+    'source': (('src', 'url'), ('srcset', 'srcset')),
+    'video': (('src', 'url'), ('poster', 'url')),
+    'audio': (('src', 'url'),),
+    'track': (('src', 'url'),),
+    'base': (('href', 'url'),),
+    'meta': (('content', 'refresh'),),
+    'html': (('manifest', 'url'),),
+    # Legacy presentational background images
+    'body': (('background', 'url'),),
+    'table': (('background', 'url'),),
+    'td': (('background', 'url'),),
+    'th': (('background', 'url'),),
+    # SVG (the parser lowercases attribute names, so xlink:href arrives as is)
+    'image': (('href', 'ref'), ('xlink:href', 'ref')),
+    'use': (('href', 'ref'), ('xlink:href', 'ref')),
+}
+
+# Tags that load a sub-resource the browser requests right after the document
+SUBRESOURCE_TAGS = ('link', 'script', 'img')
+
+# "5; url=http://example.com/" (the URL part is optional)
+REFRESH_PATTERN = re.compile(r'''^(\s*[\d.]*\s*[;,]\s*(?:url\s*=\s*)?)(['"]?)(.*?)\2\s*$''', re.IGNORECASE | re.DOTALL)
+
+# Meta tag injected into <head> to help prevent mixed content
+CSP_META_TAG = '<meta http-equiv="Content-Security-Policy" content="upgrade-insecure-requests">'
+
+# How many bytes to inspect for a <meta charset> declaration
+CHARSET_SNIFF_SIZE = 1024
+
+CHARSET_PATTERN = re.compile(rb'''<meta[^>]+charset\s*=\s*["']?\s*([a-zA-Z0-9_.:-]+)''', re.IGNORECASE)
+
+def detect_charset(content_type, head):
+    """
+    Determines the character encoding of an HTML document.
+
+    Args:
+        content_type (str): The Content-Type header value (may be None)
+        head (bytes): The first bytes of the document
+
+    Returns:
+        str: A codec name usable with codecs.getincrementaldecoder
+    """
+    candidates = []
+    if content_type and 'charset=' in content_type.lower():
+        candidates.append(content_type.lower().split('charset=', 1)[1].split(';', 1)[0].strip(' "\''))
+    match = CHARSET_PATTERN.search(head)
+    if match:
+        candidates.append(match.group(1).decode('ascii', 'ignore'))
+
+    for charset in candidates:
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            continue
+    return 'utf-8'
+
+def parse_srcset(value):
+    """
+    Splits a srcset value into (url, descriptor) pairs.
+
+    Follows the HTML parsing rules closely enough that URLs containing
+    commas (e.g. CDN transformation parameters) are kept intact.
+    """
+    candidates = []
+    position, length = 0, len(value)
+    while True:
+        while position < length and (value[position].isspace() or value[position] == ','):
+            position += 1
+        if position >= length:
+            return candidates
+        start = position
+        while position < length and not value[position].isspace():
+            position += 1
+        url = value[start:position]
+        descriptor = ''
+        if url.endswith(','):
+            url = url.rstrip(',')
+        else:
+            start, depth = position, 0
+            while position < length:
+                char = value[position]
+                if char == '(':
+                    depth += 1
+                elif char == ')' and depth:
+                    depth -= 1
+                elif char == ',' and not depth:
+                    break
+                position += 1
+            descriptor = value[start:position].strip()
+        candidates.append((url, descriptor))
+
+def is_refresh_meta(attrs):
+    """
+    Returns True for <meta http-equiv="refresh">.
+
+    Args:
+        attrs (dict): The tag attributes
+    """
+    return (attrs.get('http-equiv') or '').strip().lower() == 'refresh'
+
+def subresource(tag, attrs):
+    """
+    Identifies a sub-resource reference for prefetching.
+
+    Args:
+        tag (str): The tag name
+        attrs (dict): The tag attributes (rel may be a string or a list)
+
+    Returns:
+        tuple: (attribute, destination) such as ('href', 'style'), or None
+    """
+    if tag == 'link':
+        rel = attrs.get('rel') or ''
+        rel = (' '.join(rel) if isinstance(rel, list) else rel).lower().split()
+        if 'stylesheet' in rel:
+            return 'href', 'style'
+        if 'modulepreload' in rel:
+            return 'href', 'script'
+        if 'preload' in rel and attrs.get('as'):
+            return 'href', attrs['as'].strip().lower()
+        return None
+    if tag == 'script':
+        return 'src', 'script'
+    if tag == 'img':
+        return 'src', 'image'
+    return None
+
+def rewrite_attribute(kind, value, base_url, base_domain):
+    """
+    Rewrites one attribute value according to its kind in REWRITE_ATTRIBUTES.
+
+    Args:
+        kind (str): 'url', 'urls', 'ref', 'srcset', 'refresh' or 'css'
+        value (str): The attribute value
+        base_url (str): The URL relative references are resolved against
+        base_domain (str): The base domain of our proxy server
+
+    Returns:
+        str: The rewritten value
+    """
+    if kind == 'url':
+        return get_proxy_url(base_url, base_domain, value.strip())
+    if kind == 'urls':
+        return ' '.join(get_proxy_urls(base_url, base_domain, value.split()))
+    if kind == 'ref':
+        if value.strip().startswith('#'):
+            return value
+        return get_proxy_url(base_url, base_domain, value.strip())
+    if kind == 'srcset':
+        candidates = parse_srcset(value)
+        proxy_urls = get_proxy_urls(base_url, base_domain, [url for url, _ in candidates])
+        return ', '.join(f'{proxy_url} {descriptor}' if descriptor else proxy_url
+                         for proxy_url, (_, descriptor) in zip(proxy_urls, candidates))
+    if kind == 'refresh':
+        match = REFRESH_PATTERN.match(value)
+        if not match or not match.group(3):
+            return value
+        return match.group(1) + get_proxy_url(base_url, base_domain, match.group(3).strip())
+    if kind == 'css':
+        return rewrite_css_text(value, base_url, base_domain)
+    return value
+
+class StreamingHTMLRewriter(HTMLParser):
+    """
+    Single-pass HTML rewriter built on the standard library tokenizer.
+
+    Markup is re-emitted as it is tokenized, so output can be flushed
+    before the whole document has been received. Tags whose URL
+    attributes are not rewritten are emitted exactly as they appeared
+    in the source.
+
+    If resources is a list, (destination, absolute URL) pairs of the
+    stylesheets, scripts and images found are appended to it.
+    """
+
+    def __init__(self, original_url, base_domain, resources=None):
+        super().__init__(convert_charrefs=False)
+        self.original_url = original_url
+        self.base_domain = base_domain
+        self.resources = resources
+        # Changed by the first <base href>
+        self.base_url = original_url
+        self._base_seen = False
+        self._out = []
+        self._head_done = False
+        self._head_pending = False
+        # Text of the <style> block being read (None outside of one)
+        self._style = None
+
+    def rewrite(self, data):
+        """
+        Feeds a chunk of text and returns the output available so far.
+        """
+        self.feed(data)
+        return self._flush()
+
+    def finish(self):
+        """
+        Flushes buffered input and returns the remaining output.
+        """
+        self.close()
+        if self._style is not None:
+            self._out.append(self._end_style())
+        if self._head_pending:
+            self._emit_head()
+        return self._flush()
+
+    def _flush(self):
+        out = ''.join(self._out)
+        self._out.clear()
+        return out
+
+    def _emit_head(self):
+        self._out.append('<head>' + CSP_META_TAG + '</head>')
+        self._head_pending = False
+        self._head_done = True
+
+    def pending_text(self):
+        """
+        Returns the output and input not yet emitted, without rewriting it.
+        """
+        style = ''.join(self._style) if self._style is not None else ''
+        self._style = None
+        return self._flush() + style + self.rawdata
+
+    def _end_style(self):
+        css = ''.join(self._style)
+        self._style = None
+        return rewrite_css_text(css, self.base_url, self.base_domain)
+
+    def _rewrite_kinds(self, tag, attrs):
+        # Kinds of the attributes of this tag that need rewriting
+        kinds = {}
+        for name, value in attrs:
+            if value is None:
+                continue
+            if name == 'style':
+                lowered = value.lower()
+                if 'url(' in lowered or '@import' in lowered:
+                    kinds[name] = 'css'
+        for name, kind in REWRITE_ATTRIBUTES.get(tag, ()):
+            kinds[name] = kind
+        if tag == 'meta' and not is_refresh_meta(dict(attrs)):
+            return {name: kind for name, kind in kinds.items() if kind != 'refresh'}
+        return kinds
+
+    def _start(self, tag, attrs, self_closing):
+        # <html> の直後に <head> が無ければ作成する
+        if self._head_pending and tag != 'head':
+            self._emit_head()
+
+        if tag == 'base' and not self._base_seen:
+            # Only the first <base href> counts, resolved against the document URL
+            href = dict(attrs).get('href')
+            if href is not None:
+                self.base_url = urljoin(self.original_url, href.strip())
+                self._base_seen = True
+
+        if self.resources is not None and tag in SUBRESOURCE_TAGS:
+            self._note_resource(tag, dict(attrs))
+
+        kinds = self._rewrite_kinds(tag, attrs)
+        if any(value is not None and name in kinds for name, value in attrs):
+            parts = ['<', tag]
+            for name, value in attrs:
+                if value is None:
+                    parts.append(f' {name}')
+                    continue
+                kind = kinds.get(name)
+                if kind is not None:
+                    value = rewrite_attribute(kind, value, self.base_url, self.base_domain)
+                parts.append(f' {name}="{escape(value, quote=True)}"')
+            parts.append(' />' if self_closing else '>')
+            self._out.append(''.join(parts))
+        else:
+            self._out.append(self.get_starttag_text())
+
+        if tag == 'head' and not self._head_done:
+            self._out.append(CSP_META_TAG)
+            self._head_pending = False
+            self._head_done = True
+        elif tag == 'html' and not self._head_done:
+            self._head_pending = True
+
+    def _note_resource(self, tag, attrs):
+        found = subresource(tag, attrs)
+        if found is not None and attrs.get(found[0]):
+            self.resources.append((found[1], urljoin(self.base_url, attrs[found[0]].strip())))
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs, False)
+        if tag == 'style':
+            self._style = []
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        if tag == 'style' and self._style is not None:
+            self._out.append(self._end_style())
+        self._out.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self._style is not None:
+            self._style.append(data)
+        else:
+            self._out.append(data)
+
+    def handle_entityref(self, name):
+        self._out.append(f'&{name};')
+
+    def handle_charref(self, name):
+        self._out.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        self._out.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self._out.append(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self._out.append(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        self._out.append(f'<![{data}]>')
+
+def _encode_html_errors(error):
+    # Undecodable input bytes (kept by surrogateescape) go back out unchanged.
+    # Other characters the charset cannot hold, e.g. from attribute values
+    # the parser unescaped, become character references.
+    char = error.object[error.start]
+    if '\udc80' <= char <= '\udcff':
+        return bytes([ord(char) - 0xdc00]), error.start + 1
+    return f'&#{ord(char)};', error.start + 1
+
+codecs.register_error('mais.html', _encode_html_errors)
+
+class IncrementalHTMLRewriter:
+    """
+    Push-style wrapper around StreamingHTMLRewriter working on bytes.
+
+    Buffers the first CHARSET_SNIFF_SIZE bytes to detect the charset, then
+    returns rewritten output for every chunk fed in. Usable from both
+    generator (sync) and asyncio code.
+    """
+
+    def __init__(self, original_url, base_domain, content_type=None, resources=None):
+        self.content_type = content_type
+        self.charset = None
+        self._head = b''
+        self._decoder = None
+        self._failed = False
+        self._rewriter = StreamingHTMLRewriter(original_url, base_domain, resources)
+
+    def feed(self, chunk):
+        """
+        Feeds a chunk of the document and returns the output available so far.
+        """
+        if self._failed:
+            return chunk
+        if self._decoder is None:
+            # 文字コード判定のために先頭部分だけ溜める
+            self._head += chunk
+            if len(self._head) < CHARSET_SNIFF_SIZE:
+                return b''
+            chunk, self._head = self._head, b''
+            self._start(chunk)
+        return self._process(chunk, final=False)
+
+    def close(self):
+        """
+        Flushes the rest of the document.
+        """
+        if self._failed:
+            return b''
+        if self._decoder is None:
+            chunk, self._head = self._head, b''
+            self._start(chunk)
+        else:
+            chunk = b''
+        return self._process(chunk, final=True)
+
+    def _start(self, head):
+        self.charset = detect_charset(self.content_type, head[:CHARSET_SNIFF_SIZE])
+        # surrogateescape keeps undecodable bytes intact on the way back out
+        self._decoder = codecs.getincrementaldecoder(self.charset)(errors='surrogateescape')
+
+    def _process(self, chunk, final):
+        out = ''
+        try:
+            out = self._rewriter.rewrite(self._decoder.decode(chunk, final=final))
+            if final:
+                out += self._rewriter.finish()
+        except Exception as e:
+            # Fall back to passing the rest of the document through untouched,
+            # keeping what was already rewritten
+            logger.exception("Error rewriting HTML stream: %s", e)
+            self._failed = True
+            out += self._rewriter.pending_text()
+            return out.encode(self.charset, 'mais.html') + self._decoder.getstate()[0]
+        return out.encode(self.charset, 'mais.html')
+
+def rewrite_html_stream(chunks, original_url, base_domain, content_type=None, resources=None):
+    """
+    Rewrites an HTML document incrementally.
+
+    Args:
+        chunks (iterable): The document body as an iterable of bytes
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy server
+        content_type (str): The Content-Type header value, used for the charset
+        resources (list): If given, discovered sub-resources are appended to it
+
+    Yields:
+        bytes: Rewritten output, encoded in the document's own charset
+    """
+    rewriter = IncrementalHTMLRewriter(original_url, base_domain, content_type, resources)
+    for chunk in chunks:
+        out = rewriter.feed(chunk)
+        if out:
+            yield out
+    out = rewriter.close()
+    if out:
+        yield out
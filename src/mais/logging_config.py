@@ -0,0 +1,52 @@
+import logging
+import os
+import random
+
+# ルートロガーのレベル（DEBUG / INFO / WARNING / ERROR）
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# プロキシ経路のアクセスログを出力する割合（0.0〜1.0）
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get("ACCESS_LOG_SAMPLE_RATE", "0.01"))
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# 上流へのリクエストごとにURL付きでINFOログを出すライブラリ（ASGIモードのhttpx）
+# サンプリングされず、トークンで隠している上流のURLがそのまま残るため警告以上だけを出す
+QUIET_LOGGERS = ("httpx", "httpcore")
+
+access_logger = logging.getLogger("mais.access")
+
+def configure_logging(level=None):
+    """
+    アプリケーション全体のログ設定を行う関数
+
+    ルートロガーに既にハンドラーがある場合（gunicornなど）はレベルだけ設定する。
+    QUIET_LOGGERS はLOG_LEVELに関わらずWARNING以上だけを出す。
+
+    Args:
+        level (str): ログレベル（省略時は環境変数LOG_LEVEL）
+    """
+    level = (level or LOG_LEVEL).upper()
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=level, format=LOG_FORMAT)
+    else:
+        root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+def log_access_sampled(method, path, status_code, duration):
+    """
+    アクセスログをサンプリングして出力する関数
+
+    Args:
+        method (str): HTTPメソッド
+        path (str): リクエストパス
+        status_code (int): レスポンスのステータスコード
+        duration (float): 処理時間（秒）
+    """
+    if ACCESS_LOG_SAMPLE_RATE <= 0 or not access_logger.isEnabledFor(logging.INFO):
+        return
+    if ACCESS_LOG_SAMPLE_RATE < 1 and random.random() >= ACCESS_LOG_SAMPLE_RATE:
+        return
+    access_logger.info("%s %s %d %.1fms", method, path, status_code, duration * 1000)
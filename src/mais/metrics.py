@@ -0,0 +1,370 @@
+"""
+プロキシ経路の計測（Prometheus形式のメトリクスとServer-Timingヘッダー）
+
+各ワーカーはプロセス内でカウンターとヒストグラムを集計し、一定間隔で
+METRICS_DIR/<pid>-<起動時刻>.json に書き出す。/metrics はこのディレクトリの全ワーカー分を
+合算して返すため、gunicornの複数ワーカー構成でもどのワーカーが応答しても
+同じ値になる（他ワーカーの値は最大 METRICS_FLUSH_INTERVAL 秒遅れる）。
+"""
+
+import atexit
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from src.mais.private_files import CACHE_HOME, make_private_dir, open_private
+
+logger = logging.getLogger(__name__)
+
+# メトリクスの集計（'0'で無効）
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+
+# /metrics の取得に必要なトークン（"Authorization: Bearer <トークン>"）
+# hostラベルからプロキシ経由で閲覧されたオリジンが分かるため、未設定の場合は /metrics を公開しない
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# ワーカーごとの集計結果を置くディレクトリ（全ワーカーで共有）
+# 他のユーザーがファイルを置けないよう、自分が所有し他から書き込めないディレクトリでなければ使わない
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(CACHE_HOME, "metrics")
+
+# 集計結果をファイルへ書き出す間隔（秒）
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+# 終了したワーカーのファイルを削除するまでの時間（秒）
+METRICS_DEAD_WORKER_TTL = 24 * 60 * 60
+
+# host ラベルに使う上流ホスト数の上限（超えた分は 'other'）
+METRICS_MAX_HOSTS = int(os.environ.get("METRICS_MAX_HOSTS", "100"))
+
+# レスポンスにServer-Timingヘッダーを付ける（'0'で無効）
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "1") != "0"
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# ヒストグラムのバケット（秒）
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# メトリクス名 -> (種類, 説明)
+METRICS = {
+    'mais_requests_total': ('counter', 'Requests handled, by route and status.'),
+    'mais_request_seconds': ('histogram', 'Request time including the response body, by route.'),
+    'mais_stage_seconds': ('histogram', 'Time spent in each stage of the proxy route.'),
+    'mais_upstream_responses_total': ('counter', 'Upstream responses, by host and status.'),
+    'mais_bytes_total': ('counter', 'Body bytes received from upstream (in) and sent to clients (out).'),
+    'mais_response_cache_total': ('counter', 'Response cache lookups, by result.'),
+    'mais_rewrite_cache_total': ('counter', 'Rewritten-body cache lookups, by result.'),
+    'mais_rewrite_cache_cpu_seconds_total': ('counter', 'CPU seconds spent rewriting and saved by the rewrite cache.'),
+    'mais_coalesced_requests_total': ('counter', 'Proxy requests that led, shared or could not share a concurrent fetch.'),
+    'mais_rejected_tokens_total': ('counter', 'Encoded ids rejected without proxying, by reason.'),
+    'mais_compression_bytes_total': ('counter', 'Rewritten bytes before (in) and after (out) compression, by encoding.'),
+    'mais_prefetch_total': ('counter', 'Background sub-resource fetches, by result.'),
+    'mais_dns_lookups_total': ('counter', 'Upstream host name lookups, by DNS cache result.'),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_hosts = set()
+_last_flush = 0.0
+_dir_ready = False
+_worker = None
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """
+    Adds value to a counter.
+    """
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """
+    Records one observation in a histogram.
+    """
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+def host_label(host):
+    """
+    Returns host, or 'other' once METRICS_MAX_HOSTS distinct hosts have been seen.
+    """
+    with _lock:
+        if host in _hosts:
+            return host
+        if len(_hosts) < METRICS_MAX_HOSTS:
+            _hosts.add(host)
+            return host
+    return 'other'
+
+class RequestTimer:
+    """
+    Collects per-stage durations of one request.
+
+    Each stage is recorded in the mais_stage_seconds histogram as soon as it
+    ends; server_timing() lists the stages finished so far.
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    def add(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+        observe('mais_stage_seconds', seconds, stage=stage)
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def server_timing(self):
+        """
+        Returns the Server-Timing header value (milliseconds), or None.
+        """
+        if not SERVER_TIMING_ENABLED or not self.durations:
+            return None
+        return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in self.durations.items())
+
+def timed_iter(chunks, timer, stage, exclude=None, direction=None):
+    """
+    Yields from chunks, recording the time spent producing them as one stage.
+
+    Args:
+        chunks (iterable): The chunks to pass through
+        timer (RequestTimer): The request's timer
+        stage (str): The stage name
+        exclude (str | tuple): Nested stage(s) whose time (spent in the same period) is subtracted
+        direction (str): If given, the chunk sizes are added to mais_bytes_total{direction}
+    """
+    chunks = iter(chunks)
+    elapsed = 0.0
+    size = 0
+    excludes = (exclude,) if isinstance(exclude, str) else tuple(exclude or ())
+    excluded = sum(timer.durations.get(name, 0.0) for name in excludes)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            size += len(chunk)
+            yield chunk
+    finally:
+        if excludes:
+            elapsed -= sum(timer.durations.get(name, 0.0) for name in excludes) - excluded
+        timer.add(stage, max(elapsed, 0.0))
+        if direction:
+            inc('mais_bytes_total', size, direction=direction)
+
+async def atimed_iter(chunks, timer, stage, direction=None):
+    """
+    Async counterpart of timed_iter for async iterables.
+    """
+    chunks = chunks.__aiter__()
+    elapsed = 0.0
+    size = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            size += len(chunk)
+            yield chunk
+    finally:
+        timer.add(stage, elapsed)
+        if direction:
+            inc('mais_bytes_total', size, direction=direction)
+
+def write_iter(chunks, timer):
+    """
+    Yields the response body to the server, recording the time the server
+    spends writing it ('write' stage) and the bytes sent.
+    """
+    elapsed = 0.0
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            start = time.perf_counter()
+            yield chunk
+            elapsed += time.perf_counter() - start
+    finally:
+        timer.add('write', elapsed)
+        inc('mais_bytes_total', size, direction='out')
+
+def _snapshot():
+    with _lock:
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), list(h[0]), h[1], h[2]] for (name, labels), h in _histograms.items()],
+        }
+
+def _check_dir():
+    # 所有者・権限が不正なディレクトリには書き込まず、中のファイルも合算しない
+    global _dir_ready
+    if not _dir_ready:
+        make_private_dir(METRICS_DIR)
+        _dir_ready = True
+
+def _own_name():
+    # PIDは再利用されるため、起動時刻と組み合わせて終了したワーカーのファイルと区別する
+    # （fork後の子プロセスでは最初の呼び出し時に作り直す）
+    global _worker
+    pid = os.getpid()
+    if _worker is None or _worker[0] != pid:
+        _worker = (pid, f'{pid}-{time.time_ns()}.json')
+    return _worker[1]
+
+def flush():
+    """
+    Writes this worker's metrics to METRICS_DIR.
+    """
+    global _last_flush
+    if not METRICS_ENABLED:
+        return
+    _last_flush = time.monotonic()
+    path = os.path.join(METRICS_DIR, _own_name())
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        _check_dir()
+        with open_private(tmp_path) as f:
+            f.write(json.dumps(_snapshot()).encode())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not write metrics to %s: %s", path, e)
+
+def maybe_flush():
+    """
+    Calls flush() if METRICS_FLUSH_INTERVAL has passed since the last one.
+    """
+    if METRICS_ENABLED and time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        flush()
+
+atexit.register(flush)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _load_other_workers():
+    # 他ワーカーのファイルを読み込む（自分の分はメモリ上の最新値を使う）
+    snapshots = []
+    try:
+        _check_dir()
+        names = os.listdir(METRICS_DIR)
+    except OSError as e:
+        logger.warning("Could not read metrics from %s: %s", METRICS_DIR, e)
+        return snapshots
+    own = _own_name()
+    now = time.time()
+    for name in names:
+        if not name.endswith('.json') or name == own:
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            pid = int(name.split('-', 1)[0])
+            if not _pid_alive(pid) and now - os.path.getmtime(path) > METRICS_DEAD_WORKER_TTL:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (ValueError, OSError) as e:
+            logger.debug("Skipping metrics file %s: %s", path, e)
+    return snapshots
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def is_authorized(authorization):
+    """
+    /metrics の取得を許可するかを判定する関数
+    
+    Args:
+        authorization (str): リクエストのAuthorizationヘッダー（無い場合はNone）
+        
+    Returns:
+        bool: 集計が有効で、METRICS_TOKENが設定されていて一致する場合はTrue
+    """
+    if not METRICS_ENABLED or not METRICS_TOKEN or not authorization:
+        return False
+    scheme, _, token = authorization.partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.strip().encode(), METRICS_TOKEN.encode())
+
+def render():
+    """
+    Returns the metrics of all workers in the Prometheus text format.
+    """
+    counters = {}
+    histograms = {}
+    for snapshot in [_snapshot()] + _load_other_workers():
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, total, count in snapshot['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged = histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+            merged[2] += count
+
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for (name, labels), value in histograms.items():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text = METRICS.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name[name]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+            buckets, total, count = value
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,267 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from src.mais import coalescing, metrics, response_cache
+
+logger = logging.getLogger(__name__)
+
+# Fetch the sub-resources of rewritten HTML into the response cache in the background ('1' to enable)
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "0") == "1"
+
+# Background fetches running at once, in total and per origin
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "4"))
+PREFETCH_PER_ORIGIN = int(os.environ.get("PREFETCH_PER_ORIGIN", "2"))
+
+# Queued URLs beyond this are dropped rather than fetched late
+PREFETCH_MAX_QUEUE = int(os.environ.get("PREFETCH_MAX_QUEUE", "256"))
+
+# Sub-resources prefetched per page, in document order
+PREFETCH_MAX_PER_PAGE = int(os.environ.get("PREFETCH_MAX_PER_PAGE", "32"))
+
+# Request destinations (link 'as' values) worth prefetching
+PREFETCH_DESTINATIONS = ('style', 'script', 'image', 'font')
+
+# Send 'Link: rel=preload' for the critical sub-resources of cached pages ('0' to disable)
+PRELOAD_LINKS_ENABLED = os.environ.get("PRELOAD_LINKS_ENABLED", "1") != "0"
+
+# Preload links per response (the header is sent before anything else, so keep it short)
+PRELOAD_MAX_LINKS = int(os.environ.get("PRELOAD_MAX_LINKS", "8"))
+
+# Render-blocking destinations that get preload links
+PRELOAD_DESTINATIONS = ('style', 'script')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Route URLs (see _route_url) queued or being fetched, to drop duplicates
+_queued = set()
+_queued_lock = threading.Lock()
+
+# Origin -> semaphore limiting the fetches to that origin
+_origin_slots = OrderedDict()
+_origin_lock = threading.Lock()
+
+def new_resource_list():
+    """
+    Returns a list for the rewriters to collect sub-resources into, or None
+    if neither prefetching nor preload links are enabled.
+    """
+    if PREFETCH_ENABLED or PRELOAD_LINKS_ENABLED:
+        return []
+    return None
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+        return _executor
+
+def _origin_slot(url):
+    origin = urlparse(url).netloc
+    with _origin_lock:
+        slot = _origin_slots.get(origin)
+        if slot is None:
+            slot = _origin_slots[origin] = threading.BoundedSemaphore(PREFETCH_PER_ORIGIN)
+            # Only the most recent origins are kept; a dropped one just gets a new semaphore
+            if len(_origin_slots) > PREFETCH_MAX_QUEUE:
+                _origin_slots.popitem(last=False)
+        else:
+            _origin_slots.move_to_end(origin)
+        return slot
+
+def _route_url(url):
+    """
+    Returns the URL the redirect route will decode for the proxied link to url.
+
+    The response cache is keyed by that URL, so the prefetched entry is
+    found by the browser's follow-up request.
+    """
+    from src.mais.proxy_utils import LINK_TOKEN_MODE
+    from src.mais.url_crypto import decode_url, encode_origin_relative, encode_url
+
+    encoded_id = None
+    if LINK_TOKEN_MODE == 'origin':
+        encoded_id = encode_origin_relative(url)
+    if encoded_id is None:
+        encoded_id = encode_url(url)
+    if encoded_id is None:
+        return None
+    return decode_url(encoded_id)
+
+def _unique(resources, destinations, limit):
+    seen = set()
+    for destination, url in resources:
+        if len(seen) >= limit:
+            break
+        if destination not in destinations or url in seen or not url.startswith(('http://', 'https://')):
+            continue
+        seen.add(url)
+        yield destination, url
+
+def schedule(resources, base_domain, limit=PREFETCH_MAX_PER_PAGE):
+    """
+    Queues the sub-resources of a rewritten page for fetching into the response cache.
+
+    Only resources the browser will request next (stylesheets, scripts,
+    images and preloaded fonts) are fetched, at most limit of them.
+    Resources already queued, cached or being fetched by a request are
+    skipped. Nothing is fetched if the response cache is disabled.
+
+    Args:
+        resources (list): (destination, URL) pairs collected while rewriting
+        base_domain (str): The base domain of our proxy server
+        limit (int): The maximum number of resources to consider
+
+    Returns:
+        int: The number of resources considered, counting against limit
+    """
+    if not PREFETCH_ENABLED or not resources or limit <= 0 or response_cache.get_cache() is None:
+        return 0
+    selected = list(_unique(resources, PREFETCH_DESTINATIONS, limit))
+    for _destination, url in selected:
+        try:
+            url = _route_url(url)
+        except Exception as e:
+            logger.debug("Could not encode %s for prefetching: %s", url, e)
+            continue
+        if url is None:
+            continue
+        with _queued_lock:
+            if url in _queued:
+                continue
+            if len(_queued) >= PREFETCH_MAX_QUEUE:
+                metrics.inc('mais_prefetch_total', result='dropped')
+                break
+            _queued.add(url)
+        _get_executor().submit(_run, url, base_domain)
+    return len(selected)
+
+def iter_schedule(chunks, resources, base_domain):
+    """
+    Passes rewritten chunks through, queueing the sub-resources found in each
+    chunk before the chunk is sent, so the fetches start ahead of the
+    browser's own requests for them.
+
+    Args:
+        chunks (iterable): The rewritten body
+        resources (list): The list the rewriter appends sub-resources to
+        base_domain (str): The base domain of our proxy server
+
+    Yields:
+        bytes: The chunks, unchanged
+    """
+    if not PREFETCH_ENABLED or resources is None:
+        yield from chunks
+        return
+    done = 0
+    budget = PREFETCH_MAX_PER_PAGE
+    for chunk in chunks:
+        if len(resources) > done:
+            budget -= schedule(resources[done:], base_domain, budget)
+            done = len(resources)
+        yield chunk
+
+async def aiter_schedule(chunks, resources, base_domain):
+    """
+    Async counterpart of iter_schedule.
+    """
+    done = 0
+    budget = PREFETCH_MAX_PER_PAGE
+    async for chunk in chunks:
+        if PREFETCH_ENABLED and resources is not None and len(resources) > done:
+            budget -= schedule(resources[done:], base_domain, budget)
+            done = len(resources)
+        yield chunk
+
+def _run(url, base_domain):
+    try:
+        result = _prefetch(url, base_domain)
+    except Exception as e:
+        logger.debug("Prefetch of %s failed: %s", url, e)
+        result = 'error'
+    finally:
+        with _queued_lock:
+            _queued.discard(url)
+    metrics.inc('mais_prefetch_total', result=result)
+
+def _prefetch(url, base_domain):
+    from src.mais import compression, rewrite_cache
+    from src.mais.content_processor import get_content_kind
+    from src.mais.proxy_utils import BODY_CHUNK_SIZE, check_content_length, get_body_limit, iter_limited, request_upstream
+
+    # Looked up without lookup() so prefetching does not count as cache traffic
+    cache = response_cache.get_cache()
+    if cache is None:
+        return 'skipped'
+    entry = cache.get(response_cache.cache_key(url, base_domain))
+    if entry is not None and entry['expires_at'] > time.time():
+        return 'cached'
+
+    # A request for the same URL is already fetching it
+    flight, is_leader = coalescing.flights.join((url, base_domain))
+    if flight is not None and not is_leader:
+        return 'skipped'
+
+    stored = False
+    try:
+        with _origin_slot(url):
+            upstream = request_upstream(
+                url, headers={'Accept-Encoding': compression.UPSTREAM_ACCEPT_ENCODING}, stream=True)
+            try:
+                if upstream.status_code != 200:
+                    return 'skipped'
+                content_type = upstream.headers.get('Content-Type', 'text/html')
+                content_kind = get_content_kind(content_type)
+                body_limit = get_body_limit(content_type)
+                check_content_length(upstream.headers, body_limit, url)
+                if content_kind is None:
+                    # Stored as the origin sent it, like the passthrough route does
+                    limit = min(body_limit or response_cache.RESPONSE_CACHE_MAX_ENTRY_BYTES,
+                                response_cache.RESPONSE_CACHE_MAX_ENTRY_BYTES)
+                    check_content_length(upstream.headers, limit, url)
+                    body = b''.join(iter_limited(
+                        upstream.raw.stream(BODY_CHUNK_SIZE, decode_content=False), limit, url))
+                    entry = response_cache.make_entry(200, upstream.headers, body)
+                    stored = response_cache.store(url, base_domain, 200, upstream.headers, body)
+                else:
+                    body = b''.join(iter_limited(upstream.iter_content(BODY_CHUNK_SIZE), body_limit, url))
+                    body = rewrite_cache.rewrite(body, content_type, url, base_domain)
+                    entry = response_cache.make_entry(200, upstream.headers, body, rewritten=True)
+                    stored = response_cache.store(url, base_domain, 200, upstream.headers, body, rewritten=True)
+            finally:
+                upstream.close()
+        if flight is not None:
+            flight.publish_entry(entry)
+    finally:
+        if flight is not None:
+            flight.abandon()
+    return 'stored' if stored else 'skipped'
+
+def preload_links(resources, base_domain):
+    """
+    Builds a Link header preloading the critical sub-resources of a page.
+
+    Args:
+        resources (list): (destination, URL) pairs collected while rewriting
+        base_domain (str): The base domain of our proxy server
+
+    Returns:
+        str: The header value, or None if there is nothing to preload
+    """
+    from src.mais.proxy_utils import get_proxy_urls
+
+    if not PRELOAD_LINKS_ENABLED or not resources:
+        return None
+    selected = list(_unique(resources, PRELOAD_DESTINATIONS, PRELOAD_MAX_LINKS))
+    if not selected:
+        return None
+    proxy_urls = get_proxy_urls(selected[0][1], base_domain, [url for _destination, url in selected])
+    return ', '.join(
+        f'<{proxy_url}>; rel=preload; as={destination}'
+        for (destination, _url), proxy_url in zip(selected, proxy_urls)
+    )
@@ -0,0 +1,38 @@
+import os
+import stat
+
+# Base directory of the files shared by the workers on a host (disk caches, metrics);
+# must be owned by this user and not writable by others
+CACHE_HOME = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "mais")
+
+def make_private_dir(directory):
+    """
+    Creates directory with mode 0700 if needed and checks that other local
+    users cannot plant or replace files in it.
+
+    Raises:
+        PermissionError: If the directory belongs to another user or is
+            writable by group or others
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(
+            f"Directory {directory} must be owned by this user and not writable by group or others")
+
+def open_private(path):
+    """
+    Opens a new file for writing with mode 0600, never following a symlink.
+
+    A file left at path by a writer that crashed is replaced.
+
+    Returns:
+        file: The file, opened in binary mode
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+    try:
+        fd = os.open(path, flags, 0o600)
+    except FileExistsError:
+        os.remove(path)
+        fd = os.open(path, flags, 0o600)
+    return open(fd, 'wb')
@@ -1,12 +1,315 @@
 import logging
+import os
+import threading
+import time
+import socket
+import sys
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin, urlparse
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+from src.mais import dns_cache, metrics
+from src.mais.compression import UPSTREAM_ACCEPT_ENCODING
 
 logger = logging.getLogger(__name__)
 
 # Timeout for HTTP requests (in seconds)
 REQUEST_TIMEOUT = 10
 
+# Upstream connection pool settings (per worker process)
+# POOL_CONNECTIONS: number of distinct origins whose pools are kept alive
+# POOL_MAXSIZE: maximum number of keep-alive connections per origin
+# POOL_IDLE_TIMEOUT: seconds after which an unused session is discarded
+POOL_CONNECTIONS = int(os.environ.get("UPSTREAM_POOL_CONNECTIONS", "32"))
+POOL_MAXSIZE = int(os.environ.get("UPSTREAM_POOL_MAXSIZE", "10"))
+POOL_IDLE_TIMEOUT = float(os.environ.get("UPSTREAM_POOL_IDLE_TIMEOUT", "60"))
+
+# Headers sent to the origin to mimic a browser
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'ja,en-US;q=0.7,en;q=0.3',
+    # Every encoding we can decode; the proxy routes narrow this to what the client accepts
+    'Accept-Encoding': UPSTREAM_ACCEPT_ENCODING,
+}
+
+# HSTS-like memory of which hosts accept the HTTP -> HTTPS upgrade (seconds)
+HTTPS_UPGRADE_TTL = float(os.environ.get("HTTPS_UPGRADE_TTL", "86400"))
+HTTPS_FAILURE_TTL = float(os.environ.get("HTTPS_FAILURE_TTL", "600"))
+HTTPS_UPGRADE_CACHE_SIZE = 4096
+
+# Maximum upstream body size per content kind (bytes, 0 = unlimited).
+# HTML/CSS is decoded and rewritten, so it gets tight limits; other content
+# is streamed through with constant memory and is unlimited by default.
+MAX_BODY_BYTES = {
+    'html': int(os.environ.get("MAX_HTML_BODY_BYTES", str(16 * 1024 * 1024))),
+    'css': int(os.environ.get("MAX_CSS_BODY_BYTES", str(4 * 1024 * 1024))),
+    None: int(os.environ.get("MAX_OTHER_BODY_BYTES", "0")),
+}
+
+# Limit for bodies that have to be buffered whole (fetch_content) when their kind is unlimited
+MAX_BUFFERED_BODY_BYTES = int(os.environ.get("MAX_BUFFERED_BODY_BYTES", str(64 * 1024 * 1024)))
+
+# Chunk size used when reading bodies to buffer them
+BODY_CHUNK_SIZE = 64 * 1024
+
+class BodyTooLargeError(Exception):
+    """
+    Raised when an upstream body exceeds the limit for its content type.
+    """
+
+    def __init__(self, url, limit, size):
+        super().__init__(f"Upstream body of {url} exceeds the limit of {limit} bytes ({size} bytes)")
+        self.url = url
+        self.limit = limit
+        self.size = size
+
+_session = None
+_session_pid = None
+_session_last_used = 0.0
+_session_lock = threading.Lock()
+
+class _UpstreamConnectionMixin:
+    """
+    Opens sockets through the DNS cache, racing IPv6 and IPv4 addresses.
+    """
+
+    def _new_conn(self):
+        # Same error mapping as urllib3's own _new_conn
+        try:
+            sock = dns_cache.create_connection(
+                (self._dns_host, self.port),
+                self.timeout,
+                source_address=self.source_address,
+                socket_options=self.socket_options,
+                family=allowed_gai_family(),
+            )
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        except TimeoutError as e:
+            raise ConnectTimeoutError(
+                self, f"Connection to {self.host} timed out. (connect timeout={self.timeout})") from e
+        except OSError as e:
+            raise NewConnectionError(self, f"Failed to establish a new connection: {e}") from e
+        sys.audit("http.client.connect", self, self.host, self.port)
+        return sock
+
+class _UpstreamHTTPConnection(_UpstreamConnectionMixin, HTTPConnection):
+    pass
+
+class _UpstreamHTTPSConnection(_UpstreamConnectionMixin, HTTPSConnection):
+    pass
+
+class _UpstreamHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _UpstreamHTTPConnection
+
+class _UpstreamHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _UpstreamHTTPSConnection
+
+class UpstreamAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose direct connections use the DNS cache and happy eyeballs.
+
+    Connections through an HTTP(S)_PROXY are left to urllib3.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _UpstreamHTTPConnectionPool,
+            'https': _UpstreamHTTPSConnectionPool,
+        }
+
+def _create_session():
+    """
+    Creates a requests session backed by keep-alive connection pools.
+    """
+    session = requests.Session()
+    adapter = UpstreamAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, pool_block=False)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    return session
+
+def get_session():
+    """
+    Returns the shared upstream session for the current worker process.
+    
+    The session is created lazily and re-created after a fork (gunicorn
+    preloading) or when it has been idle longer than POOL_IDLE_TIMEOUT,
+    so that stale keep-alive sockets are not reused.
+    
+    Returns:
+        requests.Session: The pooled session
+    """
+    global _session, _session_pid, _session_last_used
+    
+    with _session_lock:
+        now = time.monotonic()
+        pid = os.getpid()
+        
+        if _session is not None and (_session_pid != pid or now - _session_last_used > POOL_IDLE_TIMEOUT):
+            # Drop connections inherited from the parent or left idle too long
+            if _session_pid == pid:
+                _session.close()
+            _session = None
+            
+        if _session is None:
+            _session = _create_session()
+            _session_pid = pid
+            
+        _session_last_used = now
+        return _session
+
+# host -> (supports_https, expires_at)
+_https_hosts = {}
+_https_hosts_lock = threading.Lock()
+
+def get_https_support(host):
+    """
+    Returns the cached HTTPS upgrade result for a host.
+    
+    Args:
+        host (str): The host (netloc) of the URL
+        
+    Returns:
+        bool or None: True/False if known, None if unknown or expired
+    """
+    with _https_hosts_lock:
+        entry = _https_hosts.get(host)
+        if entry is None:
+            return None
+        supports_https, expires_at = entry
+        if expires_at < time.monotonic():
+            del _https_hosts[host]
+            return None
+        return supports_https
+
+def set_https_support(host, supports_https):
+    """
+    Remembers whether a host accepted the HTTPS upgrade.
+    
+    Args:
+        host (str): The host (netloc) of the URL
+        supports_https (bool): Whether the HTTPS request succeeded
+    """
+    ttl = HTTPS_UPGRADE_TTL if supports_https else HTTPS_FAILURE_TTL
+    with _https_hosts_lock:
+        if len(_https_hosts) >= HTTPS_UPGRADE_CACHE_SIZE and host not in _https_hosts:
+            # Evict the oldest inserted entry to keep the table bounded
+            _https_hosts.pop(next(iter(_https_hosts)))
+        _https_hosts[host] = (supports_https, time.monotonic() + ttl)
+
+def record_upstream_response(url, status):
+    """
+    Counts an upstream response (or 'error') in mais_upstream_responses_total.
+    """
+    metrics.inc('mais_upstream_responses_total', host=metrics.host_label(urlparse(url).hostname or ''), status=str(status))
+
+def request_upstream(url, **kwargs):
+    """
+    Sends a GET request to the origin, upgrading HTTP URLs to HTTPS when possible.
+    
+    An http: URL is first tried over HTTPS and the HTTPS response is returned
+    directly when it succeeds, so the resource is never downloaded twice.
+    The per-host outcome is cached so later requests skip the probe.
+    
+    Args:
+        url (str): The http(s) URL to fetch
+        **kwargs: Extra keyword arguments passed to requests.Session.get
+        
+    Returns:
+        requests.Response: The upstream response
+    """
+    try:
+        response = _request_upstream(url, **kwargs)
+    except Exception:
+        record_upstream_response(url, 'error')
+        raise
+    record_upstream_response(url, response.status_code)
+    return response
+
+def _request_upstream(url, **kwargs):
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    kwargs.setdefault('allow_redirects', True)
+    session = get_session()
+    
+    if url.startswith('http:'):
+        host = urlparse(url).netloc
+        supports_https = get_https_support(host)
+        
+        if supports_https is not False:
+            https_url = url.replace('http:', 'https:', 1)
+            logger.debug("Trying to upgrade HTTP URL to HTTPS: %s", https_url)
+            
+            try:
+                response = session.get(https_url, **kwargs)
+                if supports_https is None:
+                    set_https_support(host, True)
+                return response
+            except requests.RequestException:
+                # If HTTPS failed, continue with the original HTTP URL
+                logger.debug("HTTPS upgrade failed, falling back to original URL: %s", url)
+                set_https_support(host, False)
+                
+    return session.get(url, **kwargs)
+
+def get_body_limit(content_type):
+    """
+    Returns the maximum body size for a Content-Type (0 = unlimited).
+    """
+    from src.mais.content_processor import get_content_kind
+    
+    return MAX_BODY_BYTES.get(get_content_kind(content_type), 0)
+
+def check_body_size(size, limit, url):
+    """
+    Raises BodyTooLargeError if size is over limit (0 = unlimited).
+    """
+    if limit and size > limit:
+        logger.warning("Aborting oversize upstream body: %s (limit %d bytes)", url, limit)
+        raise BodyTooLargeError(url, limit, size)
+
+def check_content_length(headers, limit, url):
+    """
+    Rejects a response up front when its Content-Length is over limit.
+    """
+    try:
+        declared = int(headers.get('Content-Length') or 0)
+    except ValueError:
+        return
+    check_body_size(declared, limit, url)
+
+def iter_limited(chunks, limit, url):
+    """
+    Passes chunks through, raising BodyTooLargeError once more than limit bytes were seen.
+    """
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        check_body_size(size, limit, url)
+        yield chunk
+
+def read_body(chunks, limit, url):
+    """
+    Reads a whole body into memory, stopping as soon as it exceeds the limit.
+    
+    The consumers (the rewriters and BeautifulSoup) need the complete body,
+    so the limit is what bounds memory use.
+    
+    Args:
+        chunks (iterable): The body as an iterable of bytes
+        limit (int): The maximum body size (0 = unlimited)
+        url (str): The URL, for the error message
+        
+    Returns:
+        bytes: The body
+    """
+    return b''.join(iter_limited(chunks, limit, url))
+
 def fetch_content(url):
     """
     Fetches content from the specified URL.
@@ -53,55 +356,58 @@ def fetch_content(url):
                     # Invalid data URI format
                     return f"Invalid data URI format".encode(), 400, 'text/plain'
             except Exception as e:
-                logger.exception(f"Error processing data URI: {str(e)}")
+                logger.exception("Error processing data URI: %s", e)
                 return f"Error processing data URI: {str(e)}".encode(), 500, 'text/plain'
         
-        # Try to upgrade HTTP to HTTPS if needed
-        if url.startswith('http:'):
-            https_url = url.replace('http:', 'https:', 1)
-            logger.debug(f"Trying to upgrade HTTP URL to HTTPS: {https_url}")
-            
-            try:
-                # First try with HTTPS
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                    'Accept-Language': 'ja,en-US;q=0.7,en;q=0.3',
-                }
-                
-                response = requests.get(https_url, headers=headers, timeout=REQUEST_TIMEOUT, allow_redirects=True)
-                
-                # If successful, use the HTTPS URL
-                url = https_url
-                
-            except requests.RequestException:
-                # If HTTPS failed, continue with the original HTTP URL
-                logger.debug(f"HTTPS upgrade failed, falling back to original URL: {url}")
-                
         # Handle regular HTTP/HTTPS requests
         if url.startswith(('http://', 'https://')):
-            # Set up headers to mimic a browser
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'ja,en-US;q=0.7,en;q=0.3',
-            }
+            # Make the request (http: URLs are upgraded to HTTPS when the host supports it)
+            response = request_upstream(url, stream=True)
             
-            # Make the request
-            response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT, allow_redirects=True)
-            
-            # Get content type from headers
-            content_type = response.headers.get('Content-Type', 'text/html')
+            try:
+                # Get content type from headers
+                content_type = response.headers.get('Content-Type', 'text/html')
+                
+                # Read the body within the size limit for its content type
+                limit = get_body_limit(content_type) or MAX_BUFFERED_BODY_BYTES
+                check_content_length(response.headers, limit, url)
+                content = read_body(response.iter_content(BODY_CHUNK_SIZE), limit, url)
+            finally:
+                response.close()
             
-            return response.content, response.status_code, content_type
+            return content, response.status_code, content_type
         else:
             # Unsupported URL scheme
             return f"Unsupported URL scheme: {url.split(':')[0] if ':' in url else 'unknown'}".encode(), 400, 'text/plain'
     
+    except BodyTooLargeError as e:
+        return str(e).encode(), 502, 'text/plain'
     except Exception as e:
-        logger.exception(f"Error fetching content from {url}: {str(e)}")
+        logger.exception("Error fetching content from %s: %s", url, e)
         return f"Error fetching content: {str(e)}".encode(), 500, 'text/plain'
 
+# How rewritten links refer to their target:
+#   'absolute' - one token per full URL: <base_domain><token>
+#   'origin'   - one token per origin plus the raw path: /<origin token>/<path?query>
+LINK_TOKEN_MODE = os.environ.get("LINK_TOKEN_MODE", "absolute")
+
+# URLs with these schemes are left as they are
+PASSTHROUGH_SCHEMES = ('data:', 'javascript:', 'about:', 'blob:', 'mailto:')
+
+def secure_base_domain(base_domain):
+    """
+    Ensures base_domain uses HTTPS only in production environments.
+    """
+    if base_domain.startswith('http:') and not base_domain.startswith('http://localhost') and not base_domain.startswith('http://127.0.0.1'):
+        base_domain = base_domain.replace('http:', 'https:', 1)
+    return base_domain
+
+def _join_proxy_url(base_domain, encoded_id):
+    # Plain concatenation gives the same result as urljoin for the usual 'https://host/' base
+    if base_domain.endswith('/'):
+        return base_domain + encoded_id
+    return urljoin(base_domain, encoded_id)
+
 def get_proxy_url(original_url, base_domain, target_url):
     """
     Converts a URL from the original site to a proxied URL using our custom encoding.
@@ -114,25 +420,61 @@ def get_proxy_url(original_url, base_domain, target_url):
     Returns:
         str: The proxied URL
     """
-    # 特殊なURLスキームはそのまま返す
-    if target_url.startswith(('data:', 'javascript:', 'about:', 'blob:', 'mailto:')):
-        return target_url
-        
-    from url_crypto import encode_url
+    return get_proxy_urls(original_url, base_domain, [target_url])[0]
+
+def get_proxy_urls(original_url, base_domain, target_urls):
+    """
+    Converts many URLs from the same page to proxied URLs in one call.
     
-    # If it's a relative URL, make it absolute first
-    if not target_url.startswith(('http://', 'https://')):
-        target_url = urljoin(original_url, target_url)
+    Args:
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy (e.g., 'http://example.com/')
+        target_urls (list): The URLs to convert to proxied URLs
+        
+    Returns:
+        list: The proxied URLs, in the same order
+    """
+    from src.mais.url_crypto import encode_origin_relative, encode_urls
     
-    # Use our custom encoding to convert the URL to an encoded form
-    encoded_id = encode_url(target_url)
+    base_domain = secure_base_domain(base_domain)
     
-    # Ensure base_domain uses HTTPS only in production environments
-    if base_domain.startswith('http:') and not base_domain.startswith('http://localhost') and not base_domain.startswith('http://127.0.0.1'):
-        base_domain = base_domain.replace('http:', 'https:', 1)
+    # 特殊なURLスキームはそのまま返す
+    absolute_urls = []
+    for target_url in target_urls:
+        if target_url.startswith(PASSTHROUGH_SCHEMES):
+            absolute_urls.append(None)
+        elif target_url.startswith(('http://', 'https://')):
+            absolute_urls.append(target_url)
+        else:
+            # If it's a relative URL, make it absolute first
+            absolute_urls.append(urljoin(original_url, target_url))
     
-    # Create the proxy URL by joining the base domain with the encoded ID
-    proxy_url = urljoin(base_domain, encoded_id)
+    # Use our custom encoding to convert the URLs to an encoded form
+    if LINK_TOKEN_MODE == 'origin':
+        # 同じオリジンのリンクはトークンを共有し、パスだけが変わる（ルート相対で出力する）
+        encoded_ids = []
+        for url in absolute_urls:
+            if url is not None:
+                relative = encode_origin_relative(url)
+                encoded_ids.append(relative if relative is not None else encode_urls([url])[0])
+        base_domain = '/'
+    else:
+        encoded_ids = encode_urls([url for url in absolute_urls if url is not None])
     
-    logger.debug(f"Converted '{target_url}' to proxy URL '{proxy_url}'")
-    return proxy_url
\ No newline at end of file
+    debug = logger.isEnabledFor(logging.DEBUG)
+    proxy_urls = []
+    encoded_iter = iter(encoded_ids)
+    for target_url, absolute_url in zip(target_urls, absolute_urls):
+        if absolute_url is None:
+            proxy_urls.append(target_url)
+            continue
+        encoded_id = next(encoded_iter)
+        if encoded_id is None:
+            proxy_urls.append(target_url)
+            continue
+        # Create the proxy URL by joining the base domain with the encoded ID
+        proxy_url = _join_proxy_url(base_domain, encoded_id)
+        if debug:
+            logger.debug("Converted '%s' to proxy URL '%s'", absolute_url, proxy_url)
+        proxy_urls.append(proxy_url)
+    return proxy_urls
@@ -0,0 +1,484 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from src.mais import metrics
+from src.mais.private_files import CACHE_HOME, make_private_dir, open_private
+
+logger = logging.getLogger(__name__)
+
+# Cache backend: 'memory' (per worker), 'disk' (shared by all workers on the host) or 'none'
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")
+
+# Total size budget of the cache and the largest single entry (bytes)
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(8 * 1024 * 1024)))
+
+# Directory used by the disk backend
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR") or os.path.join(CACHE_HOME, "responses")
+
+# Upper bound for heuristic freshness when only Last-Modified is present (seconds)
+HEURISTIC_MAX_AGE = 24 * 60 * 60
+
+# Bump to invalidate browser copies of rewritten bodies when the rewriting rules change
+REWRITTEN_ETAG_VERSION = 2
+
+# Caching headers forwarded to the client (rewritten bodies drop Last-Modified, see client_validators)
+CLIENT_CACHE_HEADERS = ('Cache-Control', 'Expires', 'Last-Modified')
+
+# Response headers stored with a cached entry
+CACHED_HEADERS = ('Content-Type', 'Content-Encoding', 'ETag', 'Last-Modified', 'Cache-Control', 'Expires')
+
+class MemoryCacheBackend:
+    """
+    In-process LRU cache bounded by the total size of the stored bodies.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        size = len(entry['body'])
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old['body'])
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted['body'])
+
+    def delete(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old['body'])
+
+class DiskCacheBackend:
+    """
+    On-disk cache shared by every worker process on the host.
+
+    Each entry is one file holding a length-prefixed JSON header followed by
+    the raw body, written atomically with os.replace. Nothing is unpickled,
+    and the directory must belong to this user with no group/other write
+    access, so other local users cannot plant entries. Reads touch the
+    file's mtime so eviction can drop the least recently used entries once
+    the directory exceeds max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._written = 0
+        make_private_dir(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.cache')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                size = int.from_bytes(f.read(4), 'big')
+                entry = json.loads(f.read(size))
+                entry['body'] = f.read()
+            os.utime(path)
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Discarding unreadable cache entry {path}: {str(e)}")
+            self.delete(key)
+            return None
+
+    def set(self, key, entry):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        header = json.dumps({name: value for name, value in entry.items() if name != 'body'}).encode()
+        with open_private(tmp_path) as f:
+            f.write(len(header).to_bytes(4, 'big'))
+            f.write(header)
+            f.write(entry['body'])
+        os.replace(tmp_path, path)
+
+        # Only scan the directory once enough new data has been written
+        self._written += len(entry['body'])
+        if self._written > self.max_bytes // 10:
+            self._written = 0
+            self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.cache'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        files.sort()
+        for _, size, name in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def create_backend(backend, directory, max_bytes):
+    """
+    Creates a 'disk' or 'memory' backend, falling back to memory if the
+    disk directory cannot be used safely.
+    """
+    if backend == 'disk':
+        try:
+            return DiskCacheBackend(directory, max_bytes)
+        except OSError as e:
+            logger.error("Disk cache disabled, using memory instead: %s", e)
+    return MemoryCacheBackend(max_bytes)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Returns the configured cache backend, or None when caching is disabled.
+    """
+    global _cache
+    if RESPONSE_CACHE_BACKEND == 'none':
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = create_backend(RESPONSE_CACHE_BACKEND, RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_BYTES)
+        return _cache
+
+def uses_disk():
+    """
+    Returns True if lookups and stores do file I/O, so async callers should
+    run them in a worker thread.
+    """
+    return isinstance(get_cache(), DiskCacheBackend)
+
+def rewrite_settings():
+    """
+    Returns a digest of the settings that change a rewritten body without
+    the upstream body changing: the rewriting rules, the HTML backend, how
+    links refer to their target and the token format and key.
+
+    Returns:
+        str: A hex digest
+    """
+    from src.mais.content_processor import HTML_REWRITER_BACKEND
+    from src.mais.proxy_utils import LINK_TOKEN_MODE
+    from src.mais.url_crypto import token_fingerprint
+    settings = f"{REWRITTEN_ETAG_VERSION}\n{HTML_REWRITER_BACKEND}\n{LINK_TOKEN_MODE}\n{token_fingerprint()}"
+    return hashlib.sha1(settings.encode()).hexdigest()[:16]
+
+def cache_key(url, base_domain):
+    """
+    Builds the cache key for a proxied resource.
+
+    Rewritten bodies embed the proxy's own host and tokens, so the base
+    domain and rewrite_settings() are part of the key.
+
+    Args:
+        url (str): The decoded upstream URL
+        base_domain (str): The base domain of our proxy server
+
+    Returns:
+        str: A hex digest usable as a file name
+    """
+    return hashlib.sha256(f"{rewrite_settings()}\n{base_domain}\n{url}".encode('utf-8', 'surrogatepass')).hexdigest()
+
+def _parse_cache_control(value):
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+def _parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def get_freshness_lifetime(headers, now=None):
+    """
+    Computes how long a response may be served from a shared cache.
+
+    Args:
+        headers (Mapping): The upstream response headers
+        now (float): The current time as a Unix timestamp
+
+    Returns:
+        float or None: Lifetime in seconds (0 means "store but always revalidate"),
+        or None if the response must not be stored
+    """
+    now = time.time() if now is None else now
+    directives = _parse_cache_control(headers.get('Cache-Control'))
+
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return max(0, int(directives[name]))
+            except ValueError:
+                return 0
+
+    if 'Expires' in headers:
+        expires = _parse_http_date(headers['Expires'])
+        if expires is None:
+            return 0
+        date = _parse_http_date(headers.get('Date')) or now
+        return max(0, expires - date)
+
+    # Heuristic freshness (RFC 9111 4.2.2): 10% of the time since last modification
+    if 'Last-Modified' in headers:
+        last_modified = _parse_http_date(headers['Last-Modified'])
+        date = _parse_http_date(headers.get('Date')) or now
+        if last_modified is not None and last_modified < date:
+            return min(HEURISTIC_MAX_AGE, (date - last_modified) / 10)
+        return 0
+
+    if 'ETag' in headers:
+        return 0
+    return None
+
+def lookup(url, base_domain):
+    """
+    Looks up a cached response.
+
+    Args:
+        url (str): The decoded upstream URL
+        base_domain (str): The base domain of our proxy server
+
+    Returns:
+        tuple: (entry, is_fresh), or (None, False) on a miss
+    """
+    cache = get_cache()
+    if cache is None:
+        return None, False
+    entry = cache.get(cache_key(url, base_domain))
+    if entry is None:
+        metrics.inc('mais_response_cache_total', result='miss')
+        return None, False
+    is_fresh = entry['expires_at'] > time.time()
+    metrics.inc('mais_response_cache_total', result='hit' if is_fresh else 'stale')
+    return entry, is_fresh
+
+def make_entry(status_code, upstream_headers, body, rewritten=False, resources=None):
+    """
+    Builds a cache entry without its expiry times.
+
+    Entries are also what concurrent requests share (see coalescing), so
+    anything that can serve a cache hit can serve them.
+
+    Args:
+        status_code (int): The status code served to the client
+        upstream_headers (Mapping): The upstream response headers
+        body (bytes): The body served to the client
+        rewritten (bool): True if body is decoded and rewritten rather than the raw upstream bytes
+        resources (list): Sub-resources of a rewritten HTML body, as (destination, URL)
+
+    Returns:
+        dict: The entry
+    """
+    headers = {name: upstream_headers[name] for name in CACHED_HEADERS if name in upstream_headers}
+    if rewritten:
+        headers.pop('Content-Encoding', None)
+    entry = {
+        'status': status_code,
+        'rewritten': rewritten,
+        'headers': headers,
+        'body': body,
+    }
+    if resources:
+        entry['resources'] = list(resources)
+    return entry
+
+def store(url, base_domain, status_code, upstream_headers, body, rewritten=False, resources=None):
+    """
+    Stores a (possibly rewritten) response body if the upstream headers allow it.
+
+    Args:
+        url (str): The decoded upstream URL
+        base_domain (str): The base domain of our proxy server
+        status_code (int): The status code served to the client
+        upstream_headers (Mapping): The upstream response headers
+        body (bytes): The body served to the client
+        rewritten (bool): True if body is decoded and rewritten rather than the raw upstream bytes
+        resources (list): Sub-resources of a rewritten HTML body, as (destination, URL)
+
+    Returns:
+        bool: True if the response was stored
+    """
+    cache = get_cache()
+    if cache is None or status_code != 200 or len(body) > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+        return False
+
+    now = time.time()
+    lifetime = get_freshness_lifetime(upstream_headers, now)
+    if lifetime is None:
+        return False
+    # Without validators a response that needs revalidation is useless to keep
+    if lifetime == 0 and 'ETag' not in upstream_headers and 'Last-Modified' not in upstream_headers:
+        return False
+
+    entry = make_entry(status_code, upstream_headers, body, rewritten, resources)
+    entry['stored_at'] = now
+    entry['expires_at'] = now + lifetime
+    try:
+        cache.set(cache_key(url, base_domain), entry)
+    except Exception as e:
+        logger.warning(f"Failed to store cache entry for {url}: {str(e)}")
+        return False
+    return True
+
+class CacheCollector:
+    """
+    Collects a streamed body and stores it in the cache once it is complete.
+
+    Collection stops (and nothing is stored) once the body grows beyond
+    RESPONSE_CACHE_MAX_ENTRY_BYTES or the response is not storable.
+    """
+
+    def __init__(self, url, base_domain, status_code, upstream_headers, rewritten=False, resources=None):
+        self.url = url
+        self.base_domain = base_domain
+        self.status_code = status_code
+        self.upstream_headers = upstream_headers
+        self.rewritten = rewritten
+        # Filled in while the body is rewritten, so it is read in finish()
+        self.resources = resources
+        self.collecting = get_cache() is not None and get_freshness_lifetime(upstream_headers) is not None
+        self._chunks = []
+        self._size = 0
+
+    def add(self, chunk):
+        if not self.collecting:
+            return
+        self._size += len(chunk)
+        if self._size > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+            self.collecting = False
+            self._chunks = []
+        else:
+            self._chunks.append(chunk)
+
+    def finish(self):
+        if self.collecting:
+            store(self.url, self.base_domain, self.status_code, self.upstream_headers, b''.join(self._chunks), self.rewritten,
+                  self.resources)
+
+def tee(chunks, url, base_domain, status_code, upstream_headers, rewritten=False, resources=None):
+    """
+    Passes chunks through while collecting them, and stores the complete body.
+
+    Yields:
+        bytes: The same chunks that were passed in
+    """
+    collector = CacheCollector(url, base_domain, status_code, upstream_headers, rewritten, resources)
+    for chunk in chunks:
+        collector.add(chunk)
+        yield chunk
+    collector.finish()
+
+def client_validators(upstream_headers, base_domain, rewritten=False):
+    """
+    Builds the caching headers sent to the browser.
+
+    Passthrough bodies keep the origin's ETag. A rewritten body differs from
+    the origin's bytes, so it gets a weak ETag derived from the origin's ETag,
+    the proxy base domain and rewrite_settings() instead. Its Last-Modified
+    is dropped, since the origin's date says nothing about a change of
+    settings and If-Modified-Since would keep stale links in the browser.
+
+    Args:
+        upstream_headers (Mapping): The upstream (or cached) response headers
+        base_domain (str): The base domain of our proxy server
+        rewritten (bool): True if the body served to the client is rewritten
+
+    Returns:
+        dict: Header name -> value
+    """
+    headers = {name: upstream_headers[name] for name in CLIENT_CACHE_HEADERS if name in upstream_headers}
+    etag = upstream_headers.get('ETag')
+    if rewritten:
+        headers.pop('Last-Modified', None)
+    if etag:
+        if rewritten:
+            digest = hashlib.sha1(f"{rewrite_settings()}\n{base_domain}\n{etag}".encode('utf-8', 'surrogatepass')).hexdigest()[:20]
+            headers['ETag'] = f'W/"{digest}"'
+        else:
+            headers['ETag'] = etag
+    return headers
+
+def revalidation_headers(entry):
+    """
+    Builds conditional request headers from a cached entry's validators.
+    """
+    headers = {}
+    if 'ETag' in entry['headers']:
+        headers['If-None-Match'] = entry['headers']['ETag']
+    if 'Last-Modified' in entry['headers']:
+        headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+    return headers
+
+def refresh(url, base_domain, entry, upstream_headers):
+    """
+    Updates a cached entry after the origin answered 304 Not Modified.
+
+    Args:
+        url (str): The decoded upstream URL
+        base_domain (str): The base domain of our proxy server
+        entry (dict): The cached entry that was revalidated
+        upstream_headers (Mapping): Headers of the 304 response
+
+    Returns:
+        dict: The refreshed entry
+    """
+    headers = dict(entry['headers'])
+    for name in CACHED_HEADERS:
+        if name in upstream_headers and name not in ('Content-Type', 'Content-Encoding'):
+            headers[name] = upstream_headers[name]
+
+    now = time.time()
+    lifetime = get_freshness_lifetime(headers, now) or 0
+    entry = dict(entry, headers=headers, stored_at=now, expires_at=now + lifetime)
+    metrics.inc('mais_response_cache_total', result='revalidated')
+
+    cache = get_cache()
+    if cache is not None:
+        cache.set(cache_key(url, base_domain), entry)
+    return entry
@@ -0,0 +1,249 @@
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+from src.mais import metrics
+from src.mais import content_processor
+from src.mais.content_processor import get_content_kind, process_response
+from src.mais.private_files import CACHE_HOME
+from src.mais.response_cache import DiskCacheBackend, create_backend, rewrite_settings
+
+logger = logging.getLogger(__name__)
+
+# Cache of rewritten HTML/CSS keyed by the upstream body:
+#   'memory' (per worker, default), 'disk' (shared by all workers on the host) or 'none'
+REWRITE_CACHE_BACKEND = os.environ.get("REWRITE_CACHE_BACKEND", "memory")
+
+# Total size budget of the cached rewritten bodies (bytes)
+REWRITE_CACHE_MAX_BYTES = int(os.environ.get("REWRITE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Larger upstream bodies are not cached
+REWRITE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("REWRITE_CACHE_MAX_ENTRY_BYTES", str(2 * 1024 * 1024)))
+
+# Streamed bodies up to this size are downloaded whole and looked up before the first byte is
+# sent; larger bodies are rewritten while streaming and the result is stored for later lookups
+# (0 = never buffer, which leaves the cache to rewrite() callers such as prefetching)
+REWRITE_CACHE_BUFFER_BYTES = int(os.environ.get("REWRITE_CACHE_BUFFER_BYTES", str(256 * 1024)))
+
+# Directory used by the disk backend
+REWRITE_CACHE_DIR = os.environ.get("REWRITE_CACHE_DIR") or os.path.join(CACHE_HOME, "rewrites")
+
+def _record_hit(cpu_seconds):
+    metrics.inc('mais_rewrite_cache_total', result='hit')
+    metrics.inc('mais_rewrite_cache_cpu_seconds_total', cpu_seconds, kind='saved')
+
+def _record_miss(cpu_seconds):
+    metrics.inc('mais_rewrite_cache_total', result='miss')
+    metrics.inc('mais_rewrite_cache_cpu_seconds_total', cpu_seconds, kind='spent')
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Returns the configured cache backend, or None when the rewrite cache is disabled.
+    """
+    global _cache
+    if REWRITE_CACHE_BACKEND == 'none':
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = create_backend(REWRITE_CACHE_BACKEND, REWRITE_CACHE_DIR, REWRITE_CACHE_MAX_BYTES)
+        return _cache
+
+def uses_disk():
+    """
+    Returns True if lookups and stores do file I/O, so async callers should
+    run them in a worker thread.
+    """
+    return isinstance(get_cache(), DiskCacheBackend)
+
+def get_buffer_limit():
+    """
+    Returns how many bytes of a streamed body may be buffered to look it up
+    before anything is sent (0 = rewrite while streaming).
+    """
+    if get_cache() is None:
+        return 0
+    return min(REWRITE_CACHE_BUFFER_BYTES, REWRITE_CACHE_MAX_ENTRY_BYTES)
+
+def content_key(body, content_type, original_url, base_domain):
+    """
+    Builds the cache key for a rewritten body.
+
+    The output depends on the upstream bytes, on the URL relative links are
+    resolved against, on the proxy's own host, on the declared charset and
+    on the rewrite settings (response_cache.rewrite_settings).
+
+    Returns:
+        str: A hex digest usable as a file name
+    """
+    return _finish_key(hashlib.blake2b(body, digest_size=16), content_type, original_url, base_domain)
+
+def _finish_key(digest, content_type, original_url, base_domain):
+    digest.update(f"\n{content_type}\n{original_url}\n{base_domain}\n{rewrite_settings()}".encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+def rewrite(body, content_type, original_url, base_domain, resources=None):
+    """
+    Returns the rewritten body, reusing the previous output for identical upstream bytes.
+
+    Args:
+        body (bytes): The complete upstream body
+        content_type (str): The Content-Type header value
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy server
+        resources (list): If given, sub-resources found in HTML are appended as (destination, URL),
+            also when the output comes from the cache
+
+    Returns:
+        bytes: The processed content
+    """
+    cache = get_cache()
+    if cache is None:
+        return process_response(body, content_type, original_url, base_domain, resources)
+
+    key = content_key(body, content_type, original_url, base_domain)
+    entry = cache.get(key)
+    if entry is not None:
+        _record_hit(entry['cpu_seconds'])
+        if resources is not None:
+            resources.extend(entry.get('resources', ()))
+        return entry['body']
+
+    # thread_time excludes other requests handled by the same process
+    found = []
+    start = time.thread_time()
+    processed = process_response(body, content_type, original_url, base_domain, found)
+    cpu_seconds = time.thread_time() - start
+    _record_miss(cpu_seconds)
+    if resources is not None:
+        resources.extend(found)
+
+    try:
+        cache.set(key, {'body': processed, 'cpu_seconds': cpu_seconds, 'resources': found})
+    except Exception as e:
+        logger.warning("Could not store rewritten body for %s: %s", original_url, e)
+    return processed
+
+class CachingProcessor:
+    """
+    Push-style processor (feed/close) that rewrites while the body streams
+    and stores the result once the body is complete.
+
+    The upstream bytes are hashed as they are fed, so the cache key is
+    known when the body ends; a later rewrite() of the same bytes is a hit.
+    Bodies over REWRITE_CACHE_MAX_ENTRY_BYTES are not stored.
+    """
+
+    def __init__(self, cache, content_type, original_url, base_domain, resources=None):
+        self._cache = cache
+        self.content_type = content_type
+        self.original_url = original_url
+        self.base_domain = base_domain
+        self._resources = resources if resources is not None else []
+        self._resources_start = len(self._resources)
+        self._processor = content_processor.create_processor(content_type, original_url, base_domain, self._resources)
+        self._digest = hashlib.blake2b(digest_size=16)
+        self._size = 0
+        # None once the body is too large to store
+        self._output = []
+        self._cpu_seconds = 0.0
+
+    def feed(self, chunk):
+        self._digest.update(chunk)
+        self._size += len(chunk)
+        start = time.thread_time()
+        out = self._processor.feed(chunk)
+        self._cpu_seconds += time.thread_time() - start
+        self._keep(out)
+        return out
+
+    def close(self):
+        start = time.thread_time()
+        out = self._processor.close()
+        self._cpu_seconds += time.thread_time() - start
+        self._keep(out)
+        if self._output is not None:
+            _record_miss(self._cpu_seconds)
+            key = _finish_key(self._digest, self.content_type, self.original_url, self.base_domain)
+            entry = {
+                'body': b''.join(self._output),
+                'cpu_seconds': self._cpu_seconds,
+                'resources': self._resources[self._resources_start:],
+            }
+            self._output = None
+            try:
+                self._cache.set(key, entry)
+            except Exception as e:
+                logger.warning("Could not store rewritten body for %s: %s", self.original_url, e)
+        return out
+
+    def _keep(self, out):
+        if self._output is None:
+            return
+        if self._size > REWRITE_CACHE_MAX_ENTRY_BYTES:
+            self._output = None
+        else:
+            self._output.append(out)
+
+def create_processor(content_type, original_url, base_domain, resources=None):
+    """
+    Counterpart of content_processor.create_processor that stores the rewritten
+    body in the cache.
+
+    Returns:
+        object: The processor, or None if the content is passed through untouched
+    """
+    cache = get_cache()
+    if cache is None or get_content_kind(content_type) is None:
+        return content_processor.create_processor(content_type, original_url, base_domain, resources)
+    return CachingProcessor(cache, content_type, original_url, base_domain, resources)
+
+def iter_rewrite(chunks, content_type, original_url, base_domain, resources=None):
+    """
+    Streaming counterpart of rewrite.
+
+    Bodies up to REWRITE_CACHE_BUFFER_BYTES are collected and looked up
+    first, which delays the first byte until the whole body has been
+    downloaded. Larger bodies are rewritten while they stream and the result
+    is stored for rewrite() and later buffered lookups.
+
+    Args:
+        chunks (iterable): The upstream body as an iterable of bytes
+        content_type (str): The Content-Type header value
+        original_url (str): The original URL that we're proxying
+        base_domain (str): The base domain of our proxy server
+        resources (list): If given, sub-resources found in HTML are appended as (destination, URL)
+
+    Yields:
+        bytes: The processed content
+    """
+    processor = create_processor(content_type, original_url, base_domain, resources)
+    if processor is None:
+        yield from chunks
+        return
+
+    chunks = iter(chunks)
+    head = []
+    buffer_limit = get_buffer_limit()
+    if buffer_limit:
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size > buffer_limit:
+                break
+        else:
+            yield rewrite(b''.join(head), content_type, original_url, base_domain, resources)
+            return
+
+    for chunk in itertools.chain(head, chunks):
+        out = processor.feed(chunk)
+        if out:
+            yield out
+    out = processor.close()
+    if out:
+        yield out
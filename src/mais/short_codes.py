@@ -0,0 +1,186 @@
+import logging
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from src.mais import access_counts
+
+logger = logging.getLogger(__name__)
+
+# 外部短縮サービス: 'none'（既定、ローカルの短縮コードのみ）または 'tinyurl'（バックグラウンドで追加取得）
+EXTERNAL_SHORTENER = os.environ.get("EXTERNAL_SHORTENER", "none")
+
+# プロセス内にキャッシュする短縮コードの件数
+SHORT_CODE_CACHE_SIZE = int(os.environ.get("SHORT_CODE_CACHE_SIZE", "10000"))
+
+# 短縮コードの文字数（base62のランダムな文字列、10文字で約59ビット）
+SHORT_CODE_LENGTH = int(os.environ.get("SHORT_CODE_LENGTH", "10"))
+
+# コードが既存のものと衝突した場合に作り直す回数
+SHORT_CODE_MAX_ATTEMPTS = 5
+
+BASE62_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+class _LRUCache:
+    """
+    スレッドセーフな件数上限つきLRUキャッシュ
+    """
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+# 元のURL -> 短縮コード、短縮コード -> エンコードID
+_codes_by_url = _LRUCache(SHORT_CODE_CACHE_SIZE)
+_ids_by_code = _LRUCache(SHORT_CODE_CACHE_SIZE)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def generate_code():
+    """
+    ランダムな短縮コードを生成する関数
+    
+    連番から作ると /s/1, /s/2, ... と順に辿って登録済みのURLを集められるため、
+    推測できない乱数（secrets）から作る。
+    
+    Returns:
+        str: base62文字列
+    """
+    return ''.join(secrets.choice(BASE62_ALPHABET) for _ in range(SHORT_CODE_LENGTH))
+
+def create_short_code(original_url, encoded_id):
+    """
+    URLの短縮コードを作成する関数（同じURLには同じコードを返す）
+    
+    アプリケーションコンテキスト内で呼び出すこと。
+    
+    Args:
+        original_url (str): 元のURL
+        encoded_id (str): 元のURLのエンコードID
+        
+    Returns:
+        str: 短縮コード
+    """
+    from sqlalchemy.exc import IntegrityError
+    from app import db
+    
+    code = _codes_by_url.get(original_url)
+    if code is not None:
+        return code
+    
+    # 同じURLの同時登録（encoded_idの重複）やコードの衝突で失敗した場合は、
+    # ロールバックして登録済みの対応を引き直す
+    for attempt in range(SHORT_CODE_MAX_ATTEMPTS):
+        try:
+            mapping = _get_or_add_mapping(original_url, encoded_id)
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == SHORT_CODE_MAX_ATTEMPTS - 1:
+                raise
+            logger.debug("Short code insert conflicted, retrying: %s", original_url)
+    
+    _codes_by_url.set(original_url, mapping.short_code)
+    _ids_by_code.set(mapping.short_code, mapping.encoded_id)
+    access_counts.mark_mapped(mapping.encoded_id)
+    return mapping.short_code
+
+def _get_or_add_mapping(original_url, encoded_id):
+    from app import db
+    from src.mais.models import URLMapping
+    
+    # original_urlのインデックスで既存の対応を探す
+    mapping = URLMapping.query.filter_by(original_url=original_url).first()
+    if mapping is None:
+        mapping = URLMapping.query.filter_by(encoded_id=encoded_id).first()
+    if mapping is None:
+        mapping = URLMapping(original_url=original_url, encoded_id=encoded_id)
+        db.session.add(mapping)
+    if mapping.short_code is None:
+        mapping.short_code = generate_code()
+    db.session.flush()
+    return mapping
+
+def resolve_short_code(code):
+    """
+    短縮コードからエンコードIDを取得する関数
+    
+    アプリケーションコンテキスト内で呼び出すこと。
+    
+    Args:
+        code (str): 短縮コード
+        
+    Returns:
+        str: エンコードID（見つからない場合はNone）
+    """
+    from src.mais.models import URLMapping
+    
+    encoded_id = _ids_by_code.get(code)
+    if encoded_id is not None:
+        return encoded_id
+    
+    mapping = URLMapping.query.filter_by(short_code=code).first()
+    if mapping is None:
+        return None
+    _ids_by_code.set(code, mapping.encoded_id)
+    access_counts.mark_mapped(mapping.encoded_id)
+    return mapping.encoded_id
+
+def _shorten_externally(app, original_url, proxy_url):
+    from app import db
+    from src.mais.models import URLMapping
+    
+    with app.app_context():
+        mapping = URLMapping.query.filter_by(original_url=original_url).first()
+        if mapping is None or mapping.external_url:
+            return
+    
+    try:
+        import pyshorteners
+        external_url = pyshorteners.Shortener().tinyurl.short(proxy_url)
+    except Exception as e:
+        logger.warning("External shortening failed for %s: %s", proxy_url, e)
+        return
+    
+    with app.app_context():
+        mapping = URLMapping.query.filter_by(original_url=original_url).first()
+        if mapping is not None:
+            mapping.external_url = external_url
+            db.session.commit()
+
+def schedule_external_shortening(app, original_url, proxy_url):
+    """
+    外部短縮サービス（TinyURL）での短縮をバックグラウンドで実行する関数
+    
+    結果はURLMapping.external_urlに保存される。EXTERNAL_SHORTENERが'none'の場合は何もしない。
+    
+    Args:
+        app (flask.Flask): アプリケーション
+        original_url (str): 元のURL
+        proxy_url (str): 短縮するプロキシURL
+    """
+    global _executor
+    if EXTERNAL_SHORTENER != 'tinyurl':
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='shortener')
+    _executor.submit(_shorten_externally, app, original_url, proxy_url)
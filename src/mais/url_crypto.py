@@ -1,17 +1,181 @@
 import base64
+import binascii
+import functools
 import hashlib
+import hmac
 import logging
-from urllib.parse import quote, unquote
-import secrets
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from urllib.parse import quote, unquote, urlsplit
 import os
+from src.mais import metrics
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# ログ設定はアプリケーション側（src.mais.logging_config）で行う
 logger = logging.getLogger(__name__)
 
 # Secret key for URL encoding/decoding (keep this secure in a production environment)
 URL_ENCODING_KEY = os.environ.get("URL_ENCODING_KEY") or "mySecretKey123"
 
+# エンコード/デコード結果のメモ化件数（プロセスごと）
+URL_CACHE_SIZE = int(os.environ.get("URL_CACHE_SIZE", "65536"))
+
+# 不正と判定したエンコードIDを覚えておく件数（プロセスごと、署名の再計算とログを省く）
+URL_NEGATIVE_CACHE_SIZE = int(os.environ.get("URL_NEGATIVE_CACHE_SIZE", "4096"))
+
+# 受け付けるトークンの最大長（これより長いものは署名を計算せずに拒否する）
+MAX_TOKEN_LENGTH = int(os.environ.get("MAX_TOKEN_LENGTH", "8192"))
+
+# 新しく発行するトークンの形式: 'compact'（既定、バージョン付きバイナリ形式）または 'legacy'
+TOKEN_FORMAT = os.environ.get("URL_TOKEN_FORMAT", "compact")
+
+# コンパクト形式（v1）の先頭文字。旧形式の先頭は16進数なので衝突しない
+COMPACT_TOKEN_VERSION = "v"
+
+# コンパクト形式の署名長（バイト）
+COMPACT_MAC_SIZE = 6
+
+# コンパクト形式で1バイトに置き換えるURLの先頭部分
+# ※インデックスがトークンに埋め込まれるため、既存の要素の順番は変更しないこと（追加は末尾のみ）
+COMPACT_PREFIXES = (
+    "",
+    "https://www.",
+    "http://www.",
+    "https://",
+    "http://",
+    "https://m.",
+    "https://en.",
+    "https://ja.",
+    "https://cdn.",
+    "https://static.",
+    "https://img.",
+    "https://images.",
+    "https://fonts.googleapis.com/",
+    "https://fonts.gstatic.com/",
+    "https://ajax.googleapis.com/ajax/libs/",
+    "https://cdnjs.cloudflare.com/ajax/libs/",
+    "https://cdn.jsdelivr.net/",
+    "https://www.google.com/",
+    "https://www.youtube.com/",
+    "https://twitter.com/",
+    "https://x.com/",
+    "https://www.facebook.com/",
+    "https://www.instagram.com/",
+    "https://ja.wikipedia.org/wiki/",
+    "https://en.wikipedia.org/wiki/",
+)
+
+# COMPACT_PREFIXES の最長一致を1回の照合で求める（長いものから順に並べた選択肢）
+_PREFIX_INDEXES = {prefix: index for index, prefix in enumerate(COMPACT_PREFIXES) if prefix}
+_PREFIX_PATTERN = re.compile('|'.join(re.escape(prefix) for prefix in sorted(_PREFIX_INDEXES, key=len, reverse=True)))
+
+# 形式ごとのトークンの文字種と最短長（署名より前に安く弾くための事前チェック）
+# コンパクト形式: "v" + base64url（署名6バイト + 先頭バイト = 7バイト以上なので10文字以上）
+# 旧形式: 16進数の署名8文字 + base64url
+_COMPACT_TOKEN_PATTERN = re.compile(r"v[A-Za-z0-9_-]{10,}")
+_LEGACY_TOKEN_PATTERN = re.compile(r"[0-9a-f]{8}[A-Za-z0-9_-]*")
+
+# 圧縮フラグ（先頭バイトの最上位ビット）
+COMPACT_FLAG_DEFLATE = 0x80
+
+# URLによく現れる文字列（raw deflateのプリセット辞書）
+# ※トークンの復号に必要なため変更しないこと
+COMPACT_ZDICT = (
+    b"utm_source=utm_medium=utm_campaign=&ref=&id=&page=&q=?lang=ja"
+    b"/wp-content/uploads/wp-content/themes/assets/images/static/css/js/img/"
+    b".min.js.min.css.woff2.svg.webp.jpeg.jpg.png.gif.html.php.aspx"
+    b"index.htmlarticle/news/blog/category/tag/search/products/item/"
+    b".co.jp/.ne.jp/.or.jp/.ac.jp/.go.jp/.jp/.net/.org/.com/"
+)
+
+# プリセット辞書を読み込み済みの圧縮器（呼び出しごとにcopy()して使う）
+# URLは短いので、ウィンドウ（1KB）とメモリレベルを小さくしてcopy()のコストを抑える
+# （復号側は32KBのウィンドウで展開するため、小さいウィンドウで圧縮したトークンもそのまま読める）
+_COMPRESSOR = zlib.compressobj(9, zlib.DEFLATED, -10, 2, zlib.Z_DEFAULT_STRATEGY, COMPACT_ZDICT)
+
+# 鍵を処理済みのHMAC状態（呼び出しごとにcopy()して使う）
+_SIGNING_STATE = hmac.new(URL_ENCODING_KEY.encode(), digestmod=hashlib.sha256)
+
+# コンパクト形式の署名用に、さらにバージョン文字まで処理済みのHMAC状態
+_COMPACT_SIGNING_STATE = _SIGNING_STATE.copy()
+_COMPACT_SIGNING_STATE.update(COMPACT_TOKEN_VERSION.encode())
+
+class _InvalidToken(Exception):
+    """
+    トークンが不正な場合の例外（lru_cacheに結果を残さないために例外で返す）
+    """
+
+class _NotOriginToken(Exception):
+    """
+    オリジン相対参照のトークンがオリジン以外のURLを指している場合の例外
+    
+    トークン自体は正しく署名されており、単独の /<トークン> としては有効なため、
+    拒否したトークンとして記録してはいけない。
+    """
+
+class _RejectedTokens:
+    """
+    不正と判定したエンコードIDの件数上限つきLRU集合（スレッドセーフ）
+    """
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __contains__(self, token):
+        with self._lock:
+            if token in self._data:
+                self._data.move_to_end(token)
+                return True
+            return False
+    
+    def add(self, token):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[token] = None
+            self._data.move_to_end(token)
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+_rejected = _RejectedTokens(URL_NEGATIVE_CACHE_SIZE)
+
+def is_plausible_token(token):
+    """
+    トークンの長さ・文字種・形式（バージョン）だけを確認する関数
+    
+    署名の計算やデコードより前に、明らかにトークンではない文字列
+    （favicon.ico やスキャナーのパスなど）を安く弾くために使う。
+    
+    Args:
+        token (str): トークン（オリジン相対参照の場合は'/'より前の部分）
+        
+    Returns:
+        bool: トークンとしてあり得る場合はTrue
+    """
+    if len(token) > MAX_TOKEN_LENGTH:
+        return False
+    if token.startswith(COMPACT_TOKEN_VERSION):
+        # base64urlの長さを4で割って1余ることはない
+        return len(token[len(COMPACT_TOKEN_VERSION):]) % 4 != 1 and _COMPACT_TOKEN_PATTERN.fullmatch(token) is not None
+    return len(token[8:]) % 4 != 1 and _LEGACY_TOKEN_PATTERN.fullmatch(token) is not None
+
+def _sign(encoded):
+    """
+    エンコード部分の署名（HMAC-SHA256の最初の8文字）を計算する
+    """
+    mac = _SIGNING_STATE.copy()
+    mac.update(encoded.encode())
+    return mac.hexdigest()[:8]
+
+def _legacy_sign(encoded):
+    """
+    旧形式の署名（SHA-256(エンコード部分 + 鍵)の最初の8文字）を計算する
+    """
+    return hashlib.sha256((encoded + URL_ENCODING_KEY).encode()).hexdigest()[:8]
+
 def encode_url(original_url):
     """
     URLを独自のアルゴリズムでエンコードする関数
@@ -23,69 +187,257 @@ def encode_url(original_url):
         str: エンコードされたURL文字列
     """
     try:
-        # 特殊文字を処理するためにURLをクォートする
-        safe_url = quote(original_url)
-        
-        # base64でエンコード
-        encoded = base64.urlsafe_b64encode(safe_url.encode()).decode()
-        
-        # パディング文字(=)を削除（URLセーフにするため）
-        encoded = encoded.rstrip("=")
+        return _encode_url_cached(original_url)
+    except Exception as e:
+        logger.exception("エラー: URLのエンコード中にエラーが発生しました: %s", e)
+        return None
+
+def encode_urls(original_urls):
+    """
+    複数のURLをまとめてエンコードする関数
+    
+    Args:
+        original_urls (iterable): エンコードする元のURLのリスト
         
-        # 検証用のハッシュを追加（SHA-256ハッシュの最初の8文字）
-        hash_signature = hashlib.sha256((encoded + URL_ENCODING_KEY).encode()).hexdigest()[:8]
+    Returns:
+        list: エンコードされたURL文字列のリスト（失敗したものはNone）
+    """
+    return [encode_url(url) for url in original_urls]
+
+@functools.lru_cache(maxsize=1)
+def token_fingerprint():
+    """
+    新しく発行するトークンの形式と鍵を表す値を返す関数
+    
+    書き換え結果のETagやキャッシュキーに含め、形式や鍵が変わったときに
+    以前のトークンを埋め込んだ書き換え結果を使わないようにする。
+    鍵はHMACを通してだけ反映するため、値から鍵は分からない。
+    
+    Returns:
+        str: 16進数の文字列
+    """
+    mac = _SIGNING_STATE.copy()
+    mac.update(f"fingerprint\n{TOKEN_FORMAT}\n{COMPACT_TOKEN_VERSION}\n".encode())
+    return mac.hexdigest()[:16]
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def _encode_url_cached(original_url):
+    if TOKEN_FORMAT == 'legacy':
+        return _encode_legacy(original_url)
+    return _encode_compact(original_url)
+
+def _compact_mac(body):
+    mac = _COMPACT_SIGNING_STATE.copy()
+    mac.update(body)
+    return mac.digest()[:COMPACT_MAC_SIZE]
+
+def _encode_compact(original_url):
+    """
+    コンパクト形式（v1）でエンコードする
+    
+    形式: "v" + base64url(署名6バイト + 先頭バイト + 本体)
+    先頭バイトの下位7ビットはCOMPACT_PREFIXESのインデックス、最上位ビットは圧縮フラグ。
+    本体は残りのURLのUTF-8バイト列（短くなる場合はプリセット辞書付きraw deflate）。
+    
+    トークンは旧形式の半分程度の長さになるが、毎回deflateを試すため、
+    初回（メモ化されていない）の生成は旧形式より重い。
+    """
+    # 最も長く一致する先頭部分を1バイトに置き換える
+    match = _PREFIX_PATTERN.match(original_url)
+    if match:
+        prefix_index = _PREFIX_INDEXES[match.group()]
+        payload = original_url[match.end():].encode('utf-8', 'surrogatepass')
+    else:
+        prefix_index = 0
+        payload = original_url.encode('utf-8', 'surrogatepass')
+    
+    header = prefix_index
+    compressor = _COMPRESSOR.copy()
+    compressed = compressor.compress(payload) + compressor.flush()
+    if len(compressed) < len(payload):
+        payload = compressed
+        header |= COMPACT_FLAG_DEFLATE
+    
+    body = bytes([header]) + payload
+    token = base64.urlsafe_b64encode(_compact_mac(body) + body).decode().rstrip("=")
+    result = COMPACT_TOKEN_VERSION + token
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("元のURL: %s", original_url)
+        logger.debug("エンコード結果: %s", result)
+    return result
+
+def _decode_compact(encoded_id):
+    """
+    コンパクト形式（v1）のトークンをデコードする（不正な場合は_InvalidTokenを送出する）
+    """
+    token = encoded_id[len(COMPACT_TOKEN_VERSION):]
+    raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    if len(raw) <= COMPACT_MAC_SIZE:
+        raise _InvalidToken("短すぎます")
+    
+    mac, body = raw[:COMPACT_MAC_SIZE], raw[COMPACT_MAC_SIZE:]
+    if not hmac.compare_digest(mac, _compact_mac(body)):
+        raise _InvalidToken("ハッシュ検証に失敗しました")
+    
+    header, payload = body[0], body[1:]
+    if (header & ~COMPACT_FLAG_DEFLATE) >= len(COMPACT_PREFIXES):
+        raise _InvalidToken("未知の先頭部分です")
+    if header & COMPACT_FLAG_DEFLATE:
+        decompressor = zlib.decompressobj(-15, COMPACT_ZDICT)
+        payload = decompressor.decompress(payload) + decompressor.flush()
+    original_url = COMPACT_PREFIXES[header & ~COMPACT_FLAG_DEFLATE] + payload.decode('utf-8', 'surrogatepass')
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("エンコードされたID: %s", encoded_id)
+        logger.debug("デコード結果: %s", original_url)
+    return original_url
+
+def _encode_legacy(original_url):
+    """
+    旧形式（quote + base64 + 16進署名8文字）でエンコードする
+    """
+    # 特殊文字を処理するためにURLをクォートする
+    safe_url = quote(original_url)
         
-        # ハッシュとエンコードされた文字列を結合
-        result = f"{hash_signature}{encoded}"
+    # base64でエンコード
+    encoded = base64.urlsafe_b64encode(safe_url.encode()).decode()
+    
+    # パディング文字(=)を削除（URLセーフにするため）
+    encoded = encoded.rstrip("=")
+    
+    # 検証用の署名を追加（HMAC-SHA256の最初の8文字）
+    hash_signature = _sign(encoded)
+    
+    # ハッシュとエンコードされた文字列を結合
+    result = f"{hash_signature}{encoded}"
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("元のURL: %s", original_url)
+        logger.debug("エンコード結果: %s", result)
+    return result
+
+# オリジン相対参照の残り部分でエスケープしない文字（既存の%エスケープも保持する）
+RELATIVE_SAFE_CHARS = "/?&=:@!$'()*+,;-._~%[]"
+
+def encode_origin_relative(original_url):
+    """
+    URLをオリジン相対の参照（"<オリジンのトークン>/<パスとクエリ>"）にエンコードする関数
+    
+    署名されるのはオリジン（スキーム + ホスト）部分のみで、同じオリジンへのリンクは
+    すべて同じトークンを共有する。残り部分は常にそのオリジンの下に解決されるため、
+    別のホストを指すように改ざんすることはできない。
+    
+    Args:
+        original_url (str): エンコードする元のURL（http/https）
         
-        logger.debug(f"元のURL: {original_url}")
-        logger.debug(f"エンコード結果: {result}")
-        return result
-    except Exception as e:
-        logger.exception(f"エラー: URLのエンコード中にエラーが発生しました: {str(e)}")
+    Returns:
+        str: オリジン相対の参照（http/https以外の場合はNone）
+    """
+    parts = urlsplit(original_url)
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        return None
+    origin = f"{parts.scheme}://{parts.netloc}/"
+    token = encode_url(origin)
+    if token is None:
         return None
+    rest = parts.path[1:] if parts.path.startswith('/') else parts.path
+    if parts.query:
+        rest += '?' + parts.query
+    return token + '/' + quote(rest, safe=RELATIVE_SAFE_CHARS)
 
 def decode_url(encoded_id):
     """
     エンコードされたURLを元のURLにデコードする関数
     
+    "<トークン>/<パスとクエリ>" 形式のオリジン相対参照も受け付ける。
+    
     Args:
         encoded_id (str): エンコードされたURL識別子
         
     Returns:
         str: デコードされた元のURL（デコードに失敗した場合はNone）
     """
+    token = encoded_id.split('/', 1)[0]
+    
+    # 最近拒否したIDと、形式からしてトークンではないものは署名を計算せずに断る
+    if encoded_id in _rejected:
+        metrics.inc('mais_rejected_tokens_total', reason='cached')
+        return None
+    if not is_plausible_token(token):
+        metrics.inc('mais_rejected_tokens_total', reason='malformed')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("トークンの形式ではありません: %.200s", encoded_id)
+        return None
+    
     try:
-        if len(encoded_id) < 8:
-            logger.error(f"エラー: 無効なエンコードID（短すぎます）: {encoded_id}")
-            return None
-            
-        # ハッシュ部分とエンコード部分を抽出
-        hash_part = encoded_id[:8]
-        encoded_part = encoded_id[8:]
-        
-        # ハッシュを検証
-        calculated_hash = hashlib.sha256((encoded_part + URL_ENCODING_KEY).encode()).hexdigest()[:8]
-        if calculated_hash != hash_part:
-            logger.error(f"エラー: ハッシュ検証に失敗しました: {encoded_id}")
-            return None
-        
-        # 必要に応じてパディングを追加
-        padding_needed = len(encoded_part) % 4
-        if padding_needed:
-            encoded_part += "=" * (4 - padding_needed)
-        
-        # base64をデコード
-        decoded_bytes = base64.urlsafe_b64decode(encoded_part)
-        safe_url = decoded_bytes.decode()
-        
-        # URLアンクォートして元のURLを取得
-        original_url = unquote(safe_url)
-        
-        logger.debug(f"エンコードされたID: {encoded_id}")
-        logger.debug(f"デコード結果: {original_url}")
-        return original_url
-        
+        if '/' in encoded_id:
+            return _decode_origin_relative(encoded_id)
+        return _decode_url_cached(encoded_id)
+    except _NotOriginToken as e:
+        metrics.inc('mais_rejected_tokens_total', reason='invalid')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("無効なエンコードIDです（%s）: %.200s", e, encoded_id)
+        return None
+    except (_InvalidToken, binascii.Error, zlib.error, UnicodeError) as e:
+        # 改ざん・破損したトークンは利用者側の問題なので、ERRORではなくDEBUGで記録する
+        # （署名・base64の検証に失敗したID全体を記録し、同じIDだけを以後すぐに断る）
+        _rejected.add(encoded_id)
+        metrics.inc('mais_rejected_tokens_total', reason='invalid')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("無効なエンコードIDです（%s）: %.200s", e, encoded_id)
+        return None
     except Exception as e:
-        logger.exception(f"エラー: URLのデコード中にエラーが発生しました: {str(e)}")
-        return None
\ No newline at end of file
+        logger.exception("エラー: URLのデコード中にエラーが発生しました: %s", e)
+        return None
+
+def _decode_origin_relative(encoded_id):
+    token, rest = encoded_id.split('/', 1)
+    origin = _decode_url_cached(token)
+    
+    # トークンがオリジンのみ（"scheme://host/"）を指していることを確認する
+    parts = urlsplit(origin)
+    if parts.scheme not in ('http', 'https') or parts.path != '/' or parts.query or parts.fragment:
+        raise _NotOriginToken("オリジンではないトークンです")
+    
+    # 文字列の連結なのでホストが変わることはない
+    return origin + rest
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def _decode_url_cached(encoded_id):
+    if encoded_id.startswith(COMPACT_TOKEN_VERSION):
+        return _decode_compact(encoded_id)
+    return _decode_legacy(encoded_id)
+
+def _decode_legacy(encoded_id):
+    """
+    旧形式のトークンをデコードする（不正な場合は_InvalidTokenを送出する）
+    """
+    if len(encoded_id) < 8:
+        raise _InvalidToken("短すぎます")
+        
+    # ハッシュ部分とエンコード部分を抽出
+    hash_part = encoded_id[:8]
+    encoded_part = encoded_id[8:]
+    
+    # 署名を検証（旧形式のSHA-256署名も受け付ける）
+    hash_bytes = hash_part.encode('utf-8', 'surrogatepass')
+    if not (hmac.compare_digest(_sign(encoded_part).encode(), hash_bytes) or hmac.compare_digest(_legacy_sign(encoded_part).encode(), hash_bytes)):
+        raise _InvalidToken("ハッシュ検証に失敗しました")
+    
+    # 必要に応じてパディングを追加
+    padding_needed = len(encoded_part) % 4
+    if padding_needed:
+        encoded_part += "=" * (4 - padding_needed)
+    
+    # base64をデコード
+    decoded_bytes = base64.urlsafe_b64decode(encoded_part)
+    safe_url = decoded_bytes.decode()
+    
+    # URLアンクォートして元のURLを取得
+    original_url = unquote(safe_url)
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("エンコードされたID: %s", encoded_id)
+        logger.debug("デコード結果: %s", original_url)
+    return original_url
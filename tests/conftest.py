@@ -0,0 +1,49 @@
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# app.py reads its settings on import, so point the database and caches at a scratch directory first
+_scratch = tempfile.mkdtemp(prefix='mais-tests-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_scratch, 'mais.db'))
+os.environ.setdefault('XDG_CACHE_HOME', os.path.join(_scratch, 'cache'))
+
+class _OriginHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        page = self.server.pages.get(self.path)
+        if page is None:
+            self.send_error(404)
+            return
+        headers, body = page
+        self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def origin():
+    """
+    A local HTTP origin; register pages with origin.pages[path] = (headers, body).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _OriginHandler)
+    server.pages = {}
+    server.hits = {}
+    server.url = 'http://127.0.0.1:%d' % server.server_port
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client():
+    from app import app
+    return app.test_client()
@@ -0,0 +1,32 @@
+from src.mais import proxy_utils
+from src.mais.url_crypto import encode_url
+
+PAGE = b'<!DOCTYPE html><html><head></head><body><a href="/next.html">next</a></body></html>'
+
+def _get(client, path, headers=None):
+    with client.get(path, headers=headers) as response:
+        return response.status_code, response.headers, response.data
+
+def test_rewritten_etag_changes_with_link_token_mode(origin, client, monkeypatch):
+    origin.pages['/etag.html'] = ({
+        'Content-Type': 'text/html; charset=utf-8',
+        'Cache-Control': 'no-store',
+        'ETag': '"origin-1"',
+        'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT',
+    }, PAGE)
+    path = '/' + encode_url(origin.url + '/etag.html')
+
+    status, headers, _ = _get(client, path)
+    assert status == 200
+    assert 'Last-Modified' not in headers
+    conditional = {'If-None-Match': headers['ETag'], 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+
+    status, _, _ = _get(client, path, conditional)
+    assert status == 304
+
+    # The browser's copy links to 'absolute' tokens, which the new mode no longer produces
+    monkeypatch.setattr(proxy_utils, 'LINK_TOKEN_MODE', 'origin')
+    status, headers, body = _get(client, path, conditional)
+    assert status == 200
+    assert headers['ETag'] != conditional['If-None-Match']
+    assert body
@@ -0,0 +1,25 @@
+from src.mais import metrics
+from src.mais.url_crypto import encode_url
+
+PAGE = b'<!DOCTYPE html><html><head><link rel="stylesheet" href="/s.css"></head><body><a href="/p">x</a></body></html>'
+
+def _rewrite_cache_count(result):
+    return metrics._counters.get(metrics._key('mais_rewrite_cache_total', {'result': result}), 0)
+
+def test_identical_body_hits_rewrite_cache(origin, client):
+    # no-store keeps the response cache out of the way, so the second request reaches the rewriter
+    origin.pages['/page.html'] = ({'Content-Type': 'text/html; charset=utf-8', 'Cache-Control': 'no-store'}, PAGE)
+    path = '/' + encode_url(origin.url + '/page.html')
+    hits = _rewrite_cache_count('hit')
+    misses = _rewrite_cache_count('miss')
+
+    with client.get(path) as first:
+        first_body = first.data
+    with client.get(path) as second:
+        second_body = second.data
+
+    assert first.status_code == second.status_code == 200
+    assert first_body == second_body
+    assert origin.hits['/page.html'] == 2
+    assert _rewrite_cache_count('miss') == misses + 1
+    assert _rewrite_cache_count('hit') == hits + 1